@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+from stops import TRAILING_STOP_STEPS, INITIAL_STOP, stop_price
+
+BULLISH = 1
+BEARISH = -1
+
+# Trade kinds reported by simulate(), matching the order_type used by test.Order
+BUY = 'buy'
+SELL = 'sell'
+LIMIT_SELL = 'limit_sell'
+
+
+def align_price_data(all_data, tickers):
+    # Align per-ticker frames on the same daily grid CryptoBacktester.run_backtest walks.
+    # Returns the grid, a dates x tickers close matrix (NaN where a ticker has no bar)
+    # and a matching trend matrix of BULLISH / BEARISH / 0 from the signal column (0 where
+    # there is no bar or the signal has not warmed up).
+    min_date = max(all_data[ticker].index.min() for ticker in tickers)
+    max_date = min(all_data[ticker].index.max() for ticker in tickers)
+    grid = pd.date_range(min_date, max_date)
+
+    closes = np.full((len(grid), len(tickers)), np.nan)
+    trends = np.zeros((len(grid), len(tickers)), dtype=np.int8)
+    for column, ticker in enumerate(tickers):
+        df = all_data[ticker].reindex(grid)
+        closes[:, column] = df['close'].to_numpy(dtype=float)
+        trend = df['signal'].to_numpy()
+        trends[:, column] = np.where(trend == 'Bullish', BULLISH, np.where(trend == 'Bearish', BEARISH, 0))
+
+    has_data = ~np.isnan(closes).all(axis=1)
+    return grid[has_data], closes[has_data], trends[has_data]
+
+
+def moving_average_matrices(all_data, tickers, grid, windows):
+    # dates x tickers simple moving averages on grid for every window, from one cumulative
+    # sum per ticker instead of a rolling() call per window. Averages run over each
+    # ticker's own bars (its full frame, so earlier history warms them up) and are NaN
+    # until a window has filled, like rolling().mean().
+    averages = {window: np.full((len(grid), len(tickers)), np.nan) for window in windows}
+    for column, ticker in enumerate(tickers):
+        close = all_data[ticker]['close']
+        rows = grid.get_indexer(close.index)
+        on_grid = rows >= 0
+        sums = np.concatenate([[0.0], np.cumsum(close.to_numpy(dtype=float))])
+        for window, matrix in averages.items():
+            average = np.full(len(close), np.nan)
+            average[window - 1:] = (sums[window:] - sums[:-window]) / window
+            matrix[rows[on_grid], column] = average[on_grid]
+    return averages
+
+def crossover_trends(short_average, long_average):
+    # Trend matrix of moving_average_trend: bullish while the short average is above the
+    # long one, bearish otherwise (including before both averages exist)
+    return np.where(short_average > long_average, BULLISH, BEARISH).astype(np.int8)
+
+
+def _window_tables(values, reduce):
+    # Sparse table: level j holds reduce() over every window of 2 ** j values
+    tables = [values]
+    width = 1
+    while 2 * width <= len(values):
+        previous = tables[-1]
+        tables.append(reduce(previous[:-width], previous[width:]))
+        width *= 2
+    return tables
+
+def _first_crossing(tables, starts, thresholds, above):
+    # For every query, the first index at or after its start whose value is at or above
+    # (at or below) its threshold, or the series length if there is none. Whole windows
+    # that cannot cross are skipped, largest first, so each query takes one step per level.
+    length = len(tables[0])
+    positions = starts.copy()
+    for level in range(len(tables) - 1, -1, -1):
+        table = tables[level]
+        width = 1 << level
+        values = table[np.minimum(positions, len(table) - 1)]
+        skip = (positions <= length - width) & ((values < thresholds) if above else (values > thresholds))
+        positions += skip * width
+    return positions
+
+def order_exits(prices, entries, limit_prices, trailing_stop_steps=TRAILING_STOP_STEPS):
+    # Where every take-profit order leaves the stop book, for all orders at once.
+    # prices: closes of one ticker's bars, or of several tickers' with a NaN after each
+    # series (a NaN ends the series of the orders before it); entries: indices of the
+    # bars the orders were bought at. Returns the index of the bar that fills each order
+    # (-1 while it stays open) and the trailing stop step it ended on. Follows StopBook: step k is reached on the
+    # first bar at or above its step price, its stop holds until the next step is
+    # reached, and a bar at or below the stop, or at or above the limit price, fills the
+    # order.
+    length = len(prices)
+    ends = np.append(np.isnan(prices), True)
+    n_orders, n_steps = len(entries), len(trailing_stop_steps)
+    entry = prices[entries]
+
+    def crossings(tables, starts, thresholds, above):
+        # Crossings for n_orders-long blocks of queries; the end of a series counts as never
+        found = _first_crossing(tables, starts, thresholds, above)
+        return np.where(ends[found], length, found).reshape(-1, n_orders)
+
+    # The limit price and every step price in one pass over the running highs
+    steps = [entry * (1 + step) for step in trailing_stop_steps]
+    up = crossings(_window_tables(prices, np.maximum), np.tile(entries + 1, n_steps + 1),
+                   np.concatenate([limit_prices] + steps), True)
+    exits, reached = up[0], list(up[1:]) + [np.full(n_orders, length)]
+    # Each step's stop, searched from the bar that reaches the step (which can trigger it
+    # too, when the stop is set above the step price), in one pass over the running lows
+    stops = [entry * (1 + (INITIAL_STOP if step == 1 else trailing_stop_steps[step - 2]))
+             for step in range(1, n_steps + 1)]
+    triggered = crossings(_window_tables(prices, np.minimum), np.concatenate(reached[:-1]) if n_steps else entries,
+                          np.concatenate(stops) if n_steps else entry, False)
+    for step in range(1, n_steps + 1):
+        hit = (reached[step - 1] < length) & (triggered[step - 1] < np.minimum(reached[step], exits))
+        exits = np.where(hit, triggered[step - 1], exits)
+    end_steps = sum((days < exits).astype(int) for days in reached[:-1])
+    return np.where(exits < length, exits, -1), end_steps
+
+
+def simulate(closes, trends, volumes, balance, positions, take_profit_percentage,
+             trailing_stop_steps=TRAILING_STOP_STEPS):
+    # Replays CryptoBacktester's daily rules over aligned matrices.
+    #   closes, trends: dates x tickers arrays from align_price_data
+    #   volumes: fixed trade volume per ticker column
+    #   positions: starting holdings per ticker column
+    # Returns the trades as (day, column, kind, order_price, fill_price, placed_day) tuples
+    # in the order the loop engine appends them to filled_orders, plus the end state with
+    # the open take-profit orders as (column, limit_price, placed_day, step, stop_price).
+    # Where each order would be filled is computed in batch by order_exits, for every bar
+    # with a buy signal, before the run. The day loop then only settles cash and holdings:
+    # whether a buy is affordable or a sell covered, and the fills of the orders it placed.
+    n_days, n_tickers = closes.shape
+    positions = list(positions)
+    volumes = [float(volume) for volume in volumes]
+
+    # Batch signal and price work for the whole run
+    has_data = ~np.isnan(closes)
+    buy_signal = (trends == BULLISH) & has_data
+    sell_signal = (trends == BEARISH) & has_data
+    limit_prices = closes * (1 + take_profit_percentage)
+    costs = closes * np.asarray(volumes)
+
+    # Fill of the order a buy on each bar would place, as a key into the flattened
+    # dates x tickers matrices (-1 if it stays open), for every ticker at once: the bars of
+    # all tickers go into one series, each ticker's followed by a NaN
+    exit_keys = np.full(closes.shape, -1, dtype=np.int64)
+    end_steps = np.zeros(closes.shape, dtype=np.int64)
+    bars = np.flatnonzero(np.vstack([has_data, np.ones((1, n_tickers), dtype=bool)]).T.ravel())
+    bar_columns, bar_days = np.divmod(bars, n_days + 1)
+    is_bar = bar_days < n_days
+    series = np.where(is_bar, closes[np.minimum(bar_days, n_days - 1), bar_columns], np.nan)
+    entries = np.flatnonzero(is_bar & buy_signal[np.minimum(bar_days, n_days - 1), bar_columns])
+    if len(entries):
+        days, columns = bar_days[entries], bar_columns[entries]
+        exits, steps = order_exits(series, entries, limit_prices[days, columns], trailing_stop_steps)
+        exit_keys[days, columns] = np.where(exits >= 0, bar_days[exits] * n_tickers + columns, -1)
+        end_steps[days, columns] = steps
+
+    # One row per bar with a signal or a possible fill, in the order the loop engine visits
+    # them: by day, then by ticker column
+    kinds = np.where(buy_signal, BULLISH, np.where(sell_signal, BEARISH, 0)).ravel()
+    keys = np.union1d(np.flatnonzero(kinds), exit_keys[exit_keys >= 0])
+    rows = zip(keys.tolist(), (keys // n_tickers).tolist(), (keys % n_tickers).tolist(), kinds[keys].tolist(),
+               closes.ravel()[keys].tolist(), costs.ravel()[keys].tolist(), limit_prices.ravel()[keys].tolist(),
+               exit_keys.ravel()[keys].tolist())
+
+    # Orders placed, and those waiting for their fill by the key of the bar that fills them,
+    # as (limit_price, placed_day) in placement order
+    placed_orders = []
+    fills = {}
+    open_orders = [0] * n_tickers
+    # Reserved volume is the running sum the loop engine recomputes from scratch: with a
+    # constant volume per ticker it only depends on the number of open orders.
+    reserved = [[0] for _ in range(n_tickers)]
+    trades = []
+    skipped_buys = 0
+    skipped_sells = 0
+
+    for key, day, column, kind, price, cost, limit_price, fill_key in rows:
+        volume = volumes[column]
+        filled = fills.pop(key, None)
+        if filled:
+            for order_price, placed_day in filled:
+                balance += price * volume
+                positions[column] -= volume
+                trades.append((day, column, LIMIT_SELL, order_price, price, placed_day))
+            open_orders[column] -= len(filled)
+
+        if kind == BULLISH:
+            if balance >= cost:
+                balance -= cost
+                positions[column] = positions[column] + volume
+                trades.append((day, column, BUY, price, price, day))
+                open_orders[column] += 1
+                placed_orders.append((day, column))
+                if fill_key >= 0:
+                    fills.setdefault(fill_key, []).append((limit_price, day))
+            else:
+                skipped_buys += 1
+        elif kind == BEARISH:
+            sums = reserved[column]
+            count = open_orders[column]
+            while len(sums) <= count:
+                sums.append(sums[-1] + volume)
+            if positions[column] - sums[count] >= volume:
+                balance += price * volume
+                positions[column] -= volume
+                trades.append((day, column, SELL, price, price, day))
+            else:
+                skipped_sells += 1
+
+    unfilled = []
+    for day, column in placed_orders:
+        if exit_keys[day, column] >= 0:
+            continue
+        step = int(end_steps[day, column])
+        entry = float(closes[day, column])
+        unfilled.append((column, float(limit_prices[day, column]), int(day), step,
+                         stop_price(entry, trailing_stop_steps, step) if step else None))
+
+    return {
+        'trades': trades,
+        'open_orders': unfilled,
+        'balance': balance,
+        'positions': positions,
+        'skipped_buy_orders': skipped_buys,
+        'skipped_sell_orders': skipped_sells,
+    }
@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from resample import INTERVAL_SECONDS, BAR_COLUMNS
+from data_quality import empty_bars
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_DTYPE = np.dtype([('timestamp', '<i8')] + [(column, '<f8') for column in BAR_COLUMNS])  # seconds since the epoch, UTC
+
+
+def encode_chunk(df):
+    chunk = np.empty(len(df), dtype=CHUNK_DTYPE)
+    chunk['timestamp'] = pd.DatetimeIndex(df.index).to_numpy().astype('datetime64[s]').astype(np.int64)
+    for column in BAR_COLUMNS:
+        chunk[column] = pd.to_numeric(df[column]).to_numpy(dtype=np.float64, na_value=np.nan)
+    return chunk.tobytes()
+
+def decode_chunk(data):
+    chunk = np.frombuffer(data, dtype=CHUNK_DTYPE)
+    index = pd.DatetimeIndex(pd.to_datetime(chunk['timestamp'], unit='s'), name='Date')
+    return pd.DataFrame({column: chunk[column] for column in BAR_COLUMNS}, index=index)
+
+def subtract_ranges(start, end, ranges):
+    # Parts of [start, end) not covered by the sorted, disjoint ranges
+    missing = []
+    for lo, hi in ranges:
+        if hi <= start or lo >= end:
+            continue
+        if lo > start:
+            missing.append((start, lo))
+        start = max(start, hi)
+    if start < end:
+        missing.append((start, end))
+    return missing
+
+def merge_ranges(ranges):
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+# Content-addressed on-disk cache of raw downloads, so re-runs and full refreshes never
+# download history they already have. Every download is stored once under
+# <root>/objects/, as a file of CHUNK_DTYPE records named by the SHA-256 of its bytes;
+# a JSON manifest per source, ticker and interval lists its chunks and the time ranges
+# already fetched. fetch() only downloads the parts of a request no earlier download
+# covered. Chunks are checked against their hash when read; a corrupt or missing one is
+# dropped with its range, which is then downloaded again. A range counts as fetched only
+# up to the last bar the source returned, so bars it had not published yet are asked for
+# on the next run. Each (source, ticker, interval) is expected to be fetched by one
+# thread at a time, like the bot's per-ticker workers do.
+class BarCache:
+    def __init__(self, root):
+        self.root = root
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], f"{digest}.bin")
+
+    def _manifest_path(self, source, ticker, interval):
+        return os.path.join(self.root, source, ticker, f"{interval}.json")
+
+    def _write(self, path, data):
+        # Written under a temporary name and renamed, so readers never see half a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def load_manifest(self, source, ticker, interval):
+        path = self._manifest_path(source, ticker, interval)
+        if not os.path.exists(path):
+            return {'ranges': [], 'chunks': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self, source, ticker, interval, manifest):
+        self._write(self._manifest_path(source, ticker, interval), json.dumps(manifest, indent=1).encode())
+
+    def put(self, df):
+        data = encode_chunk(df)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, data)
+        return digest
+
+    def get(self, digest):
+        # The chunk's bars, or None when its file is missing or does not match its hash; a
+        # corrupt file is removed so the same bars can be stored again
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            os.remove(path)
+            return None
+        return decode_chunk(data)
+
+    def fetch(self, source, ticker, interval, start, end, download):
+        # Bars of [start, end) from the cache, calling download(start, end) for the parts
+        # it does not cover yet. download returns raw bars with BAR_COLUMNS indexed by
+        # naive UTC bar start.
+        lo, hi = int(pd.Timestamp(start).timestamp()), int(pd.Timestamp(end).timestamp())
+        manifest = self.load_manifest(source, ticker, interval)
+        changed = False
+        frames = []
+        for chunk in list(manifest['chunks']):
+            if chunk['end'] <= lo or chunk['start'] >= hi:
+                continue
+            bars = self.get(chunk['sha256'])
+            if bars is None:
+                logger.warning(f"Cached {source} {interval} bars of {ticker} failed their checksum, downloading them again")
+                metrics.count('bar_cache_corrupt_total', source=source)
+                manifest['chunks'].remove(chunk)
+                manifest['ranges'] = [list(part) for covered in manifest['ranges']
+                                      for part in subtract_ranges(covered[0], covered[1], [(chunk['start'], chunk['end'])])]
+                changed = True
+                continue
+            frames.append((chunk['start'], bars))
+        cached = sum(len(bars) for _, bars in frames)
+        if cached:
+            metrics.count('bars_cached_total', cached, source=source, interval=interval)
+
+        for missing_lo, missing_hi in subtract_ranges(lo, hi, manifest['ranges']):
+            bars = download(pd.Timestamp(missing_lo, unit='s'), pd.Timestamp(missing_hi, unit='s'))
+            bars = bars[(bars.index >= pd.Timestamp(missing_lo, unit='s')) & (bars.index < pd.Timestamp(missing_hi, unit='s'))]
+            if bars.empty:
+                continue
+            covered_hi = min(missing_hi, int(bars.index.max().timestamp()) + INTERVAL_SECONDS[interval])
+            manifest['chunks'].append({'sha256': self.put(bars), 'start': missing_lo, 'end': covered_hi, 'bars': len(bars)})
+            manifest['ranges'] = merge_ranges(manifest['ranges'] + [[missing_lo, covered_hi]])
+            frames.append((missing_lo, bars[BAR_COLUMNS]))
+            changed = True
+        if changed:
+            self.save_manifest(source, ticker, interval, manifest)
+
+        if not frames:
+            return empty_bars()
+        # Chunks in time order, each with its bars as downloaded: duplicates and bars out
+        # of order are left for validation, which runs after the cache
+        df = pd.concat([bars for _, bars in sorted(frames, key=lambda frame: frame[0])])
+        return df[(df.index >= pd.Timestamp(lo, unit='s')) & (df.index < pd.Timestamp(hi, unit='s'))]
+
+
+# A bar source (anything with fetch_bars(ticker, interval, start, end), such as
+# data_quality.KrakenOHLC) whose downloads go through the cache under `name`
+class CachedSource:
+    def __init__(self, cache, name, source):
+        self.cache = cache
+        self.name = name
+        self.source = source
+
+    def fetch_bars(self, ticker, interval, start, end):
+        return self.cache.fetch(self.name, ticker, interval, start, end,
+                                lambda lo, hi: self.source.fetch_bars(ticker, interval, lo, hi))
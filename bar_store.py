@@ -0,0 +1,139 @@
+import os
+import argparse
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# One append-only binary file per column, under <root>/<ticker>/<interval>/
+BAR_STORE_COLUMNS = {
+    'timestamp': np.int64,  # seconds since the epoch, UTC
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    'volume': np.float64,
+    'rsi': np.float64,
+    'ema': np.float64,
+    'trend': np.int8,  # index into TREND_CATEGORIES, -1 when unknown
+    'signal_fast_ema': np.float64,
+    'signal_slow_ema': np.float64,
+    'signal': np.int8,  # index into TREND_CATEGORIES, -1 before the signal warms up
+}
+TREND_CATEGORIES = ['Bearish', 'Bullish']
+
+SQLITE_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'rsi', 'ema', 'ground_truth_trend',
+                  'signal_fast_ema', 'signal_slow_ema', 'signal']
+CATEGORY_COLUMNS = {'ground_truth_trend': 'trend', 'signal': 'signal'}  # frame column -> code file
+
+
+def encode_bars(df):
+    # df: crypto_data columns with a '%Y-%m-%d %H:%M:%S' timestamp column
+    columns = {'timestamp': pd.to_datetime(df['timestamp']).to_numpy().astype('datetime64[s]').astype(np.int64)}
+    for name in ['open', 'high', 'low', 'close', 'volume', 'rsi', 'ema', 'signal_fast_ema', 'signal_slow_ema']:
+        columns[name] = pd.to_numeric(df[name]).to_numpy(dtype=np.float64, na_value=np.nan)
+    for name, code_column in CATEGORY_COLUMNS.items():
+        columns[code_column] = pd.Categorical(df[name], categories=TREND_CATEGORIES).codes.astype(np.int8)
+    return columns
+
+
+# Columnar bar store for analytics. Columns are read back as read-only memory maps, so
+# loading a ticker copies nothing and forked processes share the pages through the OS
+# cache. Bars are appended in timestamp order; the timestamp file is written last and
+# defines the number of complete bars, so an interrupted append is cut off next time.
+class BarStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, ticker, interval, column):
+        return os.path.join(self.root, ticker, interval, f"{column}.bin")
+
+    def length(self, ticker, interval):
+        path = self._path(ticker, interval, 'timestamp')
+        return os.path.getsize(path) // 8 if os.path.exists(path) else 0
+
+    def column(self, ticker, interval, name):
+        n = self.length(ticker, interval)
+        dtype = BAR_STORE_COLUMNS[name]
+        if n == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._path(ticker, interval, name), dtype=dtype, mode='r', shape=(n,))
+
+    def complete(self, ticker, interval):
+        # False when a stored series lacks a column added since it was written
+        return self.length(ticker, interval) == 0 or all(
+            os.path.exists(self._path(ticker, interval, name)) for name in BAR_STORE_COLUMNS)
+
+    def last_timestamp(self, ticker, interval):
+        n = self.length(ticker, interval)
+        if n == 0:
+            return None
+        return pd.Timestamp(int(self.column(ticker, interval, 'timestamp')[n - 1]), unit='s')
+
+    def append(self, ticker, interval, columns):
+        # columns: dict of arrays as returned by encode_bars, all newer than the stored bars
+        n = self.length(ticker, interval)
+        if n and len(columns['timestamp']) and columns['timestamp'][0] <= self.column(ticker, interval, 'timestamp')[-1]:
+            raise ValueError(f"Bars for {ticker} {interval} must be appended in timestamp order")
+        os.makedirs(os.path.dirname(self._path(ticker, interval, 'timestamp')), exist_ok=True)
+        for name, dtype in BAR_STORE_COLUMNS.items():
+            if name == 'timestamp':
+                continue
+            with open(self._path(ticker, interval, name), 'ab') as f:
+                f.truncate(n * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        with open(self._path(ticker, interval, 'timestamp'), 'ab') as f:
+            f.write(np.ascontiguousarray(columns['timestamp'], dtype=np.int64).tobytes())
+        return len(columns['timestamp'])
+
+    def clear(self, ticker, interval):
+        for name in BAR_STORE_COLUMNS:
+            path = self._path(ticker, interval, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def frame(self, ticker, interval='1d', columns=('close', 'signal')):
+        # Same layout as HistoricalData frames: a timestamp index and the requested columns
+        index = pd.DatetimeIndex(self.column(ticker, interval, 'timestamp').view('datetime64[s]'), name='timestamp')
+        data = {}
+        for name in columns:
+            if name in CATEGORY_COLUMNS:
+                codes = self.column(ticker, interval, CATEGORY_COLUMNS[name])
+                data[name] = pd.Categorical.from_codes(codes, categories=TREND_CATEGORIES)
+            else:
+                data[name] = pd.Series(self.column(ticker, interval, name), index=index, copy=False)
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def sync(self, conn, ticker, interval='1d', rebuild=False):
+        # Append the crypto_data rows newer than the last stored bar; rebuild rewrites
+        # the whole series, for when existing rows were replaced (--full-refresh) or the
+        # store predates one of the columns
+        if rebuild or not self.complete(ticker, interval):
+            self.clear(ticker, interval)
+        last = self.last_timestamp(ticker, interval)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+        SELECT {', '.join(SQLITE_COLUMNS)} FROM crypto_data
+        WHERE ticker = ? AND interval = ? AND timestamp > ?
+        ORDER BY timestamp ASC
+        """, (ticker, interval, '' if last is None else last.strftime('%Y-%m-%d %H:%M:%S')))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        return self.append(ticker, interval, encode_bars(pd.DataFrame(rows, columns=SQLITE_COLUMNS)))
+
+
+def export_database(db_path, root):
+    conn = sqlite3.connect(db_path)
+    store = BarStore(root)
+    for ticker, interval in conn.execute("SELECT DISTINCT ticker, interval FROM crypto_data ORDER BY ticker, interval").fetchall():
+        written = store.sync(conn, ticker, interval)
+        print(f"{ticker} {interval}: appended {written} bars, {store.length(ticker, interval)} stored")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy crypto_data bars into the columnar bar store")
+    parser.add_argument('db_path')
+    parser.add_argument('root', help="bar store directory")
+    args = parser.parse_args()
+    export_database(args.db_path, args.root)
@@ -0,0 +1,317 @@
+import os
+import gc
+import sys
+import json
+import math
+import time
+import zlib
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import kraken_daily_momentum as bot
+import test as simulation
+from test import CryptoBacktester
+from historical_data import HistoricalData
+from indicators import IndicatorState
+from resample import INTERVAL_SECONDS
+from trade_ledger import TradeLedger
+from exchange_client import ExchangeClient, MockExchange, TokenBucket
+from metrics import configure_logging
+
+# Offline benchmarks of the hot paths: ingestion (fetch_and_process_data, store_data), the
+# live decision (trade_based_on_trend and execute_plan against a mock Kraken) and both backtest engines.
+# Everything runs on synthetic bars, so results only depend on the code and the machine.
+
+Scenario = namedtuple('Scenario', ['name', 'tickers', 'interval', 'bars'])
+
+SUITES = {
+    'quick': [
+        Scenario('daily-4', 4, '1d', 1500),
+    ],
+    'full': [
+        Scenario('daily-1', 1, '1d', 1500),
+        Scenario('daily-10', 10, '1d', 1500),
+        Scenario('daily-50', 50, '1d', 1500),
+        Scenario('daily-500', 500, '1d', 1500),
+        Scenario('hourly-20', 20, '1h', 24 * 365),
+        Scenario('minute-4', 4, '1m', 60 * 24 * 7),  # Yahoo serves 7 days of 1m bars
+    ],
+}
+SYNTHETIC_START = datetime(2020, 1, 1)
+SYNTHETIC_SEED = 42
+DAILY_VOLATILITY = 0.03
+LOOP_BACKTEST_MAX_TICKERS = 50  # the day-by-day engine is skipped above this many tickers
+BASELINE_PATH = 'benchmark_baseline.json'
+TIME_TOLERANCE = 0.25  # a stage this much slower than its baseline fails the comparison
+MEMORY_TOLERANCE = 0.25
+MEMORY_NOISE_BYTES = 1 << 20  # peak memory differences below 1 MB are ignored
+
+StageResult = namedtuple('StageResult', ['seconds', 'units', 'unit', 'peak_bytes'])
+
+
+def synthetic_pair(ticker):
+    return ticker.replace('-', '/')
+
+def synthetic_bars(ticker, interval, bars, start=SYNTHETIC_START, seed=SYNTHETIC_SEED):
+    # Geometric random walk shaped like a yf.download result. Each ticker gets its own
+    # reproducible stream, so adding tickers does not change the existing ones.
+    rng = np.random.default_rng([seed, zlib.crc32(ticker.encode())])
+    step = INTERVAL_SECONDS[interval]
+    index = pd.date_range(start, periods=bars, freq=pd.Timedelta(seconds=step), name='Date')
+    close = 100 * np.exp(np.cumsum(rng.normal(0, DAILY_VOLATILITY * math.sqrt(step / 86400), bars)))
+    spread = np.abs(rng.normal(0, DAILY_VOLATILITY * math.sqrt(step / 86400) / 2, bars))
+    return pd.DataFrame({
+        'Open': np.concatenate([[close[0]], close[:-1]]),
+        'High': close * (1 + spread),
+        'Low': close * (1 - spread),
+        'Close': close,
+        'Volume': rng.uniform(1e5, 1e6, bars),
+    }, index=index)
+
+
+# Offline stand-in for the yfinance module: download() answers from pre-generated bars
+# with yfinance's [start, end) semantics
+class SyntheticMarket:
+    def __init__(self, scenario, seed=SYNTHETIC_SEED):
+        self.scenario = scenario
+        self.tickers = [f"SYN{i:03d}-USD" for i in range(scenario.tickers)]
+        self.history = {ticker: synthetic_bars(ticker, scenario.interval, scenario.bars, seed=seed)
+                        for ticker in self.tickers}
+        self.start = SYNTHETIC_START
+        self.end = SYNTHETIC_START + pd.Timedelta(seconds=INTERVAL_SECONDS[scenario.interval] * scenario.bars)
+
+    def download(self, ticker, start=None, end=None, interval='1d', **kwargs):
+        history = self.history[ticker]
+        start, end = (pd.Timestamp(bound).tz_convert(None) if pd.Timestamp(bound).tzinfo else pd.Timestamp(bound)
+                      for bound in (start, end))
+        return history[(history.index >= start) & (history.index < end)].copy()
+
+    def last_prices(self):
+        return {synthetic_pair(ticker): history['Close'].iat[-1] for ticker, history in self.history.items()}
+
+
+def mock_kraken(market):
+    # No throttling and no fill batching window: the stage measures our own overhead
+    unlimited = float('inf')
+    exchange = MockExchange(market.last_prices(), {'USD': 1e12})
+    return ExchangeClient(exchange, private_bucket=TokenBucket(unlimited, 1), public_bucket=TokenBucket(unlimited, 1),
+                          fill_batch_window=0)
+
+@contextlib.contextmanager
+def synthetic_environment(market):
+    # Points the bot and the backtester at the synthetic market and a mock exchange
+    pairs = {ticker: synthetic_pair(ticker) for ticker in market.tickers}
+    volumes = {pair: 1.0 for pair in pairs.values()}
+    saved = (bot.yf, bot.kraken, bot.MIN_TRADE_VOLUME, bot.BAR_STORE_PATH, bot.BAR_CACHE_PATH, simulation.TICKER_TO_PAIR)
+    bot.yf = market
+    bot.kraken = mock_kraken(market)
+    bot.MIN_TRADE_VOLUME = {**bot.MIN_TRADE_VOLUME, **volumes}
+    bot.BAR_STORE_PATH = None
+    bot.BAR_CACHE_PATH = None
+    simulation.TICKER_TO_PAIR = {**simulation.TICKER_TO_PAIR, **pairs}
+    try:
+        yield volumes
+    finally:
+        bot.yf, bot.kraken, bot.MIN_TRADE_VOLUME, bot.BAR_STORE_PATH, bot.BAR_CACHE_PATH, simulation.TICKER_TO_PAIR = saved
+
+
+def measure(function, trace_memory):
+    gc.collect()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    units = function()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline if trace_memory else None
+    return seconds, units, peak
+
+def run_pass(market, db_path, trace_memory=False):
+    # One pass over every stage on a fresh fixture database. Each stage builds on the
+    # previous one, exactly like a first bot run followed by a backtest.
+    scenario = market.scenario
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = bot.connect_db(db_path)
+    bot.create_tables(conn)
+    results = {}
+    processed = {}
+
+    with synthetic_environment(market) as volumes:
+        def fetch_and_process():
+            for ticker in market.tickers:
+                state = IndicatorState()
+                processed[ticker] = (bot.fetch_and_process_data(ticker, market.start, market.end, state,
+                                                                scenario.interval), state)
+            return sum(len(df) for df, state in processed.values())
+
+        def store():
+            for ticker, (df, state) in processed.items():
+                bot.store_data(conn, ticker, df, state, scenario.interval)
+            return sum(len(df) for df, state in processed.values())
+
+        def trade():
+            ledger = TradeLedger(conn).load()
+            engine = bot.risk_engine()
+            for ticker in market.tickers:
+                bot.trade_based_on_trend(conn, ledger, ticker, synthetic_pair(ticker), scenario.interval, engine)
+            bot.execute_plan(ledger, engine)
+            ledger.flush()
+            return sum(1 for call in bot.kraken.exchange.calls if call[0] == 'create_order')
+
+        def backtest(engine):
+            def run():
+                start_date = market.start.strftime('%Y-%m-%d')
+                end_date = (market.end - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+                backtester = CryptoBacktester(db_path, start_date, end_date, 1e9, {}, min_trade_volume=volumes,
+                                              data=HistoricalData(db_path, interval=scenario.interval))
+                backtester.run_backtest(market.tickers, engine=engine)
+                backtester.data.close()
+                return scenario.bars * scenario.tickers
+            return run
+
+        stages = [('fetch_and_process_data', fetch_and_process, 'bars'),
+                  ('store_data', store, 'bars'),
+                  ('trade_based_on_trend', trade, 'orders')]
+        # Both engines step through daily bars
+        if scenario.interval == '1d':
+            if scenario.tickers <= LOOP_BACKTEST_MAX_TICKERS:
+                stages.append(('run_backtest[loop]', backtest('loop'), 'bars'))
+            stages.append(('run_backtest[vectorized]', backtest('vectorized'), 'bars'))
+
+        for name, function, unit in stages:
+            seconds, units, peak = measure(function, trace_memory)
+            results[name] = StageResult(seconds, units, unit, peak)
+
+    conn.close()
+    return results
+
+def run_scenario(scenario, workdir, repeat=3, seed=SYNTHETIC_SEED):
+    # Wall time is the best of `repeat` passes; peak memory comes from one extra pass
+    # under tracemalloc, which would otherwise slow the timed passes down
+    market = SyntheticMarket(scenario, seed)
+    db_path = os.path.join(workdir, f"{scenario.name}.db")
+    timed = [run_pass(market, db_path) for _ in range(repeat)]
+    tracemalloc.start()
+    try:
+        traced = run_pass(market, db_path, trace_memory=True)
+    finally:
+        tracemalloc.stop()
+    return {stage: StageResult(min(result[stage].seconds for result in timed), traced[stage].units,
+                               traced[stage].unit, traced[stage].peak_bytes)
+            for stage in traced}
+
+def run_suite(scenarios, workdir, repeat=3, seed=SYNTHETIC_SEED):
+    results = {}
+    for scenario in scenarios:
+        print(f"Running {scenario.name}: {scenario.tickers} tickers x {scenario.bars} {scenario.interval} bars")
+        results[scenario.name] = run_scenario(scenario, workdir, repeat, seed)
+    return results
+
+
+def machine_info():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+def to_records(results):
+    return {scenario: {stage: result._asdict() for stage, result in stages.items()}
+            for scenario, stages in results.items()}
+
+def save_baseline(path, suite, results):
+    baseline = {'created': datetime.now(timezone.utc).isoformat(), 'suite': suite, 'machine': machine_info(),
+                'results': to_records(results)}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+def results_table(results, baseline=None, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    rows = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            row = {
+                'scenario': scenario,
+                'stage': stage,
+                'seconds': result.seconds,
+                'throughput': f"{result.units / result.seconds:,.0f} {result.unit}/s" if result.seconds else '',
+                'peak_mb': result.peak_bytes / 2 ** 20,
+            }
+            previous = (baseline or {}).get(scenario, {}).get(stage)
+            if baseline is not None:
+                row['baseline_seconds'] = previous['seconds'] if previous else np.nan
+                row['change'] = result.seconds / previous['seconds'] - 1 if previous else np.nan
+                row['status'] = compare_stage(result, previous, time_tolerance, memory_tolerance)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+def compare_stage(result, previous, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    if previous is None:
+        return 'new'
+    if result.seconds > previous['seconds'] * (1 + time_tolerance):
+        return 'SLOWER'
+    if result.peak_bytes - previous['peak_bytes'] > max(MEMORY_NOISE_BYTES, previous['peak_bytes'] * memory_tolerance):
+        return 'MORE MEMORY'
+    return 'ok'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of ingestion, indicators, the live decision and the backtester")
+    parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    parser.add_argument('--tickers', type=int, help="run one custom scenario with this many tickers instead of a suite")
+    parser.add_argument('--interval', choices=sorted(INTERVAL_SECONDS), default='1d', help="bar interval of the custom scenario")
+    parser.add_argument('--bars', type=int, default=1500, help="bars per ticker in the custom scenario")
+    parser.add_argument('--repeat', type=int, default=3, help="timed passes per scenario; the fastest one is reported")
+    parser.add_argument('--seed', type=int, default=SYNTHETIC_SEED)
+    parser.add_argument('--workdir', help="keep the fixture databases in this directory")
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE_PATH, help=f"store the results as the baseline (default {BASELINE_PATH})")
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH,
+                        help="compare with a stored baseline and exit with status 1 on a regression")
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    if args.tickers:
+        suite = f"custom-{args.tickers}-{args.interval}-{args.bars}"
+        scenarios = [Scenario(suite, args.tickers, args.interval, args.bars)]
+    else:
+        suite = args.suite
+        scenarios = SUITES[suite]
+
+    baseline = None
+    if args.compare:
+        # Baselines are per machine and not committed: a fresh checkout has to record one
+        if not os.path.exists(args.compare):
+            parser.error(f"no baseline at {args.compare}; record one first with --save-baseline "
+                         f"(on the code to compare against, e.g. after git stash)")
+        with open(args.compare) as f:
+            stored = json.load(f)
+        if stored['suite'] != suite:
+            parser.error(f"{args.compare} holds a baseline of the {stored['suite']} suite, not {suite}")
+        if stored['machine'] != machine_info():
+            print(f"Warning: {args.compare} was recorded on a different machine or library versions: {stored['machine']}")
+        baseline = stored['results']
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        results = run_suite(scenarios, workdir, args.repeat, args.seed)
+
+    table = results_table(results, baseline, args.time_tolerance, args.memory_tolerance)
+    with pd.option_context('display.width', 200, 'display.float_format', '{:.4f}'.format):
+        print(table.to_string(index=False))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, suite, results)
+        print(f"Baseline written to {args.save_baseline}")
+    if baseline is not None:
+        regressions = table[~table['status'].isin(['ok', 'new'])]
+        if not regressions.empty:
+            print(f"{len(regressions)} stages regressed beyond the tolerance")
+            sys.exit(1)
+        print("No regressions against the baseline")
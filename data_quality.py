@@ -0,0 +1,125 @@
+import logging
+from collections import namedtuple
+import ccxt
+import numpy as np
+import pandas as pd
+from resample import INTERVAL_SECONDS, BAR_COLUMNS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+QualityReport = namedtuple('QualityReport', ['bars', 'duplicates', 'out_of_order', 'invalid', 'gaps', 'filled', 'missing'])
+
+
+def empty_bars():
+    return pd.DataFrame({column: pd.Series(dtype=float) for column in BAR_COLUMNS},
+                        index=pd.DatetimeIndex([], name='Date'))
+
+def epoch_seconds(index):
+    return pd.DatetimeIndex(index).to_numpy().astype('datetime64[s]').astype(np.int64)
+
+def check_bars(df):
+    # Bars in timestamp order, without duplicate timestamps (the last one is kept, as
+    # yfinance repeats a bar it has revised) and without bars that cannot be traded on:
+    # missing or non-positive prices, or a close outside the bar's low-high range.
+    # Returns (bars, duplicates, out_of_order, invalid).
+    times = epoch_seconds(df.index)
+    out_of_order = int((np.diff(times) < 0).sum())
+    if out_of_order:
+        df = df.sort_index(kind='stable')
+    duplicated = df.index.duplicated(keep='last')
+    prices = {column: df[column].to_numpy(dtype=float, na_value=np.nan) for column in ['open', 'high', 'low', 'close']}
+    # NaN compares False, so missing prices fail the checks too
+    valid = ((prices['open'] > 0) & (prices['low'] > 0) & (prices['low'] <= prices['close'])
+             & (prices['close'] <= prices['high']))
+    keep = valid & ~duplicated
+    if keep.all():
+        return df, 0, out_of_order, 0
+    return df[keep], int(duplicated.sum()), out_of_order, int((~valid & ~duplicated).sum())
+
+def find_gaps(index, start, end, interval):
+    # Runs of missing bars in [start, end) as [(first missing bar, end of the run)].
+    # Crypto trades around the clock, so every bucket of the interval should have a bar.
+    seconds = INTERVAL_SECONDS[interval]
+    first = -(-int(pd.Timestamp(start).timestamp()) // seconds) * seconds
+    grid = np.arange(first, int(pd.Timestamp(end).timestamp()), seconds, dtype=np.int64)
+    missing = grid[~np.isin(grid, epoch_seconds(index))]
+    if not len(missing):
+        return []
+    breaks = np.flatnonzero(np.diff(missing) != seconds)
+    runs = zip(np.concatenate([[0], breaks + 1]), np.concatenate([breaks, [len(missing) - 1]]))
+    return [(pd.Timestamp(missing[lo], unit='s'), pd.Timestamp(missing[hi] + seconds, unit='s')) for lo, hi in runs]
+
+def in_gaps(index, gaps):
+    inside = np.zeros(len(index), dtype=bool)
+    for start, end in gaps:
+        inside |= (index >= start) & (index < end)
+    return inside
+
+
+# Secondary source for missing bars: Kraken's public OHLC endpoint, through an
+# ExchangeClient (or one over a MockExchange). One paged query covers all the gaps of a
+# ticker. Kraken only serves the most recent OHLC_MAX_BARS bars of an interval, so gaps
+# older than that stay missing.
+class KrakenOHLC:
+    def __init__(self, client, pairs):
+        self.client = client
+        self.pairs = pairs
+
+    def fetch_bars(self, ticker, interval, start, end):
+        pair = self.pairs.get(ticker)
+        if pair is None:
+            logger.warning(f"No Kraken pair for {ticker}, its {interval} gaps stay missing")
+            return empty_bars()
+        step = INTERVAL_SECONDS[interval] * 1000
+        since = int(pd.Timestamp(start).timestamp() * 1000)
+        until = int(pd.Timestamp(end).timestamp() * 1000)
+        rows = {}
+        while since < until:
+            page = [row for row in self.client.fetch_ohlcv(pair, interval, since) if since <= row[0] < until]
+            if not page:
+                break
+            rows.update((row[0], row) for row in page)
+            since = page[-1][0] + step
+        if not rows:
+            return empty_bars()
+        values = np.array([rows[timestamp] for timestamp in sorted(rows)], dtype=float)
+        index = pd.DatetimeIndex(pd.to_datetime(values[:, 0].astype(np.int64), unit='ms'), name='Date')
+        return pd.DataFrame(values[:, 1:6], index=index, columns=BAR_COLUMNS)
+
+
+def validate_bars(ticker, df, interval, start, end, source=None):
+    # The data-quality stage between download and store. df: raw bars with BAR_COLUMNS,
+    # indexed by naive UTC bar start. Bad bars are dropped; the gaps they and the source
+    # left in [start, end) (from the first bar when start is None) are filled from
+    # `source` in one request where it has the bars. Returns the clean bars and a
+    # QualityReport.
+    df, duplicates, out_of_order, invalid = check_bars(df)
+    if start is None:
+        start = df.index[0] if len(df) else end
+    gaps = find_gaps(df.index, start, end, interval)
+    missing = sum(int((gap_end - gap_start).total_seconds()) // INTERVAL_SECONDS[interval] for gap_start, gap_end in gaps)
+    filled = 0
+    if gaps and source is not None:
+        try:
+            fills, _, _, _ = check_bars(source.fetch_bars(ticker, interval, gaps[0][0], gaps[-1][1]))
+        except ccxt.BaseError as e:
+            logger.warning(f"Could not fill {interval} gaps of {ticker}: {type(e).__name__}: {str(e)}")
+            fills = empty_bars()
+        fills = fills[in_gaps(fills.index, gaps)]
+        if len(fills):
+            df = pd.concat([df, fills]).sort_index()
+            filled = len(fills)
+
+    report = QualityReport(len(df), duplicates, out_of_order, invalid, len(gaps), filled, missing - filled)
+    for name, count in [('duplicate', duplicates), ('out_of_order', out_of_order), ('invalid', invalid)]:
+        if count:
+            metrics.count('bars_rejected_total', count, interval=interval, reason=name)
+    if filled:
+        metrics.count('bars_gap_filled_total', filled, interval=interval)
+    if report.missing:
+        metrics.count('bars_missing_total', report.missing, interval=interval)
+    if duplicates or out_of_order or invalid or gaps:
+        logger.warning(f"{ticker} {interval} bars: {duplicates} duplicate, {out_of_order} out of order, {invalid} invalid; "
+                       f"{len(gaps)} gaps, {filled} bars filled, {report.missing} still missing")
+    return df, report
@@ -0,0 +1,374 @@
+import logging
+import time
+import random
+import itertools
+import threading
+from collections import Counter
+import ccxt
+import requests
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Kraken's private API counter: starter tier accounts may spend 15 points, recovering 0.33
+# points per second. Most calls cost 1, history calls 2; order placement has its own
+# per-pair limits and does not touch the counter.
+PRIVATE_COUNTER_LIMIT = 15
+PRIVATE_COUNTER_DECAY = 0.33
+PUBLIC_CALLS_PER_SECOND = 1.0
+CALL_COSTS = {'fetch_closed_orders': 2, 'fetch_my_trades': 2, 'fetch_ledger': 2, 'create_order': 0, 'cancel_order': 0,
+              'edit_order': 0}
+
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 0.5
+FILL_BATCH_WINDOW_SECONDS = 0.2  # fill lookups arriving within this window share one query
+FILL_LOOKUP_ATTEMPTS = 3
+MAX_ORDERS_PER_QUERY = 20  # Kraken QueryOrders accepts at most 20 txids
+CLOSED_ORDERS_PAGE_SIZE = 50  # Kraken ClosedOrders returns 50 orders per page, newest first
+OHLC_MAX_BARS = 720  # Kraken OHLC only serves the most recent 720 bars of an interval
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def acquire(self, cost=1):
+        # Blocks until cost tokens are available; returns the time spent waiting
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return waited
+                wait = (cost - self.tokens) / self.refill_per_second
+            time.sleep(wait)
+            waited += wait
+
+    def drain(self):
+        # The exchange says we are over its limit: wait for a full refill before the next call
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+
+
+def pooled_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+
+class FillBatch:
+    def __init__(self):
+        self.ids = []
+        self.orders = {}
+        self.error = None
+        self.closed = False
+        self.done = threading.Event()
+
+
+# Rate-limited, retrying wrapper around a ccxt exchange (or MockExchange). Public and
+# private calls draw from separate token buckets. Private calls are serialized because
+# Kraken rejects nonces that arrive out of order. Reads are retried on any network
+# error; orders are only retried when the exchange rejected them for rate limiting, so
+# a timeout can never place the same order twice. Every call is counted in `calls`.
+class ExchangeClient:
+    def __init__(self, exchange, private_bucket=None, public_bucket=None, fill_batch_window=FILL_BATCH_WINDOW_SECONDS):
+        self.exchange = exchange
+        self.private_bucket = private_bucket or TokenBucket(PRIVATE_COUNTER_LIMIT, PRIVATE_COUNTER_DECAY)
+        self.public_bucket = public_bucket or TokenBucket(1, PUBLIC_CALLS_PER_SECOND)
+        self.private_lock = threading.Lock()
+        self.fill_lock = threading.Lock()
+        self.fill_batch = None
+        self.fill_batch_window = fill_batch_window
+        self.calls = Counter()
+
+    @classmethod
+    def kraken(cls, api_key, secret, pool_size=8):
+        # ccxt's own throttle is disabled; the token buckets above replace it
+        return cls(ccxt.kraken({
+            'apiKey': api_key,
+            'secret': secret,
+            'enableRateLimit': False,
+            'session': pooled_session(pool_size),
+        }))
+
+    def call(self, method, *args, private=False, idempotent=True):
+        bucket = self.private_bucket if private else self.public_bucket
+        for attempt in itertools.count():
+            waited = bucket.acquire(CALL_COSTS.get(method, 1))
+            if waited:
+                metrics.count('exchange_throttled_seconds_total', waited, method=method)
+            try:
+                if private:
+                    with self.private_lock:
+                        return self._timed_call(method, args)
+                return self._timed_call(method, args)
+            except (ccxt.RateLimitExceeded, ccxt.DDoSProtection) as e:
+                bucket.drain()
+                error = e
+            except ccxt.NetworkError as e:
+                if not idempotent:
+                    raise
+                error = e
+            metrics.count('exchange_retries_total', method=method)
+            if attempt >= MAX_RETRIES:
+                raise error
+            delay = BACKOFF_SECONDS * 2 ** attempt * (1 + random.random())
+            logger.warning(f"{method} failed ({type(error).__name__}: {str(error)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def _timed_call(self, method, args):
+        self.calls[method] += 1
+        metrics.count('exchange_calls_total', method=method)
+        started = time.perf_counter()
+        try:
+            return getattr(self.exchange, method)(*args)
+        except ccxt.BaseError as e:
+            metrics.count('exchange_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('exchange_call_seconds', time.perf_counter() - started, method=method)
+
+    def fetch_ticker(self, pair):
+        return self.call('fetch_ticker', pair)
+
+    def fetch_tickers(self, pairs):
+        return self.call('fetch_tickers', list(pairs))
+
+    def fetch_ohlcv(self, pair, timeframe, since=None):
+        # [timestamp ms, open, high, low, close, volume] rows from `since` (ms) on
+        return self.call('fetch_ohlcv', pair, timeframe, since)
+
+    def fetch_balance(self):
+        return self.call('fetch_balance', private=True)
+
+    def create_market_order(self, pair, side, volume):
+        return self.call('create_order', pair, 'market', side, volume, private=True, idempotent=False)
+
+    def create_limit_sell_order(self, pair, volume, price):
+        return self.call('create_order', pair, 'limit', 'sell', volume, price, private=True, idempotent=False)
+
+    def create_stop_loss_order(self, pair, volume, stop_price):
+        # A market sell the exchange triggers once the price trades at or below stop_price
+        return self.call('create_order', pair, 'market', 'sell', volume, None, {'stopLossPrice': stop_price},
+                         private=True, idempotent=False)
+
+    def amend_stop_loss_order(self, order_id, pair, volume, stop_price):
+        # Kraken's EditOrder replaces the order: the response carries a new order id
+        return self.call('edit_order', order_id, pair, 'market', 'sell', volume, None, {'stopLossPrice': stop_price},
+                         private=True, idempotent=False)
+
+    def cancel_order(self, order_id):
+        # Canceling twice only fails with OrderNotFound, so network errors are retried
+        return self.call('cancel_order', order_id, private=True)
+
+    def fetch_orders_by_ids(self, order_ids):
+        orders = []
+        for start in range(0, len(order_ids), MAX_ORDERS_PER_QUERY):
+            orders.extend(self.call('fetch_orders_by_ids', order_ids[start:start + MAX_ORDERS_PER_QUERY], private=True))
+        return orders
+
+    def fetch_open_orders(self):
+        # Kraken returns every open order of the account, for all pairs, in one response
+        return self.call('fetch_open_orders', private=True)
+
+    def fetch_closed_orders_since(self, since):
+        # All orders closed after since (ms), paged by offset. Orders closing while we page
+        # shift later pages down, which can repeat an order but never skip one.
+        orders = {}
+        offset = 0
+        while True:
+            page = self.call('fetch_closed_orders', None, None, None,
+                             {'start': since // 1000, 'closetime': 'close', 'ofs': offset}, private=True)
+            for order in page:
+                orders[order['id']] = order
+            offset += len(page)
+            if len(page) < CLOSED_ORDERS_PAGE_SIZE:
+                return list(orders.values())
+
+    def fetch_order_batched(self, order_id):
+        # Threads asking within fill_batch_window seconds of each other share one query;
+        # the first one waits out the window and runs it for the whole batch
+        with self.fill_lock:
+            batch = self.fill_batch
+            leader = batch is None or batch.closed
+            if leader:
+                batch = self.fill_batch = FillBatch()
+            batch.ids.append(order_id)
+        if leader:
+            time.sleep(self.fill_batch_window)
+            with self.fill_lock:
+                batch.closed = True
+            try:
+                batch.orders = {order['id']: order for order in self.fetch_orders_by_ids(batch.ids)}
+            except ccxt.BaseError as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.orders.get(order_id)
+
+    def fill_price(self, order):
+        # Average fill price from the order response, or from a batched order query while
+        # the exchange has not reported it yet; None if it never does
+        for attempt in range(FILL_LOOKUP_ATTEMPTS + 1):
+            if order.get('average'):
+                return order['average']
+            if order.get('status') == 'closed' and order.get('price'):
+                return order['price']
+            if attempt < FILL_LOOKUP_ATTEMPTS:
+                order = self.fetch_order_batched(order['id']) or order
+        return None
+
+
+# Local stand-in for the ccxt methods the bot uses. Market orders fill at once at the
+# current price; like Kraken, the order response only carries the order id and the fill
+# shows up when the order is queried. Limit sells stay open until set_price crosses them;
+# stop-loss sells until set_price drops to their stop, when they fill at that price.
+# OHLC bars are served from `ohlcv`, {(pair, timeframe): rows in time order}.
+class MockExchange:
+    def __init__(self, prices=None, balances=None, slippage=0.0, ohlcv=None):
+        self.prices = dict(prices or {})
+        self.balances = dict(balances or {})
+        self.ohlcv = dict(ohlcv or {})
+        self.slippage = slippage
+        self.orders = {}
+        self.ids = itertools.count(1)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def set_price(self, pair, price):
+        with self.lock:
+            self.prices[pair] = price
+            for order in self.orders.values():
+                if order['symbol'] != pair or order['status'] != 'open':
+                    continue
+                if order['stopPrice'] is not None:
+                    if price <= order['stopPrice']:
+                        self._fill(order, price, order['remaining'])
+                elif price >= order['price']:
+                    self._fill(order, order['price'], order['remaining'])
+
+    def fill_partially(self, order_id, volume, price):
+        with self.lock:
+            self._fill(self.orders[order_id], price, volume)
+
+    def cancel_order(self, order_id):
+        self.calls.append(('cancel_order', order_id))
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or order['status'] != 'open':
+                raise ccxt.OrderNotFound(f"MockExchange has no open order {order_id}")
+            order.update({'status': 'canceled', 'lastUpdateTimestamp': self._now()})
+        return {'id': order_id, 'status': 'canceled'}
+
+    def _price(self, pair):
+        if pair not in self.prices:
+            raise ccxt.BadSymbol(f"MockExchange has no price for {pair}")
+        return self.prices[pair]
+
+    def _now(self):
+        return int(time.time() * 1000)
+
+    def _fill(self, order, price, volume):
+        base, quote = order['symbol'].split('/')
+        sign = 1 if order['side'] == 'buy' else -1
+        self.balances[base] = self.balances.get(base, 0) + sign * volume
+        self.balances[quote] = self.balances.get(quote, 0) - sign * volume * price
+        filled = order['filled'] + volume
+        order['average'] = ((order['average'] or 0) * order['filled'] + price * volume) / filled
+        order.update({'filled': filled, 'remaining': order['amount'] - filled})
+        if order['remaining'] <= 1e-12:
+            order.update({'status': 'closed', 'remaining': 0, 'lastUpdateTimestamp': self._now()})
+
+    def fetch_ticker(self, pair):
+        self.calls.append(('fetch_ticker', pair))
+        return {'symbol': pair, 'last': self._price(pair)}
+
+    def fetch_tickers(self, pairs):
+        self.calls.append(('fetch_tickers', tuple(pairs)))
+        return {pair: {'symbol': pair, 'last': self._price(pair)} for pair in pairs}
+
+    def fetch_ohlcv(self, pair, timeframe='1m', since=None, limit=None, params={}):
+        # Like Kraken, only the most recent OHLC_MAX_BARS bars are served
+        self.calls.append(('fetch_ohlcv', pair, timeframe, since))
+        rows = self.ohlcv.get((pair, timeframe), [])[-OHLC_MAX_BARS:]
+        return [list(row) for row in rows if since is None or row[0] >= since]
+
+    def fetch_balance(self):
+        # Like Kraken, free balances exclude what open limit orders hold
+        self.calls.append(('fetch_balance',))
+        with self.lock:
+            free = dict(self.balances)
+            for order in self.orders.values():
+                if order['status'] == 'open':
+                    base, quote = order['symbol'].split('/')
+                    if order['side'] == 'sell':
+                        free[base] = free.get(base, 0) - order['remaining']
+                    else:
+                        free[quote] = free.get(quote, 0) - order['remaining'] * order['price']
+            return {'total': dict(self.balances), 'free': free}
+
+    def create_order(self, pair, order_type, side, amount, price=None, params={}):
+        self.calls.append(('create_order', pair, order_type, side, amount, price))
+        with self.lock:
+            return self._create(pair, order_type, side, amount, price, params.get('stopLossPrice'))
+
+    def edit_order(self, order_id, pair, order_type, side, amount=None, price=None, params={}):
+        self.calls.append(('edit_order', order_id, pair, amount, params.get('stopLossPrice')))
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or order['status'] != 'open':
+                raise ccxt.OrderNotFound(f"MockExchange has no open order {order_id}")
+            order.update({'status': 'canceled', 'lastUpdateTimestamp': self._now()})
+            return self._create(pair, order_type, side, amount or order['remaining'], price, params.get('stopLossPrice'))
+
+    def _create(self, pair, order_type, side, amount, price, stop_price):
+        order_id = f"MOCK-{next(self.ids)}"
+        order = {'id': order_id, 'symbol': pair, 'type': order_type, 'side': side, 'amount': amount,
+                 'price': price, 'stopPrice': stop_price, 'average': None, 'status': 'open', 'filled': 0,
+                 'remaining': amount, 'timestamp': self._now(), 'lastUpdateTimestamp': None}
+        self.orders[order_id] = order
+        if order_type == 'market' and stop_price is None:
+            current = self._price(pair)
+            self._fill(order, current * (1 + self.slippage if side == 'buy' else 1 - self.slippage), amount)
+        return {'id': order_id, 'symbol': pair, 'type': order_type, 'side': side, 'amount': amount}
+
+    def fetch_orders_by_ids(self, order_ids):
+        self.calls.append(('fetch_orders_by_ids', tuple(order_ids)))
+        with self.lock:
+            return [dict(self.orders[order_id]) for order_id in order_ids if order_id in self.orders]
+
+    def fetch_open_orders(self, pair=None, since=None, limit=None, params={}):
+        self.calls.append(('fetch_open_orders', pair))
+        with self.lock:
+            return [dict(order) for order in self.orders.values()
+                    if order['status'] == 'open' and pair in (None, order['symbol'])]
+
+    def fetch_closed_orders(self, pair=None, since=None, limit=None, params={}):
+        # Kraken semantics: newest first, 'start' (exclusive, seconds) on the close time,
+        # pages of CLOSED_ORDERS_PAGE_SIZE from offset 'ofs'
+        self.calls.append(('fetch_closed_orders', pair, params.get('start'), params.get('ofs', 0)))
+        start = params.get('start')
+        with self.lock:
+            closed = [dict(order) for order in self.orders.values()
+                      if order['status'] != 'open' and pair in (None, order['symbol'])
+                      and (start is None or order['lastUpdateTimestamp'] // 1000 > start)]
+        closed.sort(key=lambda order: order['lastUpdateTimestamp'], reverse=True)
+        offset = params.get('ofs', 0)
+        return closed[offset:offset + CLOSED_ORDERS_PAGE_SIZE]
@@ -0,0 +1,92 @@
+import sqlite3
+import pandas as pd
+
+
+# In-memory price history for the backtester. Each ticker's full series is read from
+# crypto_data once with a parameterized query and kept; date windows, first/last prices
+# and timestamp lookups are then answered from memory. One instance can be shared by
+# any number of CryptoBacktester instances in the same process (and is inherited by
+# forked sweep workers). With a BarStore the series are memory-mapped from its column
+# files instead of being read from SQLite.
+class HistoricalData:
+    def __init__(self, db_path=None, conn=None, interval='1d', bar_store=None):
+        self.db_path = db_path
+        self.conn = conn
+        self.interval = interval
+        self.bar_store = bar_store
+        self.frames = {}
+        self.positions = {}
+        self.windows = {}
+
+    def _connection(self):
+        if self.conn is None:
+            if self.db_path is None:
+                raise ValueError("HistoricalData has no database to load from")
+            self.conn = sqlite3.connect(self.db_path)
+        return self.conn
+
+    def load(self, ticker):
+        df = self.frames.get(ticker)
+        if df is None and self.bar_store is not None:
+            df = self.bar_store.frame(ticker, self.interval)
+            self.frames[ticker] = df
+        elif df is None:
+            df = pd.read_sql_query("""
+            SELECT timestamp, close, signal
+            FROM crypto_data
+            WHERE ticker = ? AND interval = ?
+            ORDER BY timestamp ASC
+            """, self._connection(), params=(ticker, self.interval))
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            df.set_index('timestamp', inplace=True)
+            self.frames[ticker] = df
+        return df
+
+    def preload(self, tickers):
+        for ticker in tickers:
+            self.load(ticker)
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _bounds(self, ticker, start, end):
+        key = (ticker, start, end)
+        bounds = self.windows.get(key)
+        if bounds is None:
+            index = self.load(ticker).index
+            bounds = (index.searchsorted(start, side='left'), index.searchsorted(end, side='right'))
+            self.windows[key] = bounds
+        return bounds
+
+    def window(self, ticker, start, end):
+        lo, hi = self._bounds(ticker, start, end)
+        return self.load(ticker).iloc[lo:hi]
+
+    def first_price(self, ticker, start, end):
+        lo, hi = self._bounds(ticker, start, end)
+        if lo >= hi:
+            raise IndexError(f"No data for {ticker} between {start} and {end}")
+        return self.load(ticker)['close'].iat[lo]
+
+    def last_price(self, ticker, start, end):
+        lo, hi = self._bounds(ticker, start, end)
+        if lo >= hi:
+            raise IndexError(f"No data for {ticker} between {start} and {end}")
+        return self.load(ticker)['close'].iat[hi - 1]
+
+    def price_at(self, ticker, timestamp):
+        positions = self.positions.get(ticker)
+        if positions is None:
+            positions = {timestamp: i for i, timestamp in enumerate(self.load(ticker).index)}
+            self.positions[ticker] = positions
+        i = positions.get(pd.Timestamp(timestamp))
+        return None if i is None else self.frames[ticker]['close'].iat[i]
+
+    def __getstate__(self):
+        # Connections cannot be pickled; workers only need the loaded frames
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
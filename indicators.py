@@ -0,0 +1,208 @@
+import json
+import math
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from signals import SIGNAL_FAST_SPAN, SIGNAL_SLOW_SPAN, SIGNAL_COLUMNS, ema_step, trend_signal, batch_signals
+
+RSI_LENGTH = 14
+EMA_LENGTH = 20
+SHORT_MA_WINDOW = 50
+LONG_MA_WINDOW = 200
+TOLERANCE = 1e-8
+
+
+# Per-ticker indicator state that advances by one bar in O(1). It reproduces the batch
+# calculation: pandas_ta RSI(14) and EMA(20), the 50/200 rolling means behind
+# ground_truth_trend, and the full-history 50/200 EMAs of the trend signal (signals.py)
+# that the bot and the backtester trade on.
+class IndicatorState:
+    def __init__(self):
+        self.timestamp = None
+        self.count = 0
+        self.last_close = None
+        # pandas_ta's Wilder average is an adjusted ewm: keep the running averages and their weight
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.rsi_weight = 0.0
+        # EMA(20) seeded with the SMA of its first 20 closes
+        self.ema = None
+        self.ema_seed_sum = 0.0
+        # Ring buffer of the last LONG_MA_WINDOW closes and the running window sums
+        self.closes = [0.0] * LONG_MA_WINDOW
+        self.short_sum = 0.0
+        self.long_sum = 0.0
+        # Fast and slow EMAs of the trend signal
+        self.trend_emas = [None, None]
+
+    def update(self, timestamp, close):
+        close = float(close)
+        index = self.count
+
+        rsi = None
+        if self.last_close is not None:
+            change = close - self.last_close
+            alpha = 1.0 / RSI_LENGTH
+            decayed_weight = self.rsi_weight * (1 - alpha)
+            self.avg_gain = (decayed_weight * self.avg_gain + max(change, 0.0)) / (decayed_weight + 1)
+            self.avg_loss = (decayed_weight * self.avg_loss + max(-change, 0.0)) / (decayed_weight + 1)
+            self.rsi_weight = decayed_weight + 1
+            total = self.avg_gain + self.avg_loss
+            if index >= RSI_LENGTH and total > 0:
+                rsi = 100 * self.avg_gain / total
+
+        if index < EMA_LENGTH:
+            self.ema_seed_sum += close
+            if index == EMA_LENGTH - 1:
+                self.ema = self.ema_seed_sum / EMA_LENGTH
+        else:
+            alpha = 2.0 / (EMA_LENGTH + 1)
+            self.ema = (1 - alpha) * self.ema + alpha * close
+
+        slot = index % LONG_MA_WINDOW
+        if index >= SHORT_MA_WINDOW:
+            self.short_sum -= self.closes[(index - SHORT_MA_WINDOW) % LONG_MA_WINDOW]
+        if index >= LONG_MA_WINDOW:
+            self.long_sum -= self.closes[slot]
+        self.closes[slot] = close
+        self.short_sum += close
+        self.long_sum += close
+        if slot == LONG_MA_WINDOW - 1:
+            # Resync the running sums once per lap so rounding error cannot accumulate
+            self.long_sum = math.fsum(self.closes)
+            self.short_sum = math.fsum(self.closes[slot - SHORT_MA_WINDOW + 1:slot + 1])
+
+        fast_ema, slow_ema = self.trend_emas
+        self.trend_emas = [ema_step(fast_ema, close, SIGNAL_FAST_SPAN), ema_step(slow_ema, close, SIGNAL_SLOW_SPAN)]
+
+        self.count += 1
+        self.last_close = close
+        self.timestamp = timestamp
+
+        return {
+            'rsi': rsi,
+            'ema': self.ema if index >= EMA_LENGTH - 1 else None,
+            'ground_truth_trend': 'Bullish' if self.moving_average_trend_is_bullish() else 'Bearish',
+            'signal_fast_ema': self.trend_emas[0],
+            'signal_slow_ema': self.trend_emas[1],
+            'signal': trend_signal(*self.trend_emas, self.count),
+        }
+
+    def moving_averages(self):
+        short_ma = self.short_sum / SHORT_MA_WINDOW if self.count >= SHORT_MA_WINDOW else None
+        long_ma = self.long_sum / LONG_MA_WINDOW if self.count >= LONG_MA_WINDOW else None
+        return short_ma, long_ma
+
+    def moving_average_trend_is_bullish(self):
+        short_ma, long_ma = self.moving_averages()
+        return short_ma is not None and long_ma is not None and short_ma > long_ma
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, payload):
+        # Fields dropped since the state was saved are ignored
+        state = cls()
+        state.__dict__.update((name, value) for name, value in json.loads(payload).items() if name in state.__dict__)
+        return state
+
+
+def load_indicator_state(conn, ticker, interval='1d'):
+    cursor = conn.cursor()
+    cursor.execute("SELECT state FROM indicator_state WHERE ticker = ? AND interval = ?", (ticker, interval))
+    row = cursor.fetchone()
+    return IndicatorState.from_json(row[0]) if row else None
+
+def save_indicator_state(conn, ticker, state, interval='1d'):
+    # Callers commit, so the state is written in the same transaction as the bars it describes
+    conn.execute("""
+    INSERT OR REPLACE INTO indicator_state (ticker, interval, timestamp, state)
+    VALUES (?, ?, ?, ?)
+    """, (ticker, interval, state.timestamp, state.to_json()))
+
+def rebuild_indicator_state(conn, ticker, interval='1d'):
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT timestamp, close FROM crypto_data
+    WHERE ticker = ? AND interval = ?
+    ORDER BY timestamp ASC
+    """, (ticker, interval))
+    state = IndicatorState()
+    for timestamp, close in cursor:
+        state.update(timestamp, close)
+    return state
+
+
+def batch_indicators(close):
+    import pandas_ta as ta
+
+    df = pd.DataFrame({'close': close.astype(float)})
+    df['rsi'] = ta.rsi(df['close'], length=RSI_LENGTH)
+    df['ema'] = ta.ema(df['close'], length=EMA_LENGTH)
+    df['short_ma'] = df['close'].rolling(window=SHORT_MA_WINDOW).mean()
+    df['long_ma'] = df['close'].rolling(window=LONG_MA_WINDOW).mean()
+    df['ground_truth_trend'] = np.where(df['short_ma'] > df['long_ma'], 'Bullish', 'Bearish')
+    return df
+
+def compare_with_pandas(closes, tolerance=TOLERANCE):
+    closes = pd.Series(closes, dtype=float).reset_index(drop=True)
+    expected = batch_indicators(closes)
+
+    state = IndicatorState()
+    streamed = pd.DataFrame([state.update(i, close) for i, close in enumerate(closes)], dtype=object)
+
+    errors = {}
+    for column in ['rsi', 'ema']:
+        actual = streamed[column].astype(float).to_numpy()
+        reference = expected[column].to_numpy()
+        if not np.array_equal(np.isnan(actual), np.isnan(reference)):
+            raise ValueError(f"{column}: streaming and pandas disagree on which bars are defined")
+        scale = np.maximum(np.abs(reference), 1.0)
+        errors[column] = float(np.nanmax(np.abs(actual - reference) / scale, initial=0.0))
+
+    # A bar whose two averages are equal to within rounding may legitimately land on either side
+    short_ma, long_ma = expected['short_ma'].to_numpy(), expected['long_ma'].to_numpy()
+    ambiguous = np.abs(short_ma - long_ma) <= tolerance * np.abs(long_ma)
+    mismatched = (streamed['ground_truth_trend'].to_numpy() != expected['ground_truth_trend'].to_numpy()) & ~ambiguous
+    errors['ground_truth_trend'] = int(mismatched.sum())
+
+    signals = batch_signals(closes)
+    for column in SIGNAL_COLUMNS[:2]:
+        actual = streamed[column].astype(float).to_numpy()
+        reference = signals[column].to_numpy()
+        errors[column] = float(np.max(np.abs(actual - reference) / np.maximum(np.abs(reference), 1.0), initial=0.0))
+    fast, slow = signals['signal_fast_ema'].to_numpy(), signals['signal_slow_ema'].to_numpy()
+    ambiguous = np.abs(fast - slow) <= tolerance * np.abs(slow)
+    mismatched = (streamed['signal'].to_numpy() != signals['signal'].to_numpy()) & ~ambiguous
+    errors['signal'] = int(mismatched.sum())
+
+    failures = {name: error for name, error in errors.items() if error > tolerance}
+    if failures:
+        raise ValueError(f"Streaming indicators exceed tolerance {tolerance}: {failures}")
+    return errors
+
+
+def main(db_path, tolerance):
+    conn = sqlite3.connect(db_path)
+    series = conn.execute("SELECT DISTINCT ticker, interval FROM crypto_data ORDER BY ticker, interval").fetchall()
+    for ticker, interval in series:
+        closes = [row[0] for row in conn.execute(
+            "SELECT close FROM crypto_data WHERE ticker = ? AND interval = ? ORDER BY timestamp ASC", (ticker, interval))]
+        errors = compare_with_pandas(closes, tolerance)
+        print(f"{ticker} {interval}: {len(closes)} bars within tolerance, max errors {errors}")
+
+        stored = load_indicator_state(conn, ticker, interval)
+        if stored is not None and stored.count:
+            rebuilt = rebuild_indicator_state(conn, ticker, interval)
+            drift = max(abs(a - b) / max(abs(b), 1.0) for a, b in zip(stored.trend_emas, rebuilt.trend_emas))
+            print(f"{ticker} {interval}: stored state at {stored.timestamp}, drift from a full replay {drift}")
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the streaming indicators against the pandas calculation")
+    parser.add_argument('db_path')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    main(args.db_path, args.tolerance)
@@ -1,302 +1,893 @@
+import logging
 import os
+import argparse
 import ccxt
 import yfinance as yf
 import pandas as pd
 import sqlite3
-import pandas_ta as ta
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from resample import BarResampler, INTERVAL_SECONDS, BAR_COLUMNS, bucket_start
+from indicators import IndicatorState, load_indicator_state, save_indicator_state, rebuild_indicator_state
+from signals import SIGNAL_COLUMNS, latest_signal, backfill_signals
+from trade_ledger import TradeLedger
+from stops import convert_legacy_stops
+from bar_store import BarStore
+from bar_cache import BarCache, CachedSource
+from data_quality import KrakenOHLC, empty_bars, validate_bars
+from exchange_client import ExchangeClient
+from risk import SIZING_MODES, AccountBalances, RiskEngine, realized_volatility, take_profit_entry
+from reconcile import reconcile_orders
+from metrics import metrics, configure_logging, profiled
+
+logger = logging.getLogger(__name__)
 
 
 
 DB_PATH = os.path.abspath('/path/to/database/crypto_data.db')
 TAKE_PROFIT_PERCENTAGE = 0.30
-TRAILING_STOP_STEP = 0.05  # 5% step for trailing stop
 TICKERS = ['SOL-USD', 'XRP-USD', 'BTC-USD', 'ETH-USD']
 KRAKEN_PAIRS = {'SOL-USD': 'SOL/USD', 'XRP-USD': 'XRP/USD', 'BTC-USD': 'BTC/USD', 'ETH-USD': 'ETH/USD'}
 MIN_TRADE_VOLUME = {'SOL/USD': 0.02, 'XRP/USD': 10.0, 'BTC/USD': 0.0001, 'ETH/USD': 0.002}
-
-kraken = ccxt.kraken({
-    'apiKey': os.environ.get('KRAKEN_API_KEY'),
-    'secret': os.environ.get('KRAKEN_API_SECRET')
-})
-
+HISTORY_START_DATE = '2020-01-01'
+BASE_INTERVAL = '1d'  # interval downloaded from Yahoo Finance
+ROLLUP_INTERVALS = []  # higher intervals built from base bars, e.g. ['1h', '1d'] with BASE_INTERVAL = '1m'
+TRADE_INTERVAL = '1d'  # interval whose bars drive the trading decision
+# Yahoo Finance only serves recent intraday history
+YF_MAX_LOOKBACK_DAYS = {'1m': 7, '5m': 59, '15m': 59, '30m': 59, '1h': 729}
+MAX_WORKERS = 8  # tickers processed concurrently
+BAR_STORE_PATH = None  # directory of the columnar bar store kept next to SQLite, e.g. 'bars'
+BAR_CACHE_PATH = None  # directory of the content-hashed cache of raw downloads, e.g. 'cache'
+FILL_GAPS = True  # fill missing bars from Kraken's public OHLC endpoint
+SIZING = 'fixed'  # order sizing of the risk engine: 'fixed' (MIN_TRADE_VOLUME), 'volatility' or 'target_weight'
+EXCHANGE_STOPS = False  # rest trailing stops on the exchange as stop-loss orders instead of watching them locally
+
+# One SQLite connection is shared by the worker threads; every statement and commit on it
+# goes through db_lock so a single writer is ever active. Trade history is not touched by
+# the workers at all: it is loaded into a TradeLedger up front and flushed once at the end.
+# Exchange calls go through an ExchangeClient, which rate-limits, retries and serializes
+# private calls itself, so the workers can share it freely.
+db_lock = threading.RLock()
+# Stop changes of one order (cancel, place, amend) must not interleave across the threads
+# handling ticks and bar closes
+stop_lock = threading.Lock()
+
+kraken = ExchangeClient.kraken(os.environ.get('KRAKEN_API_KEY'), os.environ.get('KRAKEN_API_SECRET'),
+                               pool_size=MAX_WORKERS)
+
+
+def connect_db(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # WAL lets readers such as a backtest run during the daily write, and under WAL
+    # synchronous=NORMAL only syncs at checkpoints rather than on every commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have run, so
+# create_tables upgrades an existing database in place and a new one runs them all.
+# A step is a SQL statement or a function called with the connection for data changes.
+SCHEMA_MIGRATIONS = [
+    # 1: original tables
+    [
+        """
+        CREATE TABLE IF NOT EXISTS crypto_data (
+            ticker TEXT,
+            timestamp TEXT,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            rsi REAL,
+            ema REAL,
+            ground_truth_trend TEXT,
+            PRIMARY KEY (ticker, timestamp)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS trade_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticker TEXT,
+            pair TEXT,
+            trade_type TEXT,
+            price REAL,
+            volume REAL,
+            timestamp TEXT,
+            limit_order INTEGER,
+            limit_price REAL,
+            filled INTEGER DEFAULT 0,
+            filled_at REAL,
+            filled_timestamp TEXT,
+            trailing_stop_price REAL,
+            current_step INTEGER DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS indicator_state (
+            ticker TEXT PRIMARY KEY,
+            timestamp TEXT,
+            state TEXT
+        )
+        """,
+    ],
+    # 2: partial covering indexes for the open-order and latest-buy lookups, so neither
+    # scans the whole trade history. SQLite only treats a partial index as covering when
+    # it also holds the columns of its WHERE clause.
+    [
+        """
+        CREATE INDEX IF NOT EXISTS idx_trade_history_open_orders
+        ON trade_history (ticker, id, price, volume, limit_price, trailing_stop_price, current_step, limit_order, filled)
+        WHERE limit_order = 1 AND filled = 0
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_trade_history_last_buy
+        ON trade_history (ticker, timestamp, id, price, trade_type)
+        WHERE trade_type = 'buy'
+        """,
+    ],
+    # 3: store crypto_data clustered on its (ticker, timestamp) key instead of in a rowid
+    # table plus a separate primary key index
+    [
+        """
+        CREATE TABLE crypto_data_new (
+            ticker TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            rsi REAL,
+            ema REAL,
+            ground_truth_trend TEXT,
+            PRIMARY KEY (ticker, timestamp)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO crypto_data_new
+        SELECT ticker, timestamp, open, high, low, close, volume, rsi, ema, ground_truth_trend
+        FROM crypto_data
+        WHERE ticker IS NOT NULL AND timestamp IS NOT NULL
+        """,
+        "DROP TABLE crypto_data",
+        "ALTER TABLE crypto_data_new RENAME TO crypto_data",
+    ],
+    # 4: bars and indicator state are keyed by interval; existing rows are daily bars
+    [
+        """
+        CREATE TABLE crypto_data_new (
+            ticker TEXT NOT NULL,
+            interval TEXT NOT NULL DEFAULT '1d',
+            timestamp TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            rsi REAL,
+            ema REAL,
+            ground_truth_trend TEXT,
+            PRIMARY KEY (ticker, interval, timestamp)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO crypto_data_new
+        SELECT ticker, '1d', timestamp, open, high, low, close, volume, rsi, ema, ground_truth_trend
+        FROM crypto_data
+        """,
+        "DROP TABLE crypto_data",
+        "ALTER TABLE crypto_data_new RENAME TO crypto_data",
+        """
+        CREATE TABLE indicator_state_new (
+            ticker TEXT NOT NULL,
+            interval TEXT NOT NULL DEFAULT '1d',
+            timestamp TEXT,
+            state TEXT,
+            PRIMARY KEY (ticker, interval)
+        )
+        """,
+        "INSERT INTO indicator_state_new SELECT ticker, '1d', timestamp, state FROM indicator_state",
+        "DROP TABLE indicator_state",
+        "ALTER TABLE indicator_state_new RENAME TO indicator_state",
+    ],
+    # 5: exchange order ids and fill state for reconciliation, plus a key/value table for
+    # its since-cursor; the open-order index is rebuilt to keep covering the ledger query
+    [
+        "ALTER TABLE trade_history ADD COLUMN exchange_order_id TEXT",
+        "ALTER TABLE trade_history ADD COLUMN exchange_status TEXT",
+        "ALTER TABLE trade_history ADD COLUMN filled_volume REAL",
+        "DROP INDEX IF EXISTS idx_trade_history_open_orders",
+        """
+        CREATE INDEX idx_trade_history_open_orders
+        ON trade_history (ticker, id, price, volume, timestamp, limit_price, trailing_stop_price, current_step,
+                          exchange_order_id, exchange_status, filled_volume, limit_order, filled)
+        WHERE limit_order = 1 AND filled = 0
+        """,
+        """
+        CREATE UNIQUE INDEX idx_trade_history_exchange_order_id
+        ON trade_history (exchange_order_id)
+        WHERE exchange_order_id IS NOT NULL
+        """,
+        """
+        CREATE TABLE sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """,
+    ],
+    # 6: the trend signal and its EMAs on every bar (signals.py), computed for the
+    # stored history by replaying each series
+    [
+        "ALTER TABLE crypto_data ADD COLUMN signal_fast_ema REAL",
+        "ALTER TABLE crypto_data ADD COLUMN signal_slow_ema REAL",
+        "ALTER TABLE crypto_data ADD COLUMN signal TEXT",
+        backfill_signals,
+    ],
+    # 7: the kind of exchange order behind an open take-profit row, 'limit' or
+    # 'stop-loss' once its trailing stop rests on the exchange (NULL reads as 'limit'),
+    # and the steps of open orders stepped under the old 5% rule moved to stops.py's rule
+    [
+        "ALTER TABLE trade_history ADD COLUMN exchange_order_type TEXT",
+        convert_legacy_stops,
+        "DROP INDEX IF EXISTS idx_trade_history_open_orders",
+        """
+        CREATE INDEX idx_trade_history_open_orders
+        ON trade_history (ticker, id, price, volume, timestamp, limit_price, trailing_stop_price, current_step,
+                          exchange_order_id, exchange_status, filled_volume, exchange_order_type, limit_order, filled)
+        WHERE limit_order = 1 AND filled = 0
+        """,
+    ],
+]
 
 def create_tables(conn):
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS crypto_data (
-        ticker TEXT,
-        timestamp TEXT,
-        open REAL,
-        high REAL,
-        low REAL,
-        close REAL,
-        volume REAL,
-        rsi REAL,
-        ema REAL,
-        ground_truth_trend TEXT,
-        PRIMARY KEY (ticker, timestamp)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS trade_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ticker TEXT,
-        pair TEXT,
-        trade_type TEXT,
-        price REAL,
-        volume REAL,
-        timestamp TEXT,
-        limit_order INTEGER,
-        limit_price REAL,
-        filled INTEGER DEFAULT 0,
-        filled_at REAL,
-        filled_timestamp TEXT,
-        trailing_stop_price REAL,
-        current_step INTEGER DEFAULT 0
-    )
-    """)
-    conn.commit()
-
-def log_trade(conn, ticker, pair, trade_type, price, volume, limit_order=0, limit_price=None, filled=0, filled_at=None, filled_timestamp=None, trailing_stop_price=None, current_step=0):
-    cursor = conn.cursor()
-    timestamp = datetime.now().isoformat()
-    cursor.execute("""
-    INSERT INTO trade_history 
-    (ticker, pair, trade_type, price, volume, timestamp, limit_order, limit_price, filled, filled_at, filled_timestamp, trailing_stop_price, current_step)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (ticker, pair, trade_type, price, volume, timestamp, limit_order, limit_price, filled, filled_at, filled_timestamp, trailing_stop_price, current_step))
-    conn.commit()
-
-def fetch_ticker_price(pair):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        # Each migration and its version bump commit together or not at all
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        logger.info(f"Database schema migrated to version {target}")
+
+# The order functions below trade through the module-level `kraken` client with the
+# module settings unless a portfolio passes its own client, risk engine and take-profit
+# (portfolio_runner.py). With the run's AccountBalances, fills are applied to the cached
+# balances so later orders of the run are sized without another fetch_balance.
+
+def fetch_ticker_price(pair, client=None):
+    client = client or kraken
     try:
-        return kraken.fetch_ticker(pair)['last']
-    except Exception as e:
-        print(f"Error fetching ticker price for {pair}: {str(e)}")
+        return client.fetch_ticker(pair)['last']
+    except ccxt.BaseError as e:
+        logger.error(f"Error fetching ticker price for {pair}: {type(e).__name__}: {str(e)}")
         return None
 
-def execute_trade(conn, pair, direction, volume):
-    try:
-        order = kraken.create_market_order(pair, direction, volume)
-        filled_price = fetch_ticker_price(pair)
-        if filled_price:
-            filled = 1 if direction == 'buy' else 0
-            log_trade(conn, pair.replace('/', '-'), pair, direction, filled_price, volume, filled=filled)
-            print(f"Successfully placed {direction} order for {volume} of {pair} at price {filled_price}")
-            
-            # Place take-profit limit sell order immediately after a successful buy
-            if direction == 'buy':
-                execute_limit_sell(conn, pair, filled_price, volume)
-            
-            return order
-        else:
-            print("Order executed, but the ticker price could not be retrieved.")
+def execute_trade(ledger, pair, direction, volume, client=None, take_profit_percentage=None, balances=None):
+    client = client or kraken
+    with metrics.timer('order_placement'):
+        try:
+            order = client.create_market_order(pair, direction, volume)
+        except ccxt.BaseError as e:
+            logger.error(f"Exception while placing {direction} order for {pair}: {type(e).__name__}: {str(e)}")
+            metrics.count('orders_failed_total', side=direction, type='market')
             return None
-    except Exception as e:
-        print(f"Exception while placing order: {str(e)}")
+
+        try:
+            filled_price = client.fill_price(order)
+        except ccxt.BaseError as e:
+            logger.warning(f"Could not query order {order['id']}: {type(e).__name__}: {str(e)}")
+            filled_price = None
+    metrics.count('orders_placed_total', side=direction, type='market')
+    if filled_price is None:
+        logger.warning(f"Fill price of order {order['id']} not reported, using the last ticker price")
+        filled_price = fetch_ticker_price(pair, client)
+    if not filled_price:
+        logger.warning("Order executed, but the fill price could not be retrieved.")
         return None
 
-def execute_limit_sell(conn, pair, buy_price, volume):
-    limit_price = buy_price * (1 + TAKE_PROFIT_PERCENTAGE)
+    filled = 1 if direction == 'buy' else 0
+    ledger.log_trade(pair.replace('/', '-'), pair, direction, filled_price, volume, filled=filled,
+                     exchange_order_id=order['id'])
+    logger.info(f"Successfully placed {direction} order {order['id']} for {volume} of {pair} at price {filled_price}")
+    if balances is not None:
+        balances.record_fill(pair, direction, volume, filled_price)
+
+    # A successful buy is covered by the pair's take-profit order
+    if direction == 'buy':
+        combine_take_profit(ledger, pair, filled_price, volume, client, take_profit_percentage, balances)
+
+    return order
+
+def combine_take_profit(ledger, pair, buy_price, volume, client=None, take_profit_percentage=None, balances=None):
+    # Keeps one resting take-profit order per pair: the open ones are canceled and a
+    # single limit sell covers their remaining volume plus the new buy, at the
+    # take-profit of the volume-weighted entry price. An order that cannot be canceled
+    # (it filled meanwhile, or the call failed) is left for reconciliation to pick up.
+    # The canceled orders only leave the ledger once the combined order is placed; if it
+    # cannot be, they are put back on the exchange and the buy gets its own take-profit.
+    client = client or kraken
+    base = pair.split('/')[0]
+    combined = []
+    for order in ledger.get_open_orders(pair.replace('/', '-')):
+        if order['exchange_order_id'] is None:
+            continue
+        try:
+            with metrics.timer('order_placement'):
+                client.cancel_order(order['exchange_order_id'])
+        except ccxt.BaseError as e:
+            logger.warning(f"Could not cancel take-profit order {order['exchange_order_id']}: {type(e).__name__}: {str(e)}")
+            continue
+        metrics.count('orders_canceled_total', type='limit')
+        combined.append(order)
+    total, entry = take_profit_entry(combined, volume, buy_price)
+    if balances is not None:
+        balances.hold(base, volume - total)
+    if combined:
+        logger.info(f"Combining {len(combined)} take-profit orders of {pair} with the new buy: {total} at entry {entry}")
+    if execute_limit_sell(ledger, pair, entry, total, client, take_profit_percentage):
+        for order in combined:
+            ledger.apply_exchange_order(order, 'canceled', order['filled_volume'], None)
+        if balances is not None:
+            balances.hold(base, total)
+        return
+    if not combined:
+        return
+    logger.warning(f"Restoring the {len(combined)} canceled take-profit orders of {pair}")
+    for order in combined:
+        remaining = order['volume'] - (order['filled_volume'] or 0)
+        restore_take_profit(ledger, order, pair, remaining, client)
+        if balances is not None and order['exchange_order_id'] is not None:
+            balances.hold(base, remaining)
+    if execute_limit_sell(ledger, pair, buy_price, volume, client, take_profit_percentage) and balances is not None:
+        balances.hold(base, volume)
+
+def execute_limit_sell(ledger, pair, buy_price, volume, client=None, take_profit_percentage=None):
+    client = client or kraken
+    if take_profit_percentage is None:
+        take_profit_percentage = TAKE_PROFIT_PERCENTAGE
+    limit_price = buy_price * (1 + take_profit_percentage)
     try:
-        order = kraken.create_limit_sell_order(pair, volume, limit_price)
-        log_trade(conn, pair.replace('/', '-'), pair, 'sell', buy_price, volume, limit_order=1, limit_price=limit_price)
-        print(f"Limit sell order placed for {volume} of {pair} at price {limit_price}")
-        return order
-    except Exception as e:
-        print(f"Exception while placing limit sell order: {str(e)}")
+        with metrics.timer('order_placement'):
+            order = client.create_limit_sell_order(pair, volume, limit_price)
+    except ccxt.BaseError as e:
+        logger.error(f"Exception while placing limit sell order for {pair}: {type(e).__name__}: {str(e)}")
+        metrics.count('orders_failed_total', side='sell', type='limit')
         return None
-
-
-def update_trailing_stop(conn, order_id, new_stop_price, new_step):
-    cursor = conn.cursor()
-    cursor.execute("""
-    UPDATE trade_history
-    SET trailing_stop_price = ?, current_step = ?
-    WHERE id = ?
-    """, (new_stop_price, new_step, order_id))
-    conn.commit()
-
-def check_and_update_trailing_stop(conn, ticker, current_price):
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT id, price, trailing_stop_price, current_step, limit_price
-    FROM trade_history
-    WHERE ticker = ? AND limit_order = 1 AND filled = 0
-    """, (ticker,))
-    open_orders = cursor.fetchall()
-
-    for order_id, buy_price, trailing_stop_price, current_step, limit_price in open_orders:
-        price_increase = (current_price - buy_price) / buy_price
-        num_steps = int(price_increase / TRAILING_STOP_STEP)
-
-        if num_steps > current_step and num_steps < 6:  # 6 steps to reach 30%
-            new_stop_price = buy_price * (1 + (num_steps * TRAILING_STOP_STEP))
-            update_trailing_stop(conn, order_id, new_stop_price, num_steps)
-            print(f"Updated trailing stop for {ticker} order {order_id} to {new_stop_price} (Step {num_steps})")
-
-def check_order_fill(conn, ticker, current_price):
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT id, limit_price, trailing_stop_price, current_step
-    FROM trade_history
-    WHERE ticker = ? AND limit_order = 1 AND filled = 0
-    """, (ticker,))
-    open_orders = cursor.fetchall()
-
-    for order_id, limit_price, trailing_stop_price, current_step in open_orders:
-        if current_price >= limit_price:
-            fill_order(conn, order_id, current_price, "limit price")
-        elif trailing_stop_price and current_step > 0 and current_price <= trailing_stop_price:
-            fill_order(conn, order_id, current_price, f"trailing stop (Step {current_step})")
-
-def fill_order(conn, order_id, fill_price, fill_type):
-    cursor = conn.cursor()
-    filled_timestamp = datetime.now().isoformat()
-    cursor.execute("""
-    UPDATE trade_history
-    SET filled = 1, filled_at = ?, filled_timestamp = ?
-    WHERE id = ?
-    """, (fill_price, filled_timestamp, order_id))
-    conn.commit()
-    print(f"Order {order_id} filled at {fill_price} due to {fill_type}.")
-
-def fetch_and_process_data(ticker, start_date, end_date):
-    data = yf.download(ticker, start=start_date, end=end_date, interval='1d')
+    metrics.count('orders_placed_total', side='sell', type='limit')
+    ledger.log_trade(pair.replace('/', '-'), pair, 'sell', buy_price, volume, limit_order=1, limit_price=limit_price,
+                     exchange_order_id=order['id'])
+    logger.info(f"Limit sell order {order['id']} placed for {volume} of {pair} at price {limit_price}")
+    return order
+
+
+def update_stops(ledger, ticker, current_price):
+    # Moves the ticker's trailing stops in the ledger. Only the orders the price steps up
+    # or crosses are touched; returns them for apply_stop_events.
+    stepped, triggered = ledger.update_stops(ticker, current_price)
+    for order in stepped:
+        metrics.count('trailing_stop_updates_total')
+        logger.info(f"Updated trailing stop for {ticker} order {order['id']} to {order['trailing_stop_price']} "
+                    f"(Step {order['current_step']})")
+    return stepped, triggered
+
+def apply_stop_events(ledger, stepped, triggered, current_price, client=None):
+    # The exchange side of update_stops: with EXCHANGE_STOPS moved stops are placed on
+    # the exchange, and crossed stops or take-profits are closed
+    if EXCHANGE_STOPS:
+        for order in stepped:
+            place_exchange_stop(ledger, order, client)
+    for order, reason in triggered:
+        close_order(ledger, order, current_price, reason, client)
+
+def place_exchange_stop(ledger, order, client=None):
+    # Rests the order's trailing stop on the exchange as a stop-loss sell: the take-profit
+    # limit order is swapped for it on the first step (its limit price is then watched
+    # locally) and the stop-loss is amended on later ones. Orders without an exchange
+    # order keep their stop local.
+    if order['exchange_order_id'] is None:
+        return
+    client = client or kraken
+    pair = order['ticker'].replace('-', '/')
+    with stop_lock:
+        if not ledger.is_open(order):
+            return
+        volume = order['volume'] - (order['filled_volume'] or 0)
+        stop_price = order['trailing_stop_price']
+        if order['exchange_order_type'] == 'stop-loss':
+            try:
+                with metrics.timer('order_placement'):
+                    placed = client.amend_stop_loss_order(order['exchange_order_id'], pair, volume, stop_price)
+            except ccxt.BaseError as e:
+                # The old stop stays in place; if it filled, reconciliation records it
+                logger.warning(f"Could not amend stop-loss order {order['exchange_order_id']}: {type(e).__name__}: {str(e)}")
+                metrics.count('orders_failed_total', side='sell', type='stop-loss')
+                return
+        else:
+            try:
+                with metrics.timer('order_placement'):
+                    client.cancel_order(order['exchange_order_id'])
+            except ccxt.BaseError as e:
+                logger.warning(f"Could not cancel take-profit order {order['exchange_order_id']}: {type(e).__name__}: {str(e)}")
+                return
+            metrics.count('orders_canceled_total', type='limit')
+            try:
+                with metrics.timer('order_placement'):
+                    placed = client.create_stop_loss_order(pair, volume, stop_price)
+            except ccxt.BaseError as e:
+                logger.error(f"Exception while placing stop-loss order for {pair}: {type(e).__name__}: {str(e)}")
+                metrics.count('orders_failed_total', side='sell', type='stop-loss')
+                restore_take_profit(ledger, order, pair, volume, client)
+                return
+        metrics.count('orders_placed_total', side='sell', type='stop-loss')
+        ledger.replace_exchange_order(order, placed['id'], 'stop-loss')
+        logger.info(f"Stop-loss order {placed['id']} for {volume} of {pair} at {stop_price} (order {order['id']})")
+
+def restore_take_profit(ledger, order, pair, volume, client):
+    # The take-profit was canceled but what was to replace it (a stop-loss, or a combined
+    # take-profit) could not be placed: put the limit order back, or else keep both the
+    # stop and the limit price local
+    try:
+        with metrics.timer('order_placement'):
+            placed = client.create_limit_sell_order(pair, volume, order['limit_price'])
+    except ccxt.BaseError as e:
+        logger.error(f"Could not restore take-profit order for {pair}, watching it locally: {type(e).__name__}: {str(e)}")
+        metrics.count('orders_failed_total', side='sell', type='limit')
+        ledger.replace_exchange_order(order, None, 'local')
+        return
+    metrics.count('orders_placed_total', side='sell', type='limit')
+    ledger.replace_exchange_order(order, placed['id'], 'limit')
+
+def close_order(ledger, order, current_price, reason, client=None):
+    # Sells what is left of an order whose stop or take-profit the price crossed. Orders
+    # that never rested on the exchange are only recorded as filled, and stop-loss
+    # orders triggered at their stop fill on the exchange, for reconciliation to record.
+    # Otherwise the exchange order is canceled, if there is one ('local' orders lost it
+    # when it could not be restored), and the rest sold at market. The take-profit row
+    # keeps the volume it filled as a limit order and the market sell gets its own row,
+    # so each part of the sale is recorded at its own price.
+    fill_type = "limit price" if reason == 'limit' else f"trailing stop (Step {order['current_step']})"
+    if order['exchange_order_id'] is None and order['exchange_order_type'] != 'local':
+        fill_order(ledger, order, current_price, fill_type)
+        return
+    if reason == 'stop' and order['exchange_order_type'] == 'stop-loss':
+        logger.info(f"Stop-loss order {order['exchange_order_id']} of order {order['id']} triggered at {current_price}")
+        return
+    client = client or kraken
+    pair = order['ticker'].replace('-', '/')
+    with stop_lock:
+        if not ledger.is_open(order):
+            return
+        if order['exchange_order_id'] is not None:
+            try:
+                with metrics.timer('order_placement'):
+                    client.cancel_order(order['exchange_order_id'])
+            except ccxt.OrderNotFound as e:
+                # Filled or canceled meanwhile; reconciliation records which
+                logger.warning(f"Could not cancel order {order['exchange_order_id']}: {type(e).__name__}: {str(e)}")
+                return
+            except ccxt.BaseError as e:
+                logger.warning(f"Could not cancel order {order['exchange_order_id']}, retrying on the next price: "
+                               f"{type(e).__name__}: {str(e)}")
+                ledger.watch(order)
+                return
+            metrics.count('orders_canceled_total', type=order['exchange_order_type'] or 'limit')
+        volume = order['volume'] - (order['filled_volume'] or 0)
+        try:
+            with metrics.timer('order_placement'):
+                sold = client.create_market_order(pair, 'sell', volume)
+        except ccxt.BaseError as e:
+            logger.error(f"Exception while selling {volume} of {pair} for order {order['id']}, the position is left "
+                         f"without a take-profit: {type(e).__name__}: {str(e)}")
+            metrics.count('orders_failed_total', side='sell', type='market')
+            ledger.apply_exchange_order(order, 'canceled', order['filled_volume'], None)
+            return
+        metrics.count('orders_placed_total', side='sell', type='market')
+        try:
+            fill_price = client.fill_price(sold)
+        except ccxt.BaseError as e:
+            logger.warning(f"Could not query order {sold['id']}: {type(e).__name__}: {str(e)}")
+            fill_price = None
+        ledger.apply_exchange_order(order, 'canceled', order['filled_volume'], None)
+        ledger.log_trade(order['ticker'], pair, 'sell', fill_price or current_price, volume)
+        metrics.count('orders_filled_total', reason=fill_type.split(' (')[0])
+        logger.info(f"Order {order['id']} closed due to {fill_type}: sold {volume} at {fill_price or current_price}.")
+
+def fill_order(ledger, order, fill_price, fill_type):
+    if ledger.fill_order(order, fill_price):
+        metrics.count('orders_filled_total', reason=fill_type.split(' (')[0])
+        logger.info(f"Order {order['id']} filled at {fill_price} due to {fill_type}.")
+
+def manage_open_orders(ledger, ticker, current_price, client=None):
+    stepped, triggered = update_stops(ledger, ticker, current_price)
+    if stepped or triggered:
+        apply_stop_events(ledger, stepped, triggered, current_price, client)
+
+def download_yahoo(ticker, start, end, interval='1d'):
+    # Raw bars of [start, end) from Yahoo Finance, indexed by naive UTC bar start
+    with metrics.timer('download'):
+        data = yf.download(ticker, start=start.replace(tzinfo=timezone.utc), end=end.replace(tzinfo=timezone.utc),
+                           interval=interval, threads=False, progress=False)
+    metrics.count('bars_downloaded_total', len(data), interval=interval)
     if data.empty:
-        print(f"No data available for {ticker}")
-        return pd.DataFrame()
-
+        return empty_bars()
     df = data.rename(columns={'Open': 'open', 'High': 'high', 'Low': 'low', 'Close': 'close', 'Volume': 'volume'})
+    if df.index.tz is not None:
+        df.index = df.index.tz_convert('UTC').tz_localize(None)
+    return df[BAR_COLUMNS]
+
+def gap_source(cache=None, pairs=None):
+    # pairs: ticker -> Kraken pair of the tickers being downloaded, KRAKEN_PAIRS by default
+    if not FILL_GAPS:
+        return None
+    source = KrakenOHLC(kraken, KRAKEN_PAIRS if pairs is None else pairs)
+    return CachedSource(cache, 'kraken', source) if cache is not None else source
+
+def download_data(ticker, start, end, interval='1d', expected_start=None, pairs=None):
+    # start and end are naive UTC datetimes; end is exclusive. Downloads go through the
+    # bar cache when BAR_CACHE_PATH is set, then through the data-quality stage: bars are
+    # expected from expected_start on (from the first downloaded bar by default), and
+    # the gaps validation finds are filled from Kraken's OHLC endpoint, for the ticker's
+    # pair in `pairs`.
+    if interval in YF_MAX_LOOKBACK_DAYS:
+        start = max(start, end - timedelta(days=YF_MAX_LOOKBACK_DAYS[interval]))
+    cache = BarCache(BAR_CACHE_PATH) if BAR_CACHE_PATH else None
+    if cache is not None:
+        df = cache.fetch('yahoo', ticker, interval, start, end, lambda lo, hi: download_yahoo(ticker, lo, hi, interval))
+    else:
+        df = download_yahoo(ticker, start, end, interval)
+    with metrics.timer('validation'):
+        df, report = validate_bars(ticker, df, interval, expected_start, end, gap_source(cache, pairs))
+    if df.empty:
+        logger.warning(f"No {interval} data available for {ticker}")
+        return pd.DataFrame()
     df['timestamp'] = df.index.strftime('%Y-%m-%d %H:%M:%S')
-    df['rsi'] = ta.rsi(df['close'], length=14)
-    df['ema'] = ta.ema(df['close'], length=20)
-    df['50_MA'] = df['close'].rolling(window=50).mean()
-    df['200_MA'] = df['close'].rolling(window=200).mean()
-    df['ground_truth_trend'] = df.apply(lambda row: 'Bullish' if row['50_MA'] > row['200_MA'] else 'Bearish', axis=1)
-    return df.drop(columns=['50_MA', '200_MA'])
-
-def store_data(conn, ticker, df):
+    return df
+
+def add_indicators(df, state):
+    with metrics.timer('indicators'):
+        rows = [state.update(timestamp, close) for timestamp, close in zip(df['timestamp'], df['close'])]
+    df['rsi'] = [row['rsi'] for row in rows]
+    df['ema'] = [row['ema'] for row in rows]
+    df['ground_truth_trend'] = [row['ground_truth_trend'] for row in rows]
+    for column in SIGNAL_COLUMNS:
+        df[column] = [row[column] for row in rows]
+    return df
+
+def fetch_and_process_data(ticker, start, end, state, interval='1d', pairs=None):
+    df = download_data(ticker, start, end, interval, pairs=pairs)
+    if df.empty:
+        return df
+    return add_indicators(df, state)
+
+def get_last_timestamp(conn, ticker, interval='1d'):
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(timestamp) FROM crypto_data WHERE ticker = ? AND interval = ?", (ticker, interval))
+    return cursor.fetchone()[0]
+
+def load_or_rebuild_state(conn, ticker, interval, last_timestamp):
+    state = load_indicator_state(conn, ticker, interval)
+    if state is None or state.timestamp != last_timestamp:
+        # Databases written before the state table existed are replayed once
+        logger.info(f"Rebuilding {interval} indicator state for {ticker} from stored bars")
+        state = rebuild_indicator_state(conn, ticker, interval)
+    return state
+
+def next_bar_time(timestamp, interval):
+    return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') + timedelta(seconds=INTERVAL_SECONDS[interval])
+
+def fetch_incremental_data(conn, ticker, end, interval='1d', pairs=None):
+    with db_lock:
+        last_timestamp = get_last_timestamp(conn, ticker, interval)
+        if last_timestamp is not None:
+            state = load_or_rebuild_state(conn, ticker, interval, last_timestamp)
+
+    if last_timestamp is None:
+        logger.info(f"No stored {interval} data for {ticker}, downloading full history from {HISTORY_START_DATE}")
+        state = IndicatorState()
+        start = datetime.strptime(HISTORY_START_DATE, '%Y-%m-%d')
+        return fetch_and_process_data(ticker, start, end, state, interval, pairs), state
+
+    start = next_bar_time(last_timestamp, interval)
+    if start >= end:
+        logger.debug(f"{ticker} {interval} is up to date (last stored bar {last_timestamp})")
+        return pd.DataFrame(), state
+
+    df = download_data(ticker, start, end, interval, expected_start=start, pairs=pairs)
+    if df.empty:
+        return df, state
+    df = df[df['timestamp'] > last_timestamp].copy()
+    if df.empty:
+        logger.debug(f"{ticker} {interval} is up to date (last stored bar {last_timestamp})")
+        return df, state
+
+    return add_indicators(df, state), state
+
+def roll_up_data(conn, ticker, interval, base_interval, as_of):
+    # Builds the closed `interval` bars after the last stored one from stored base bars.
+    # Returns None when nothing is stored yet, so the history is backfilled by download.
+    with db_lock:
+        last_timestamp = get_last_timestamp(conn, ticker, interval)
+        if last_timestamp is None:
+            return None
+        state = load_or_rebuild_state(conn, ticker, interval, last_timestamp)
+        start = next_bar_time(last_timestamp, interval).strftime('%Y-%m-%d %H:%M:%S')
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT timestamp, open, high, low, close, volume FROM crypto_data
+        WHERE ticker = ? AND interval = ? AND timestamp >= ?
+        ORDER BY timestamp ASC
+        """, (ticker, base_interval, start))
+        base = pd.DataFrame(cursor.fetchall(), columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
+
+    resampler = BarResampler(interval)
+    df = pd.concat([resampler.update(base), resampler.flush(as_of)])
+    if df.empty:
+        logger.debug(f"{ticker} {interval} is up to date (last stored bar {last_timestamp})")
+        return df, state
+    return add_indicators(df, state), state
+
+def update_interval(conn, ticker, interval, base_interval, as_of, full_refresh=False, pairs=None):
+    # Downloads stop at the start of the bar still open at as_of, so only closed bars are stored
+    end = bucket_start(as_of, interval).to_pydatetime()
+    if full_refresh:
+        state = IndicatorState()
+        start = datetime.strptime(HISTORY_START_DATE, '%Y-%m-%d')
+        return fetch_and_process_data(ticker, start, end, state, interval, pairs), state
+    if interval != base_interval:
+        rolled = roll_up_data(conn, ticker, interval, base_interval, as_of)
+        if rolled is not None:
+            return rolled
+    return fetch_incremental_data(conn, ticker, end, interval, pairs)
+
+def store_data(conn, ticker, df, state=None, interval='1d'):
     df['ticker'] = ticker
+    df['interval'] = interval
     
-    data = df[['ticker', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'rsi', 'ema', 'ground_truth_trend']]
+    data = df[['ticker', 'interval', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'rsi', 'ema', 'ground_truth_trend']
+              + SIGNAL_COLUMNS]
     
     records = data.to_records(index=False)
     
     upsert_query = """
     INSERT OR REPLACE INTO crypto_data 
-    (ticker, timestamp, open, high, low, close, volume, rsi, ema, ground_truth_trend)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    (ticker, interval, timestamp, open, high, low, close, volume, rsi, ema, ground_truth_trend,
+     signal_fast_ema, signal_slow_ema, signal)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
     
-    cursor = conn.cursor()
-    try:
-        cursor.executemany(upsert_query, records)
-        conn.commit()
-        print(f"Successfully stored/updated {len(records)} records for {ticker}")
-    except sqlite3.Error as e:
-        print(f"An error occurred while storing data for {ticker}: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-
-def trade_based_on_trend(conn, ticker, pair):
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT close, timestamp FROM crypto_data
-    WHERE ticker = ?
-    ORDER BY timestamp DESC
-    LIMIT 200
-    """, (ticker,))
-    rows = cursor.fetchall()
-    
-    if len(rows) < 200:
-        print(f"Not enough data to trade for {ticker}")
+    with metrics.timer('db_write'):
+        with db_lock:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(upsert_query, records)
+                if state is not None:
+                    save_indicator_state(conn, ticker, state, interval)
+                conn.commit()
+                logger.info(f"Successfully stored/updated {len(records)} {interval} records for {ticker}")
+            except sqlite3.Error as e:
+                logger.error(f"An error occurred while storing data for {ticker}: {e}")
+                conn.rollback()
+                return
+            finally:
+                cursor.close()
+
+            if BAR_STORE_PATH:
+                bar_store = BarStore(BAR_STORE_PATH)
+                last = bar_store.last_timestamp(ticker, interval)
+                # Replaced rows (a full refresh) cannot be appended, so the series is rewritten
+                rebuild = last is not None and pd.Timestamp(df['timestamp'].iloc[0]) <= last
+                bar_store.sync(conn, ticker, interval, rebuild=rebuild)
+
+def read_signal(conn, ticker, interval=TRADE_INTERVAL):
+    # (timestamp, close, trend) of the newest bar, or None before the signal has warmed up
+    with metrics.timer('signal'):
+        # The signal of the newest bar was computed and stored when the bar was ingested
+        with db_lock:
+            latest = latest_signal(conn, ticker, interval)
+    if latest is None or latest[2] is None:
+        logger.warning(f"Not enough data to trade for {ticker}")
+        return None
+    metrics.count('signals_total', ticker=ticker, trend=latest[2])
+    return latest
+
+def latest_closes(conn, tickers, interval=TRADE_INTERVAL):
+    # Newest stored close of every ticker that has one
+    closes = {}
+    with db_lock:
+        for ticker in tickers:
+            latest = latest_signal(conn, ticker, interval)
+            if latest is not None:
+                closes[ticker] = latest[1]
+    return closes
+
+def mark_holdings(engine, pairs, closes):
+    # Values every configured pair (ticker -> pair) at its newest close, including the
+    # ones without a new bar this run, so equity is the same whichever tickers signalled
+    for ticker, pair in pairs.items():
+        if ticker in closes:
+            engine.mark(pair, closes[ticker])
+
+def risk_engine(client=None, min_trade_volume=None, sizing=None):
+    # The run's RiskEngine over the account's balances: one fetch_balance per run
+    balances = AccountBalances(client or kraken).load()
+    return RiskEngine(balances, min_trade_volume or MIN_TRADE_VOLUME, sizing or SIZING)
+
+def trade_based_on_trend(conn, ledger, ticker, pair, interval=TRADE_INTERVAL, engine=None):
+    # Queues the newest bar's signal on the run's risk engine, which places the orders of
+    # every ticker together (execute_plan). Without an engine the ticker trades alone.
+    signal = read_signal(conn, ticker, interval)
+    if signal is None:
         return
-
-    # Convert to DataFrame for easier manipulation
-    df = pd.DataFrame(rows, columns=['close', 'timestamp'])
-    df = df.sort_values('timestamp')
-    df['close'] = df['close'].astype(float)
-    
-    # Calculate 50 and 200 day EMAs
-    df['50_EMA'] = df['close'].ewm(span=50, adjust=False).mean()
-    df['200_EMA'] = df['close'].ewm(span=200, adjust=False).mean()
-    
-    current_price = df['close'].iloc[-1]
-    current_timestamp = df['timestamp'].iloc[-1]
-    current_50_ema = df['50_EMA'].iloc[-1]
-    current_200_ema = df['200_EMA'].iloc[-1]
-    
-    # Determine current trend
-    current_trend = 'Bullish' if current_50_ema > current_200_ema else 'Bearish'
-    
-    volume = MIN_TRADE_VOLUME[pair]
-
-    print(f"Trading {ticker} on pair {pair} with volume {volume} at current price {current_price}")
-    print(f"Current timestamp: {current_timestamp}")
-    print(f"Current trend: {current_trend}")
-
-    # Always attempt to execute a trade based on the current trend
-    if current_trend == 'Bullish':
-        print(f"Bullish trend detected for {ticker}. Attempting buy order.")
-        buy_order = execute_trade(conn, pair, 'buy', volume)
-        if buy_order:
-            print(f"Buy order placed for {ticker}. Monitoring price for trailing stop placement.")
-    elif current_trend == 'Bearish':
-        print(f"Bearish trend detected for {ticker}. Attempting sell order.")
-        execute_trade(conn, pair, 'sell', volume)
-
-    # Check for existing buy trades and update trailing stops
-    cursor.execute("""
-    SELECT id, price FROM trade_history
-    WHERE ticker = ? AND trade_type = 'buy'
-    ORDER BY timestamp DESC
-    LIMIT 1
-    """, (ticker,))
-    buy_trade = cursor.fetchone()
-
-    if buy_trade:
-        buy_price = buy_trade[1]
-        price_increase = (current_price - buy_price) / buy_price
-
-        print(f"Buy price: {buy_price}, Current price: {current_price}, Price increase: {price_increase:.2%}")
-
-        if price_increase >= 0.06:
-            check_and_update_trailing_stop(conn, ticker, current_price)
-        else:
-            print(f"Current price has not increased by 6% from the buy price for {ticker}. No trailing stop order placed.")
-    
-    check_order_fill(conn, ticker, current_price)
-
-    
-def main():
-    print(f"Using database at: {DB_PATH}")
-    conn = sqlite3.connect(DB_PATH)
-    print("Database connection established.")
+    with db_lock:
+        volatility = realized_volatility(conn, ticker, interval)
+    if engine is not None:
+        queue_signal(ledger, engine, ticker, pair, signal, volatility)
+        return
+    engine = risk_engine()
+    mark_holdings(engine, {ticker: KRAKEN_PAIRS[ticker] for ticker in TICKERS}, latest_closes(conn, TICKERS, interval))
+    queue_signal(ledger, engine, ticker, pair, signal, volatility)
+    execute_plan(ledger, engine)
+
+def queue_signal(ledger, engine, ticker, pair, signal, volatility=None, client=None):
+    current_timestamp, current_price, current_trend = signal
+    logger.info(f"{current_trend} trend for {ticker} ({pair}) at {current_price}")
+    logger.debug(f"Current bar: {current_timestamp}, volatility: {volatility}")
+    # Stops of the orders already open are checked before new orders are sized
+    manage_open_orders(ledger, ticker, current_price, client)
+    engine.add_signal(ticker, pair, signal, volatility)
+
+def execute_plan(ledger, engine, client=None, take_profit_percentage=None):
+    # Places the engine's netted orders, at most one per pair; returns how many were
+    # placed. The account's balances stay locked so no other portfolio sizes against
+    # cash these orders are about to spend.
+    placed = 0
+    with engine.balances.lock:
+        for order in engine.plan():
+            logger.info(f"Placing {order.side} order for {order.volume} of {order.pair} ({order.ticker}) near {order.price}")
+            if execute_trade(ledger, order.pair, order.side, order.volume, client, take_profit_percentage, engine.balances):
+                placed += 1
+    return placed
+
+def update_market_data(conn, ticker, as_of, full_refresh=False, base_interval=BASE_INTERVAL,
+                       rollup_intervals=ROLLUP_INTERVALS, trade_interval=TRADE_INTERVAL, pairs=None):
+    # Downloads or rolls up and stores the closed bars of every interval; returns how
+    # many new trade-interval bars were stored. pairs maps tickers to the Kraken pairs
+    # that fill their gaps (KRAKEN_PAIRS by default).
+    new_trade_bars = 0
+    for interval in [base_interval] + list(rollup_intervals):
+        df, state = update_interval(conn, ticker, interval, base_interval, as_of, full_refresh, pairs)
+        logger.debug(f"Fetched {interval} data for {ticker}, data size: {len(df)}")
+        if df.empty:
+            continue
+        store_data(conn, ticker, df, state, interval)
+        logger.debug(f"Stored {interval} data for {ticker}")
+        if interval == trade_interval:
+            new_trade_bars = len(df)
+    return new_trade_bars
+
+def process_ticker(conn, ledger, ticker, as_of, full_refresh=False, base_interval=BASE_INTERVAL,
+                   rollup_intervals=ROLLUP_INTERVALS, trade_interval=TRADE_INTERVAL, engine=None):
+    logger.debug(f"Processing {ticker}")
+    new_trade_bars = update_market_data(conn, ticker, as_of, full_refresh, base_interval, rollup_intervals, trade_interval)
+
+    # Decide once per closed trade-interval bar, however often the bot runs
+    if not new_trade_bars:
+        logger.info(f"No new {trade_interval} bar for {ticker}, skipping trading logic")
+        return
+    if engine is None:
+        logger.warning(f"No account balances, not trading {ticker}")
+        return
+    trade_based_on_trend(conn, ledger, ticker, KRAKEN_PAIRS[ticker], trade_interval, engine)
+    logger.debug(f"Queued the signal of {ticker}")
+
+def main(full_refresh=False, base_interval=BASE_INTERVAL, rollup_intervals=ROLLUP_INTERVALS, trade_interval=TRADE_INTERVAL,
+         metrics_file=None):
+    logger.info(f"Using database at: {DB_PATH}")
+    conn = connect_db(DB_PATH)
+    if metrics_file:
+        # SQLite expands every statement for the trace callback, which costs about a
+        # quarter of a bulk insert, so statements are only counted when metrics are kept
+        conn.set_trace_callback(metrics.count_sql)
+    logger.debug("Database connection established.")
     create_tables(conn)
-    print("Tables checked/created.")
-    
-    start_date = '2020-01-01'
-    end_date = datetime.now().strftime('%Y-%m-%d')  # Fetch up to and including the current date
-    print(f"Start date: {start_date}, End date: {end_date}")
-
-    for ticker in TICKERS:
-        print(f"Processing {ticker}")
-        df = fetch_and_process_data(ticker, start_date, end_date)
-        print(f"Fetched data for {ticker}, data size: {len(df)}")
-        if not df.empty:
-            store_data(conn, ticker, df)
-            print(f"Stored data for {ticker}")
-            trade_based_on_trend(conn, ticker, KRAKEN_PAIRS[ticker])
-            print(f"Completed trading logic for {ticker}")
-        else:
-            print(f"No data to store for {ticker}")
+    logger.debug("Tables checked/created.")
+    ledger = TradeLedger(conn).load()
+    logger.info(f"Loaded {sum(len(orders) for orders in ledger.open_orders.values())} open limit orders.")
+    try:
+        # Fills that happened on the exchange since the last run, before any new decisions
+        with metrics.timer('reconciliation'):
+            updated = reconcile_orders(ledger, kraken)
+        logger.info(f"Reconciled open orders with the exchange ({updated} updated).")
+    except ccxt.BaseError as e:
+        logger.warning(f"Could not reconcile orders with the exchange: {type(e).__name__}: {str(e)}")
+    try:
+        # Balances are fetched once; the engine sizes and nets every order of the run
+        engine = risk_engine()
+    except ccxt.BaseError as e:
+        logger.error(f"Could not fetch account balances, not trading this run: {type(e).__name__}: {str(e)}")
+        engine = None
+
+    as_of = datetime.now(timezone.utc).replace(tzinfo=None)
+    intervals = ', '.join([base_interval] + list(rollup_intervals))
+    if full_refresh:
+        logger.info(f"Full refresh of {intervals} bars from {HISTORY_START_DATE} to {as_of} UTC")
+    else:
+        logger.info(f"Incremental update of {intervals} bars up to {as_of} UTC, trading on {trade_interval}")
 
-    conn.close()
-    print("Database connection closed.")
-    print("Done.")
+    try:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(TICKERS))) as executor:
+            futures = {executor.submit(process_ticker, conn, ledger, ticker, as_of, full_refresh, base_interval,
+                                       rollup_intervals, trade_interval, engine): ticker for ticker in TICKERS}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Error while processing {futures[future]}: {str(e)}")
+        if engine is not None:
+            mark_holdings(engine, {ticker: KRAKEN_PAIRS[ticker] for ticker in TICKERS},
+                          latest_closes(conn, TICKERS, trade_interval))
+            placed = execute_plan(ledger, engine)
+            logger.info(f"Placed {placed} orders.")
+    finally:
+        # Orders already placed on the exchange must be recorded even if a worker failed
+        written = ledger.flush()
+        logger.info(f"Trade history updated ({written} rows in one transaction).")
+        logger.info(f"Exchange API calls: {dict(kraken.calls)}")
+        if metrics_file:
+            metrics.write(metrics_file)
+            logger.info(f"Metrics written to {metrics_file}")
 
+    conn.close()
+    logger.debug("Database connection closed.")
+    logger.debug("Done.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Daily momentum trading bot for Kraken")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help=f"re-download and recompute the full history since {HISTORY_START_DATE}")
+    parser.add_argument('--base-interval', choices=sorted(INTERVAL_SECONDS), default=BASE_INTERVAL,
+                        help="bar interval downloaded from Yahoo Finance")
+    parser.add_argument('--rollup', nargs='*', choices=sorted(INTERVAL_SECONDS), default=ROLLUP_INTERVALS,
+                        help="higher intervals resampled from the base bars")
+    parser.add_argument('--trade-interval', choices=sorted(INTERVAL_SECONDS), default=TRADE_INTERVAL,
+                        help="interval whose bars drive the trading decision")
+    parser.add_argument('--bar-store', default=BAR_STORE_PATH,
+                        help="also append stored bars to the columnar bar store in this directory")
+    parser.add_argument('--bar-cache', default=BAR_CACHE_PATH,
+                        help="cache raw downloads in this directory, so unchanged history is never downloaded again")
+    parser.add_argument('--no-fill-gaps', dest='fill_gaps', action='store_false', default=FILL_GAPS,
+                        help="leave missing bars missing instead of filling them from Kraken's OHLC endpoint")
+    parser.add_argument('--sizing', choices=SIZING_MODES, default=SIZING,
+                        help="order sizing: fixed MIN_TRADE_VOLUME, volatility-scaled or a target weight of equity")
+    parser.add_argument('--exchange-stops', action='store_true', default=EXCHANGE_STOPS,
+                        help="place trailing stops on the exchange as stop-loss orders")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics-file',
+                        help="write run metrics here: Prometheus text format for *.prom, otherwise one JSON line per run")
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], help="profile the whole run")
+    parser.add_argument('--profile-output', help="profile report path (cProfile stats or pyinstrument text/html)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    BAR_STORE_PATH = args.bar_store
+    BAR_CACHE_PATH = args.bar_cache
+    FILL_GAPS = args.fill_gaps
+    SIZING = args.sizing
+    EXCHANGE_STOPS = args.exchange_stops
+    if args.trade_interval not in [args.base_interval] + args.rollup:
+        parser.error("--trade-interval must be the base interval or one of the --rollup intervals")
+    if any(INTERVAL_SECONDS[interval] <= INTERVAL_SECONDS[args.base_interval] for interval in args.rollup):
+        parser.error("--rollup intervals must be longer than the base interval")
+    with profiled(args.profile, args.profile_output):
+        main(full_refresh=args.full_refresh, base_interval=args.base_interval, rollup_intervals=args.rollup,
+             trade_interval=args.trade_interval, metrics_file=args.metrics_file)
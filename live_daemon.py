@@ -0,0 +1,196 @@
+import logging
+import asyncio
+import argparse
+import time
+from datetime import datetime, timezone
+import ccxt
+import kraken_daily_momentum as bot
+from reconcile import reconcile_orders
+from trade_ledger import TradeLedger
+from resample import INTERVAL_SECONDS, bucket_start
+from price_feed import KrakenTickerFeed, ReplayFeed
+from metrics import metrics, configure_logging
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 1.0  # how often order changes made on ticks are written to trade_history
+RECONCILE_SECONDS = 60.0  # how often exchange fills of open limit orders are picked up
+
+
+# Long-running alternative to the cron job. Trailing stops and take-profit fills are
+# checked against every tick of the feed in the ledger's stop book, touching only the
+# orders the tick steps up or triggers; the exchange calls this leads to run in worker
+# threads so the feed is never blocked on them.
+# The trend signal is recomputed only when a trade-interval bar closes: the regular
+# per-ticker pipeline (download, indicators, trading) then runs in worker threads while
+# ticks keep being handled, after open orders are reconciled with the exchange and the
+# account balances fetched; the orders of all tickers are then sized and placed together
+# by the bar's risk engine. Bar closes follow the feed's clock, so replays behave like
+# the live feed.
+class LiveDaemon:
+    def __init__(self, conn, ledger, feed, base_interval=bot.BASE_INTERVAL, rollup_intervals=bot.ROLLUP_INTERVALS,
+                 trade_interval=bot.TRADE_INTERVAL, on_bar_close=None, flush_seconds=FLUSH_SECONDS,
+                 reconcile_seconds=RECONCILE_SECONDS, metrics_file=None):
+        # on_bar_close(ticker, as_of) replaces the default pipeline, e.g. in simulations
+        self.conn = conn
+        self.ledger = ledger
+        self.feed = feed
+        self.base_interval = base_interval
+        self.rollup_intervals = rollup_intervals
+        self.trade_interval = trade_interval
+        self.on_bar_close = on_bar_close or self.process_ticker
+        self.flush_seconds = flush_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self.metrics_file = metrics_file
+        self.tickers = {pair: ticker for ticker, pair in bot.KRAKEN_PAIRS.items() if ticker in bot.TICKERS}
+        self.current_bar = None
+        self.engine = None
+        self.bar_tasks = set()
+        self.stop_tasks = set()
+        self.bar_lock = None
+        self.ticks_handled = 0
+        self.tick_seconds = 0.0
+
+    def process_ticker(self, ticker, as_of):
+        bot.process_ticker(self.conn, self.ledger, ticker, as_of, False, self.base_interval,
+                           self.rollup_intervals, self.trade_interval, self.engine)
+
+    def on_tick(self, tick):
+        ticker = self.tickers.get(tick.pair)
+        if ticker is None:
+            return
+        started = time.perf_counter()
+        stepped, triggered = bot.update_stops(self.ledger, ticker, tick.price)
+        if stepped or triggered:
+            task = asyncio.create_task(asyncio.to_thread(bot.apply_stop_events, self.ledger, stepped, triggered, tick.price))
+            self.stop_tasks.add(task)
+            task.add_done_callback(self.stop_tasks.discard)
+        self.tick_seconds += time.perf_counter() - started
+        self.ticks_handled += 1
+
+    async def close_bar(self, as_of):
+        # Bar closes run one after another, in order, even if the previous one is slow
+        async with self.bar_lock:
+            logger.info(f"{self.trade_interval} bar closed, updating signals as of {as_of}")
+            await self.reconcile()
+            self.engine = await self.load_engine()
+            results = await asyncio.gather(*(asyncio.to_thread(self.on_bar_close, ticker, as_of)
+                                             for ticker in self.tickers.values()), return_exceptions=True)
+            for ticker, result in zip(self.tickers.values(), results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error while processing {ticker}: {str(result)}")
+            if self.engine is not None:
+                closes = await asyncio.to_thread(bot.latest_closes, self.conn, self.tickers.values(), self.trade_interval)
+                bot.mark_holdings(self.engine, {ticker: pair for pair, ticker in self.tickers.items()}, closes)
+                await asyncio.to_thread(bot.execute_plan, self.ledger, self.engine)
+        await asyncio.to_thread(self.flush)
+        self.write_metrics()
+
+    async def reconcile(self):
+        try:
+            with metrics.timer('reconciliation'):
+                await asyncio.to_thread(reconcile_orders, self.ledger, bot.kraken)
+        except ccxt.BaseError as e:
+            logger.warning(f"Could not reconcile orders with the exchange: {type(e).__name__}: {str(e)}")
+
+    async def load_engine(self):
+        # One fetch_balance per bar close
+        try:
+            return await asyncio.to_thread(bot.risk_engine)
+        except ccxt.BaseError as e:
+            logger.error(f"Could not fetch account balances, not trading this bar: {type(e).__name__}: {str(e)}")
+            return None
+
+    async def reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(self.reconcile_seconds)
+            async with self.bar_lock:
+                await self.reconcile()
+
+    def flush(self):
+        # store_data commits on the same connection from worker threads
+        with bot.db_lock:
+            return self.ledger.flush()
+
+    def write_metrics(self):
+        if self.metrics_file:
+            # Ticks are counted on the daemon itself; the registry lock is too slow for the tick path
+            metrics.set('ticks_total', self.ticks_handled)
+            metrics.set('tick_seconds_total', self.tick_seconds)
+            metrics.write(self.metrics_file)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            # The commit blocks on db_lock and disk; keep it off the tick loop
+            await asyncio.to_thread(self.flush)
+
+    async def run(self):
+        self.bar_lock = asyncio.Lock()
+        background = [asyncio.create_task(self.flush_periodically()), asyncio.create_task(self.reconcile_periodically())]
+        try:
+            async for tick in self.feed.ticks():
+                bar = bucket_start(tick.timestamp, self.trade_interval)
+                # The first tick catches up on bars closed while the daemon was down
+                if self.current_bar is None or bar > self.current_bar:
+                    self.current_bar = bar
+                    task = asyncio.create_task(self.close_bar(tick.timestamp))
+                    self.bar_tasks.add(task)
+                    task.add_done_callback(self.bar_tasks.discard)
+                self.on_tick(tick)
+            if self.bar_tasks or self.stop_tasks:
+                await asyncio.gather(*self.bar_tasks, *self.stop_tasks)
+        finally:
+            for task in background:
+                task.cancel()
+            written = self.flush()
+            self.write_metrics()
+            if self.ticks_handled:
+                logger.info(f"Handled {self.ticks_handled} ticks, {self.tick_seconds / self.ticks_handled * 1e6:.1f} us per tick; "
+                            f"{written} trade_history rows written on shutdown")
+
+
+def main(feed, base_interval=bot.BASE_INTERVAL, rollup_intervals=bot.ROLLUP_INTERVALS, trade_interval=bot.TRADE_INTERVAL,
+         metrics_file=None):
+    logger.info(f"Using database at: {bot.DB_PATH}")
+    conn = bot.connect_db(bot.DB_PATH)
+    if metrics_file:
+        conn.set_trace_callback(metrics.count_sql)
+    bot.create_tables(conn)
+    ledger = TradeLedger(conn).load()
+    logger.info(f"Loaded {sum(len(orders) for orders in ledger.open_orders.values())} open limit orders.")
+    logger.info(f"Live daemon started at {datetime.now(timezone.utc).replace(tzinfo=None)} UTC, trading on {trade_interval} bars")
+
+    daemon = LiveDaemon(conn, ledger, feed, base_interval, rollup_intervals, trade_interval, metrics_file=metrics_file)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        logger.info("Live daemon stopped.")
+    finally:
+        conn.close()
+        logger.debug("Database connection closed.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the momentum bot as a long-running daemon on a streaming price feed")
+    parser.add_argument('--feed', choices=['kraken', 'replay'], default='kraken')
+    parser.add_argument('--replay-file', help="CSV of timestamp,pair,price ticks for --feed replay")
+    parser.add_argument('--replay-speed', type=float, default=0,
+                        help="replay speed relative to real time; 0 replays as fast as possible")
+    parser.add_argument('--base-interval', choices=sorted(INTERVAL_SECONDS), default=bot.BASE_INTERVAL)
+    parser.add_argument('--rollup', nargs='*', choices=sorted(INTERVAL_SECONDS), default=bot.ROLLUP_INTERVALS)
+    parser.add_argument('--trade-interval', choices=sorted(INTERVAL_SECONDS), default=bot.TRADE_INTERVAL)
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics-file', help="metrics written after every bar close: *.prom or JSON lines")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    if args.trade_interval not in [args.base_interval] + args.rollup:
+        parser.error("--trade-interval must be the base interval or one of the --rollup intervals")
+
+    if args.feed == 'replay':
+        if not args.replay_file:
+            parser.error("--feed replay needs --replay-file")
+        feed = ReplayFeed.from_csv(args.replay_file, args.replay_speed)
+    else:
+        feed = KrakenTickerFeed([bot.KRAKEN_PAIRS[ticker] for ticker in bot.TICKERS])
+    main(feed, args.base_interval, args.rollup, args.trade_interval, args.metrics_file)
@@ -0,0 +1,170 @@
+import os
+import io
+import json
+import time
+import logging
+import threading
+import cProfile
+import pstats
+import contextlib
+from datetime import datetime, timezone
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# Upper bounds (seconds) of the exchange latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def configure_logging(level='INFO', fmt=LOG_FORMAT):
+    logging.basicConfig(level=getattr(logging, level.upper()), format=fmt)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+# Process-wide registry of counters, stage timers and latency histograms, each keyed by
+# name and labels. Updates take one lock and a dict lookup, so they can be left on in
+# the live bot; the backtester's inner loop does not record anything.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.timers = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        # Totals kept elsewhere (e.g. on a hot path) are copied in before writing
+        with self.lock:
+            self.counters[(name, label_key(labels))] = value
+
+    def record_time(self, stage, seconds):
+        with self.lock:
+            total, calls, longest = self.timers.get(stage, (0.0, 0, 0.0))
+            self.timers[stage] = (total + seconds, calls + 1, max(longest, seconds))
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(stage, time.perf_counter() - started)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def count_sql(self, statement):
+        # sqlite3 trace callback: every executed statement, including each executemany row
+        self.count('db_statements_total')
+        if statement.lstrip()[:6].upper() == 'COMMIT':
+            self.count('db_commits_total')
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'run_seconds': time.time() - self.started,
+                'counters': [{'name': name, 'labels': dict(key), 'value': value}
+                             for (name, key), value in sorted(self.counters.items())],
+                'stages': {stage: {'seconds': total, 'calls': calls, 'max_seconds': longest}
+                           for stage, (total, calls, longest) in sorted(self.timers.items())},
+                'histograms': [{'name': name, 'labels': dict(key), 'buckets': dict(zip(LATENCY_BUCKETS, histogram['buckets'])),
+                                'sum': histogram['sum'], 'count': histogram['count']}
+                               for (name, key), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, key), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(key)} {value}")
+            for stage, (total, calls, longest) in sorted(self.timers.items()):
+                labels = format_labels((('stage', stage),))
+                lines.append(f"pipeline_stage_seconds_sum{labels} {total}")
+                lines.append(f"pipeline_stage_seconds_count{labels} {calls}")
+                lines.append(f"pipeline_stage_seconds_max{labels} {longest}")
+            for (name, key), histogram in sorted(self.histograms.items()):
+                for bound, observed in zip(LATENCY_BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{format_labels(key, (('le', bound),))} {observed}")
+                lines.append(f"{name}_bucket{format_labels(key, (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(key)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(key)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # *.prom files are rewritten whole for a node_exporter textfile collector; any
+        # other path gets one JSON line appended per run
+        if path.endswith('.prom'):
+            temporary = f"{path}.tmp"
+            with open(temporary, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(temporary, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def profiled(profiler=None, output=None):
+    # profiler: None, 'cprofile' or 'pyinstrument' (optional dependency). The report goes
+    # to output, or is logged when no output path is given.
+    logger = logging.getLogger(__name__)
+    if profiler is None:
+        yield
+        return
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            if output:
+                with open(output, 'w') as f:
+                    f.write(profile.output_html() if output.endswith('.html') else profile.output_text())
+            else:
+                logger.info(profile.output_text())
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if output:
+            profile.dump_stats(output)
+        else:
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(30)
+            logger.info(report.getvalue())
@@ -0,0 +1,231 @@
+import os
+import json
+import logging
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import ccxt
+import kraken_daily_momentum as bot
+from exchange_client import ExchangeClient
+from trade_ledger import TradeLedger
+from reconcile import reconcile_orders
+from risk import AccountBalances, RiskEngine, realized_volatility
+from metrics import metrics, configure_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_KEY_ENV = 'KRAKEN_API_KEY'
+DEFAULT_API_SECRET_ENV = 'KRAKEN_API_SECRET'
+
+
+# One strategy variant on one Kraken account: its tickers, order sizing and take-profit,
+# the database holding its trade_history, and the names of the environment variables
+# with its API credentials (secrets never go in the config file).
+class Portfolio:
+    def __init__(self, name, db_path, tickers, pairs=None, min_trade_volume=None,
+                 take_profit_percentage=bot.TAKE_PROFIT_PERCENTAGE, sizing=None, api_key_env=DEFAULT_API_KEY_ENV,
+                 api_secret_env=DEFAULT_API_SECRET_ENV):
+        self.name = name
+        self.db_path = db_path
+        self.tickers = list(tickers)
+        self.pairs = {ticker: (pairs or {}).get(ticker) or bot.KRAKEN_PAIRS.get(ticker) for ticker in self.tickers}
+        self.min_trade_volume = {**bot.MIN_TRADE_VOLUME, **(min_trade_volume or {})}
+        self.take_profit_percentage = take_profit_percentage
+        self.sizing = sizing or bot.SIZING
+        self.api_key_env = api_key_env
+        self.api_secret_env = api_secret_env
+        self.client = None
+        self.conn = None
+        self.ledger = None
+
+        unknown = [ticker for ticker, pair in self.pairs.items() if pair is None]
+        if unknown:
+            raise ValueError(f"Portfolio {name}: no Kraken pair for {', '.join(unknown)}")
+        unsized = [pair for pair in self.pairs.values() if pair not in self.min_trade_volume]
+        if unsized:
+            raise ValueError(f"Portfolio {name}: no min_trade_volume for {', '.join(unsized)}")
+
+    @classmethod
+    def from_config(cls, entry):
+        try:
+            return cls(**entry)
+        except TypeError as e:
+            raise ValueError(f"Invalid portfolio {entry.get('name', '?')}: {e}") from None
+
+    def credentials(self):
+        key, secret = os.environ.get(self.api_key_env), os.environ.get(self.api_secret_env)
+        if not key or not secret:
+            raise ValueError(f"Portfolio {self.name}: set {self.api_key_env} and {self.api_secret_env}")
+        return key, secret
+
+
+def load_config(path):
+    # JSON file: market data settings plus a list of portfolio definitions
+    with open(path) as f:
+        config = json.load(f)
+    portfolios = [Portfolio.from_config(entry) for entry in config.get('portfolios', [])]
+    if not portfolios:
+        raise ValueError(f"{path} defines no portfolios")
+    names = [portfolio.name for portfolio in portfolios]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path}: portfolio names must be unique")
+    # Two ledgers over one trade_history would manage each other's orders
+    db_paths = [os.path.abspath(portfolio.db_path) for portfolio in portfolios]
+    if len(set(db_paths)) != len(db_paths):
+        raise ValueError(f"{path}: every portfolio needs its own db_path")
+    return config, portfolios
+
+def open_portfolios(portfolios, market_db, market_conn):
+    # Portfolios on the same account (API key variable) share one client, so that
+    # account's rate limits and nonce ordering are enforced across all of them. A
+    # portfolio whose db_path is the market database uses the market connection.
+    clients = {}
+    for portfolio in portfolios:
+        account = portfolio.api_key_env
+        if account not in clients:
+            clients[account] = ExchangeClient.kraken(*portfolio.credentials(), pool_size=bot.MAX_WORKERS)
+        portfolio.client = clients[account]
+        if os.path.abspath(portfolio.db_path) == os.path.abspath(market_db):
+            portfolio.conn = market_conn
+        else:
+            portfolio.conn = bot.connect_db(portfolio.db_path)
+            bot.create_tables(portfolio.conn)
+        portfolio.ledger = TradeLedger(portfolio.conn).load()
+        logger.info(f"[{portfolio.name}] {len(portfolio.tickers)} tickers, "
+                    f"{sum(len(orders) for orders in portfolio.ledger.open_orders.values())} open limit orders")
+    return clients
+
+def reconcile_portfolio(portfolio):
+    try:
+        with metrics.timer('reconciliation'):
+            updated = reconcile_orders(portfolio.ledger, portfolio.client)
+        logger.info(f"[{portfolio.name}] Reconciled open orders with the exchange ({updated} updated).")
+    except ccxt.BaseError as e:
+        logger.warning(f"[{portfolio.name}] Could not reconcile orders with the exchange: {type(e).__name__}: {str(e)}")
+
+def load_balances(account, client):
+    # One fetch_balance per account and run, shared by the account's portfolios
+    try:
+        return AccountBalances(client).load()
+    except ccxt.BaseError as e:
+        logger.error(f"Could not fetch balances for {account}, not trading its portfolios: {type(e).__name__}: {str(e)}")
+        return None
+
+def trade_portfolio(portfolio, signals, balances, closes, shared=False):
+    # signals: ticker -> ((timestamp, close, trend), volatility) for tickers with a new
+    # trade-interval bar; closes: ticker -> newest stored close, which values the holdings
+    # of every pair of the portfolio. Portfolios on one account size against its shared
+    # balances, and each only sells (or weighs) the position its own ledger holds.
+    if balances is None:
+        return
+    engine = RiskEngine(balances, portfolio.min_trade_volume, portfolio.sizing,
+                        ledger=portfolio.ledger if shared else None)
+    bot.mark_holdings(engine, portfolio.pairs, closes)
+    for ticker in portfolio.tickers:
+        if ticker in signals:
+            signal, volatility = signals[ticker]
+            bot.queue_signal(portfolio.ledger, engine, ticker, portfolio.pairs[ticker], signal, volatility,
+                             portfolio.client)
+    placed = bot.execute_plan(portfolio.ledger, engine, portfolio.client, portfolio.take_profit_percentage)
+    logger.info(f"[{portfolio.name}] Placed {placed} orders.")
+
+def flush_portfolio(portfolio):
+    # The market connection is shared with store_data
+    with bot.db_lock:
+        written = portfolio.ledger.flush()
+    logger.info(f"[{portfolio.name}] Trade history updated ({written} rows in one transaction).")
+
+
+# Runs every portfolio of the config in one process. Bars and indicators are downloaded,
+# computed and stored once per ticker in the market database while each portfolio's open
+# orders are reconciled; then every portfolio acts on the shared signals concurrently,
+# with its own client, ledger, risk engine and settings.
+def main(config_path, full_refresh=False, metrics_file=None):
+    config, portfolios = load_config(config_path)
+    market_db = config.get('market_db', bot.DB_PATH)
+    base_interval = config.get('base_interval', bot.BASE_INTERVAL)
+    rollup_intervals = config.get('rollup_intervals', bot.ROLLUP_INTERVALS)
+    trade_interval = config.get('trade_interval', bot.TRADE_INTERVAL)
+    if trade_interval not in [base_interval] + list(rollup_intervals):
+        raise ValueError("trade_interval must be the base interval or one of the rollup intervals")
+    bot.BAR_STORE_PATH = config.get('bar_store', bot.BAR_STORE_PATH)
+    bot.BAR_CACHE_PATH = config.get('bar_cache', bot.BAR_CACHE_PATH)
+    bot.EXCHANGE_STOPS = config.get('exchange_stops', bot.EXCHANGE_STOPS)
+
+    logger.info(f"Using market database at: {market_db}")
+    market_conn = bot.connect_db(market_db)
+    if metrics_file:
+        market_conn.set_trace_callback(metrics.count_sql)
+    bot.create_tables(market_conn)
+    clients = open_portfolios(portfolios, market_db, market_conn)
+    tickers = sorted({ticker for portfolio in portfolios for ticker in portfolio.tickers})
+    # Gaps are filled from Kraken with the pairs the portfolios configure
+    pairs = {ticker: pair for portfolio in portfolios for ticker, pair in portfolio.pairs.items()}
+    as_of = datetime.now(timezone.utc).replace(tzinfo=None)
+    logger.info(f"{len(portfolios)} portfolios on {len(clients)} accounts, {len(tickers)} tickers, "
+                f"updating bars up to {as_of} UTC")
+
+    try:
+        with ThreadPoolExecutor(max_workers=bot.MAX_WORKERS) as executor:
+            reconciliations = [executor.submit(reconcile_portfolio, portfolio) for portfolio in portfolios]
+            updates = {ticker: executor.submit(bot.update_market_data, market_conn, ticker, as_of, full_refresh,
+                                               base_interval, rollup_intervals, trade_interval, pairs)
+                       for ticker in tickers}
+            signals = {}
+            for ticker, future in updates.items():
+                try:
+                    new_trade_bars = future.result()
+                except Exception as e:
+                    logger.error(f"Error while updating {ticker}: {str(e)}")
+                    continue
+                # Decide once per closed trade-interval bar, however often the runner runs
+                if not new_trade_bars:
+                    logger.info(f"No new {trade_interval} bar for {ticker}, skipping trading logic")
+                    continue
+                signal = bot.read_signal(market_conn, ticker, trade_interval)
+                if signal is not None:
+                    with bot.db_lock:
+                        signals[ticker] = (signal, realized_volatility(market_conn, ticker, trade_interval))
+            for future in reconciliations:
+                future.result()
+            closes = bot.latest_closes(market_conn, tickers, trade_interval)
+
+            balances = {account: executor.submit(load_balances, account, client) for account, client in clients.items()}
+            balances = {account: future.result() for account, future in balances.items()}
+            accounts = collections.Counter(portfolio.api_key_env for portfolio in portfolios)
+            trades = {executor.submit(trade_portfolio, portfolio, signals, balances[portfolio.api_key_env], closes,
+                                      accounts[portfolio.api_key_env] > 1): portfolio
+                      for portfolio in portfolios}
+            for future, portfolio in trades.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"[{portfolio.name}] Error while trading: {str(e)}")
+    finally:
+        # Orders already placed on the exchange must be recorded even if a worker failed
+        for portfolio in portfolios:
+            if portfolio.ledger is not None:
+                flush_portfolio(portfolio)
+        for account, client in clients.items():
+            logger.info(f"Exchange API calls for {account}: {dict(client.calls)}")
+        if metrics_file:
+            metrics.write(metrics_file)
+            logger.info(f"Metrics written to {metrics_file}")
+        for conn in {id(portfolio.conn): portfolio.conn for portfolio in portfolios if portfolio.conn}.values():
+            if conn is not market_conn:
+                conn.close()
+        market_conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several portfolios of the momentum bot from one config file")
+    parser.add_argument('config', help="JSON file with the market data settings and the portfolio definitions")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help=f"re-download and recompute the full history since {bot.HISTORY_START_DATE}")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics-file',
+                        help="write run metrics here: Prometheus text format for *.prom, otherwise one JSON line per run")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    main(args.config, full_refresh=args.full_refresh, metrics_file=args.metrics_file)
@@ -0,0 +1,75 @@
+import abc
+import logging
+import asyncio
+import csv
+from collections import namedtuple
+from datetime import datetime, timezone
+import ccxt.pro as ccxtpro
+
+logger = logging.getLogger(__name__)
+
+# pair: Kraken pair ('BTC/USD'), timestamp: naive UTC datetime
+Tick = namedtuple('Tick', ['pair', 'price', 'timestamp'])
+
+RECONNECT_DELAY_SECONDS = 5
+
+
+# A price feed is anything with an async ticks() generator yielding Tick objects in time
+# order. The live daemon only depends on that, so a replay or a simulation can stand in
+# for the exchange.
+class PriceFeed(abc.ABC):
+    @abc.abstractmethod
+    def ticks(self):
+        pass
+
+
+class KrakenTickerFeed(PriceFeed):
+    # Kraken's public WebSocket ticker channel through ccxt.pro; no API keys needed
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+
+    async def ticks(self):
+        exchange = ccxtpro.kraken()
+        try:
+            while True:
+                try:
+                    tickers = await exchange.watch_tickers(self.pairs)
+                except ccxtpro.NetworkError as e:
+                    logger.warning(f"Ticker feed disconnected: {str(e)}, reconnecting in {RECONNECT_DELAY_SECONDS}s")
+                    await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                    continue
+                for pair, ticker in tickers.items():
+                    if ticker.get('last') is None:
+                        continue
+                    timestamp = ticker.get('timestamp') or exchange.milliseconds()
+                    yield Tick(pair, ticker['last'],
+                               datetime.fromtimestamp(timestamp / 1000, timezone.utc).replace(tzinfo=None))
+        finally:
+            await exchange.close()
+
+
+class ReplayFeed(PriceFeed):
+    # Replays recorded ticks. speed=0 replays as fast as possible, 1 in real time, 60 a
+    # minute of ticks per second.
+    def __init__(self, ticks, speed=0):
+        self.recorded = ticks
+        self.speed = speed
+
+    @classmethod
+    def from_csv(cls, path, speed=0):
+        # CSV with timestamp ('%Y-%m-%d %H:%M:%S'), pair and price columns
+        with open(path, newline='') as f:
+            ticks = [Tick(row['pair'], float(row['price']), datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S'))
+                     for row in csv.DictReader(f)]
+        return cls(ticks, speed)
+
+    async def ticks(self):
+        previous = None
+        for tick in self.recorded:
+            if self.speed and previous is not None:
+                await asyncio.sleep(max(0, (tick.timestamp - previous).total_seconds() / self.speed))
+            else:
+                # Let other tasks (bar closes, flushes) run between ticks
+                await asyncio.sleep(0)
+            previous = tick.timestamp
+            yield tick
@@ -0,0 +1,68 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+CLOSED_ORDERS_CURSOR = 'closed_orders_since'
+# Re-read this much history before the cursor: Kraken's start filter has one-second
+# resolution and orders can be reported closed slightly out of order
+CURSOR_OVERLAP_MS = 60 * 1000
+
+
+def to_millis(timestamp):
+    # trade_history timestamps are local-time ISO strings
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+def from_millis(millis):
+    return datetime.fromtimestamp(millis / 1000).isoformat()
+
+
+# Brings the open limit orders in the ledger up to date with the exchange:
+# - one OpenOrders call picks up partial fills of orders that are still open
+# - paged ClosedOrders calls, starting from a cursor kept in sync_state, pick up orders
+#   that were filled, canceled or expired since the last run
+# The changes and the new cursor are written by the ledger's next flush, in one
+# transaction. The number of requests depends on how many orders closed, not on how
+# many are open.
+def reconcile_orders(ledger, client):
+    tracked = ledger.exchange_orders()
+    if not tracked:
+        return 0
+
+    cursor = ledger.get_sync_state(CLOSED_ORDERS_CURSOR)
+    if cursor is not None:
+        since = max(0, int(cursor) - CURSOR_OVERLAP_MS)
+    else:
+        # First reconciliation: everything closed since the oldest tracked order was placed
+        since = max(0, min(to_millis(order['timestamp']) for order in tracked.values()) - CURSOR_OVERLAP_MS)
+
+    closed = client.fetch_closed_orders_since(since)
+    still_open = client.fetch_open_orders()
+
+    updated = 0
+    newest = int(cursor) if cursor is not None else since
+    for exchange_order in closed:
+        closed_at = exchange_order.get('lastUpdateTimestamp') or exchange_order.get('timestamp')
+        if closed_at:
+            newest = max(newest, closed_at)
+        order = tracked.pop(exchange_order['id'], None)
+        if order is None:
+            continue
+        status = exchange_order['status']
+        if ledger.apply_exchange_order(order, status, exchange_order.get('filled'), exchange_order.get('average'),
+                                       from_millis(closed_at) if closed_at else None):
+            updated += 1
+            logger.info(f"Order {order['id']} ({exchange_order['id']}) {status} on the exchange, "
+                        f"filled {exchange_order.get('filled')} at {exchange_order.get('average')}")
+
+    for exchange_order in still_open:
+        order = tracked.pop(exchange_order['id'], None)
+        if order is not None and exchange_order.get('filled') and \
+                ledger.apply_exchange_order(order, 'open', exchange_order['filled'], None):
+            updated += 1
+            logger.info(f"Order {order['id']} ({exchange_order['id']}) partially filled: {exchange_order.get('filled')}")
+
+    if tracked:
+        logger.warning(f"{len(tracked)} open orders were not found on the exchange: {', '.join(sorted(tracked))}")
+    ledger.set_sync_state(CLOSED_ORDERS_CURSOR, str(newest))
+    return updated
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+INTERVAL_SECONDS = {'1m': 60, '5m': 300, '15m': 900, '30m': 1800, '1h': 3600, '4h': 14400, '1d': 86400}
+
+BAR_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def bucket_start(timestamp, interval):
+    seconds = INTERVAL_SECONDS[interval]
+    epoch = int(pd.Timestamp(timestamp).timestamp())
+    return pd.Timestamp(epoch - epoch % seconds, unit='s')
+
+def to_bar_frame(bucket_seconds, columns):
+    index = pd.to_datetime(np.asarray(bucket_seconds, dtype=np.int64), unit='s')
+    df = pd.DataFrame(columns, index=index)
+    df['timestamp'] = df.index.strftime('%Y-%m-%d %H:%M:%S')
+    return df
+
+
+# Streaming OHLCV resampler. Lower-timeframe bars are fed in timestamp order, in batches
+# of any size; every bucket that is complete is returned as one higher-timeframe bar and
+# the bucket still being filled is carried over to the next batch. Buckets are aligned
+# to UTC epoch multiples of the interval, so daily buckets start at midnight UTC like the
+# daily bars yfinance returns for crypto.
+class BarResampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.seconds = INTERVAL_SECONDS[interval]
+        self.open_bucket = None
+        self.open_bar = None
+
+    def update(self, bars):
+        # bars: DataFrame with a 'timestamp' column ('%Y-%m-%d %H:%M:%S') and OHLCV columns
+        if bars.empty:
+            return to_bar_frame([], {column: [] for column in BAR_COLUMNS})
+
+        times = pd.to_datetime(bars['timestamp']).to_numpy().astype('datetime64[s]').astype(np.int64)
+        buckets = times - times % self.seconds
+        values = {column: bars[column].to_numpy(dtype=float) for column in BAR_COLUMNS}
+
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(buckets)] - 1
+        grouped = {
+            'open': values['open'][starts],
+            'high': np.maximum.reduceat(values['high'], starts),
+            'low': np.minimum.reduceat(values['low'], starts),
+            'close': values['close'][ends],
+            'volume': np.add.reduceat(values['volume'], starts),
+        }
+        group_buckets = buckets[starts]
+
+        # Merge the first group into the bucket left open by the previous batch
+        closed_buckets = []
+        closed = {column: [] for column in BAR_COLUMNS}
+        if self.open_bar is not None:
+            if group_buckets[0] == self.open_bucket:
+                grouped['open'][0] = self.open_bar['open']
+                grouped['high'][0] = max(grouped['high'][0], self.open_bar['high'])
+                grouped['low'][0] = min(grouped['low'][0], self.open_bar['low'])
+                grouped['volume'][0] += self.open_bar['volume']
+            else:
+                closed_buckets.append(self.open_bucket)
+                for column in BAR_COLUMNS:
+                    closed[column].append(self.open_bar[column])
+
+        closed_buckets.extend(group_buckets[:-1].tolist())
+        for column in BAR_COLUMNS:
+            closed[column].extend(grouped[column][:-1].tolist())
+
+        self.open_bucket = int(group_buckets[-1])
+        self.open_bar = {column: float(grouped[column][-1]) for column in BAR_COLUMNS}
+        return to_bar_frame(closed_buckets, closed)
+
+    def flush(self, as_of):
+        # Close the open bucket once as_of has reached its end; returns it or an empty frame
+        if self.open_bar is None or self.open_bucket + self.seconds > pd.Timestamp(as_of).timestamp():
+            return to_bar_frame([], {column: [] for column in BAR_COLUMNS})
+        bar = to_bar_frame([self.open_bucket], {column: [self.open_bar[column]] for column in BAR_COLUMNS})
+        self.open_bucket = None
+        self.open_bar = None
+        return bar
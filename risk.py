@@ -0,0 +1,190 @@
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+from signals import BULLISH, BEARISH
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SIZING_MODES = ['fixed', 'volatility', 'target_weight']
+SIZING = 'fixed'  # MIN_TRADE_VOLUME per signal, the bot's original sizing
+RISK_PER_TRADE = 0.005  # volatility sizing: a one-bar, one-sigma move of an order is worth this share of equity
+TARGET_WEIGHT = 0.20  # target_weight sizing: share of equity held in a pair while it is bullish
+MAX_PAIR_WEIGHT = 0.25  # buys never take a pair above this share of equity
+VOLATILITY_LOOKBACK = 30  # log returns behind the volatility estimate
+TAKER_FEE = 0.004  # reserved on top of the cost of every buy, so fees never overdraw the cash
+
+PlannedOrder = namedtuple('PlannedOrder', ['ticker', 'pair', 'side', 'volume', 'price'])
+
+
+def split_pair(pair):
+    base, quote = pair.split('/')
+    return base, quote
+
+def realized_volatility(conn, ticker, interval='1d', lookback=VOLATILITY_LOOKBACK):
+    # Standard deviation of the last `lookback` log returns per bar, read through the
+    # primary key; None while the series is shorter than that
+    closes = [row[0] for row in conn.execute("""
+    SELECT close FROM crypto_data
+    WHERE ticker = ? AND interval = ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+    """, (ticker, interval, lookback + 1))]
+    if len(closes) <= lookback:
+        return None
+    return float(np.diff(np.log(closes[::-1])).std(ddof=1))
+
+
+# Balances of one exchange account, fetched with a single fetch_balance per run. Fills and
+# take-profit orders placed during the run are applied locally, so sizing the later
+# orders of the run never asks the exchange again. Like Kraken, `free` excludes what open
+# limit orders hold. Portfolios trading on the same account share one instance; its lock
+# is held while a portfolio plans and places its orders.
+class AccountBalances:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.RLock()
+        self.total = {}
+        self.free = {}
+
+    def load(self):
+        balance = self.client.fetch_balance()
+        with self.lock:
+            self.total = {currency: float(amount or 0) for currency, amount in (balance.get('total') or {}).items()}
+            self.free = {currency: float(amount or 0) for currency, amount in (balance.get('free') or {}).items()}
+        return self
+
+    def available(self, currency):
+        with self.lock:
+            return max(self.free.get(currency, 0.0), 0.0)
+
+    def held(self, currency):
+        with self.lock:
+            return self.total.get(currency, 0.0)
+
+    def record_fill(self, pair, side, volume, price):
+        base, quote = split_pair(pair)
+        sign = 1 if side == 'buy' else -1
+        with self.lock:
+            for balances in (self.total, self.free):
+                balances[base] = balances.get(base, 0.0) + sign * volume
+                balances[quote] = balances.get(quote, 0.0) - sign * volume * price * (1 + TAKER_FEE * sign)
+
+    def hold(self, currency, amount):
+        # A limit order placed (amount > 0) or canceled (amount < 0)
+        with self.lock:
+            self.free[currency] = self.free.get(currency, 0.0) - amount
+
+
+# Turns the trend signals of one run into at most one market order per pair. Signals are
+# queued with add_signal as each ticker's data comes in; plan() then nets them per pair
+# and sizes the result against the account's equity: its quote cash plus the holdings of
+# every pair marked with mark() (all the configured pairs, at their newest stored close,
+# so equity does not depend on which tickers closed a bar this run) or signalled, at the
+# signal close:
+#   fixed          min_trade_volume per signal, the bot's original sizing
+#   volatility     risk_per_trade of equity per signal, divided by the pair's volatility
+#   target_weight  buys up to target_weight of equity, sells the whole free holding
+# Buys are capped by the free cash and by max_pair_weight, sells by the free base
+# currency, and orders that end up below min_trade_volume are dropped. All pairs of one
+# engine are expected to share a quote currency. When several portfolios share an
+# account, `ledger` is the portfolio's TradeLedger: its own position then also bounds
+# the holding behind sells, target weights and max_pair_weight, so one portfolio never
+# sells what another bought.
+class RiskEngine:
+    def __init__(self, balances, min_trade_volume, sizing=SIZING, risk_per_trade=RISK_PER_TRADE,
+                 target_weight=TARGET_WEIGHT, max_pair_weight=MAX_PAIR_WEIGHT, ledger=None):
+        if sizing not in SIZING_MODES:
+            raise ValueError(f"Unknown sizing {sizing!r}, expected one of {', '.join(SIZING_MODES)}")
+        self.balances = balances
+        self.min_trade_volume = min_trade_volume
+        self.sizing = sizing
+        self.risk_per_trade = risk_per_trade
+        self.target_weight = target_weight
+        self.max_pair_weight = max_pair_weight
+        self.ledger = ledger
+        self.signals = {}
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def mark(self, pair, price):
+        with self.lock:
+            self.marks[pair] = float(price)
+
+    def add_signal(self, ticker, pair, signal, volatility=None):
+        # signal: (timestamp, close, trend) as returned by read_signal
+        timestamp, price, trend = signal
+        with self.lock:
+            self.signals.setdefault(pair, []).append((ticker, trend, float(price), volatility))
+
+    def equity(self, marks):
+        quotes = {split_pair(pair)[1] for pair in marks}
+        return (sum(self.balances.held(quote) for quote in quotes)
+                + sum(self.balances.held(split_pair(pair)[0]) * price for pair, price in marks.items()))
+
+    def holding(self, pair):
+        # (held, free) base volume of the pair this engine may trade
+        base = split_pair(pair)[0]
+        held, free = self.balances.held(base), self.balances.available(base)
+        if self.ledger is not None:
+            own_held, own_free = self.ledger.position(pair.replace('/', '-'))
+            held, free = min(held, max(own_held, 0.0)), min(free, max(own_free, 0.0))
+        return held, free
+
+    def signed_volume(self, pair, signals, price, volatility, equity):
+        # Net volume the pair's signals ask for before the balance limits
+        net = sum(1 if trend == BULLISH else -1 if trend == BEARISH else 0 for ticker, trend, _, _ in signals)
+        if net == 0:
+            return 0.0
+        if self.sizing == 'target_weight':
+            held, _ = self.holding(pair)
+            if net < 0:
+                return -held
+            return max(self.target_weight * equity / price - held, 0.0)
+        if self.sizing == 'volatility' and volatility:
+            return net * self.risk_per_trade * equity / (price * volatility)
+        if self.sizing == 'volatility':
+            logger.warning(f"No volatility for {pair}, sizing with the minimum trade volume")
+        return net * self.min_trade_volume[pair]
+
+    def plan(self):
+        with self.lock:
+            signals, self.signals = self.signals, {}
+            marks = dict(self.marks)
+        with self.balances.lock:
+            marks.update((pair, pair_signals[-1][2]) for pair, pair_signals in signals.items())
+            equity = self.equity(marks)
+            cash = {}
+            orders = []
+            for pair in sorted(signals):
+                pair_signals = signals[pair]
+                ticker, _, price, volatility = pair_signals[-1]
+                quote = split_pair(pair)[1]
+                volume = self.signed_volume(pair, pair_signals, price, volatility, equity)
+                if len(pair_signals) > 1:
+                    metrics.count('signals_netted_total', len(pair_signals) - 1)
+                    logger.info(f"Netted {len(pair_signals)} signals for {pair} into {volume:+g}")
+                if not volume:
+                    continue
+                if volume > 0:
+                    cash.setdefault(quote, self.balances.available(quote))
+                    headroom = self.max_pair_weight * equity / price - self.holding(pair)[0]
+                    volume = max(min(volume, headroom, cash[quote] / (price * (1 + TAKER_FEE))), 0.0)
+                    cash[quote] -= volume * price * (1 + TAKER_FEE)
+                elif volume < 0:
+                    volume = -min(-volume, self.holding(pair)[1])
+                if abs(volume) < self.min_trade_volume[pair]:
+                    logger.info(f"No {pair} order: {abs(volume):g} after balance limits is below the minimum trade volume")
+                    metrics.count('orders_skipped_total', pair=pair)
+                    continue
+                orders.append(PlannedOrder(ticker, pair, 'buy' if volume > 0 else 'sell', abs(volume), price))
+        return orders
+
+
+def take_profit_entry(orders, volume, price):
+    # Volume-weighted entry price of a new buy combined with the remaining volume of the
+    # pair's resting take-profit orders, whose `price` is their own entry
+    remaining = [(order['volume'] - (order['filled_volume'] or 0), order['price']) for order in orders]
+    total = volume + sum(left for left, _ in remaining)
+    return total, (volume * price + sum(left * entry for left, entry in remaining)) / total
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+SIGNAL_FAST_SPAN = 50
+SIGNAL_SLOW_SPAN = 200
+SIGNAL_WARMUP = 200  # bars a series needs before its slow EMA is trusted; earlier bars carry no signal
+SIGNAL_COLUMNS = ['signal_fast_ema', 'signal_slow_ema', 'signal']
+BULLISH = 'Bullish'
+BEARISH = 'Bearish'
+
+
+# The trend signal the bot trades on, shared by ingestion, the live decision and the
+# backtester: a 50/200 EMA crossover over each series' full history (ewm with
+# adjust=False, seeded at the first close). Ingestion advances the EMAs bar by bar in
+# IndicatorState and stores them with the signal on every crypto_data row, so the live
+# decision is one lookup of the newest bar and a backtest replays the same values.
+
+def ema_step(previous, close, span):
+    alpha = 2.0 / (span + 1)
+    return close if previous is None else (1 - alpha) * previous + alpha * close
+
+def trend_signal(fast_ema, slow_ema, count):
+    # count: bars seen up to and including this one
+    if count < SIGNAL_WARMUP:
+        return None
+    return BULLISH if fast_ema > slow_ema else BEARISH
+
+def batch_signals(close):
+    # The same columns computed with pandas over a whole close series
+    close = pd.Series(close, dtype=float)
+    fast = close.ewm(span=SIGNAL_FAST_SPAN, adjust=False).mean()
+    slow = close.ewm(span=SIGNAL_SLOW_SPAN, adjust=False).mean()
+    signal = pd.Series(np.where(fast > slow, BULLISH, BEARISH), index=close.index, dtype=object)
+    signal.iloc[:SIGNAL_WARMUP - 1] = None
+    return pd.DataFrame({'signal_fast_ema': fast, 'signal_slow_ema': slow, 'signal': signal})
+
+
+def latest_signal(conn, ticker, interval='1d'):
+    # (timestamp, close, signal) of the newest stored bar, read through the primary key
+    return conn.execute("""
+    SELECT timestamp, close, signal FROM crypto_data
+    WHERE ticker = ? AND interval = ?
+    ORDER BY timestamp DESC
+    LIMIT 1
+    """, (ticker, interval)).fetchone()
+
+def backfill_signals(conn):
+    # Computes the signal columns of series stored before they existed, replaying each
+    # from its first bar with the same steps ingestion uses. Callers commit.
+    series = conn.execute("SELECT DISTINCT ticker, interval FROM crypto_data WHERE signal_slow_ema IS NULL").fetchall()
+    for ticker, interval in series:
+        rows = conn.execute("""
+        SELECT timestamp, close FROM crypto_data
+        WHERE ticker = ? AND interval = ?
+        ORDER BY timestamp ASC
+        """, (ticker, interval)).fetchall()
+        fast_ema = slow_ema = None
+        updates = []
+        for count, (timestamp, close) in enumerate(rows, start=1):
+            fast_ema = ema_step(fast_ema, float(close), SIGNAL_FAST_SPAN)
+            slow_ema = ema_step(slow_ema, float(close), SIGNAL_SLOW_SPAN)
+            updates.append((fast_ema, slow_ema, trend_signal(fast_ema, slow_ema, count), ticker, interval, timestamp))
+        conn.executemany("""
+        UPDATE crypto_data SET signal_fast_ema = ?, signal_slow_ema = ?, signal = ?
+        WHERE ticker = ? AND interval = ? AND timestamp = ?
+        """, updates)
+    return len(series)
@@ -0,0 +1,141 @@
+import heapq
+import bisect
+import itertools
+
+TRAILING_STOP_STEPS = [0.06, 0.10, 0.15, 0.20, 0.25]  # gains over the entry price that move the stop up
+INITIAL_STOP = 0.05  # stop level, over the entry price, set when the first step is reached
+LEGACY_STOP_STEP = 0.05  # the live bot's earlier rule: step k at a k * 5% gain, with the stop at that same gain
+
+
+# The trailing stop rule shared by the live bot and both backtest engines. An order
+# bought at `entry` has reached step k once the price trades at or above entry * (1 +
+# steps[k - 1]). The first step puts the stop at INITIAL_STOP above the entry; every
+# later step moves it to the step before: with the default steps a +10% price sets
+# the stop at +6%, +15% at +10%, and so on. Stops only move up.
+
+def step_prices(entry, steps):
+    return [entry * (1 + step) for step in steps]
+
+def stop_price(entry, steps, step):
+    return entry * (1 + (INITIAL_STOP if step == 1 else steps[step - 2]))
+
+def convert_legacy_stops(conn, steps=TRAILING_STOP_STEPS):
+    # Open orders stepped by the live bot before this rule stored current_step k for a
+    # k * LEGACY_STOP_STEP gain. Each moves to the step the same gain reaches under
+    # `steps` (old step 1 at +5% is step 0 of the defaults), so the next step is not
+    # read from the old numbering; its stored stop price is kept, as stops only move up.
+    # Callers commit.
+    orders = conn.execute("""
+    SELECT id, current_step FROM trade_history
+    WHERE limit_order = 1 AND filled = 0 AND current_step > 0
+    """).fetchall()
+    conn.executemany("UPDATE trade_history SET current_step = ? WHERE id = ?",
+                     [(bisect.bisect_right(steps, round(step * LEGACY_STOP_STEP, 10)), order_id)
+                      for order_id, step in orders])
+    return len(orders)
+
+
+class Stop:
+    __slots__ = ('item', 'ticker', 'entry', 'limit_price', 'prices', 'step', 'stop_price', 'sequence', 'live')
+
+    def __init__(self, item, ticker, entry, limit_price, prices, step, stop_price, sequence):
+        self.item = item
+        self.ticker = ticker
+        self.entry = entry
+        self.limit_price = limit_price
+        self.prices = prices
+        self.step = step
+        self.stop_price = stop_price
+        self.sequence = sequence
+        self.live = True
+
+
+# Open orders with trailing stops, indexed per ticker by price. Each ticker has three
+# heaps: the price of every order's next step (lowest first), its stop (highest first)
+# and, for orders whose take-profit is watched here rather than resting on an exchange,
+# its limit price (lowest first). A price update only pops the entries it crosses, so
+# its cost depends on the orders that trigger or step up, not on the orders that are
+# open. Entries left behind by a step or a removal are skipped when they surface.
+# Items are the callers' own order objects; update() reports what happened to them.
+class StopBook:
+    def __init__(self, steps=TRAILING_STOP_STEPS):
+        self.steps = list(steps)
+        self.stops = {}
+        self.heaps = {}
+        self.counts = {}
+        self.sequence = itertools.count()
+
+    def add(self, item, ticker, entry, limit_price=None, step=0, stop=None):
+        # step and stop restore an order whose stop already moved
+        prices = step_prices(entry, self.steps)
+        step = min(step or 0, len(prices))
+        record = Stop(item, ticker, entry, limit_price, prices, step, stop, next(self.sequence))
+        self.stops[id(item)] = record
+        self.counts[ticker] = self.counts.get(ticker, 0) + 1
+        next_steps, stops, limits = self.heaps.setdefault(ticker, ([], [], []))
+        if step < len(prices):
+            heapq.heappush(next_steps, (prices[step], record.sequence, record))
+        if stop is not None:
+            heapq.heappush(stops, (-stop, record.sequence, record))
+        if limit_price is not None:
+            heapq.heappush(limits, (limit_price, record.sequence, record))
+
+    def remove(self, item):
+        record = self.stops.pop(id(item), None)
+        if record is not None:
+            record.live = False
+            self.counts[record.ticker] -= 1
+
+    def count(self, ticker):
+        return self.counts.get(ticker, 0)
+
+    def __contains__(self, item):
+        return id(item) in self.stops
+
+    def __len__(self):
+        return len(self.stops)
+
+    def __iter__(self):
+        return (item for ticker, item in self.entries())
+
+    def entries(self):
+        # (ticker, item) of every open order, in placement order
+        return [(record.ticker, record.item) for record in sorted(self.stops.values(), key=lambda record: record.sequence)]
+
+    def update(self, ticker, price):
+        # Returns (stepped, triggered), both in placement order: [(item, step, stop price)]
+        # for stops that moved up and [(item, reason)] for orders to close, reason being
+        # 'limit' (take-profit reached) or 'stop'. Triggered orders leave the book.
+        heaps = self.heaps.get(ticker)
+        if heaps is None:
+            return [], []
+        next_steps, stops, limits = heaps
+        if not ((next_steps and next_steps[0][0] <= price) or (stops and -stops[0][0] >= price)
+                or (limits and limits[0][0] <= price)):
+            return [], []
+
+        triggered = {}
+        while limits and limits[0][0] <= price:
+            record = heapq.heappop(limits)[2]
+            if record.live:
+                triggered[record.sequence] = (record, 'limit')
+                self.remove(record.item)
+        stepped = {}
+        while next_steps and next_steps[0][0] <= price:
+            step_price, sequence, record = heapq.heappop(next_steps)
+            if not record.live or record.step >= len(record.prices) or record.prices[record.step] != step_price:
+                continue
+            record.step = bisect.bisect_right(record.prices, price)
+            # A stop restored from the database may sit above the rule's (convert_legacy_stops)
+            record.stop_price = max(stop_price(record.entry, self.steps, record.step), record.stop_price or 0.0)
+            stepped[sequence] = record
+            if record.step < len(record.prices):
+                heapq.heappush(next_steps, (record.prices[record.step], sequence, record))
+            heapq.heappush(stops, (-record.stop_price, sequence, record))
+        while stops and -stops[0][0] >= price:
+            stop, sequence, record = heapq.heappop(stops)
+            if record.live and record.stop_price == -stop:
+                triggered[sequence] = (record, 'stop')
+                self.remove(record.item)
+        return ([(record.item, record.step, record.stop_price) for sequence, record in sorted(stepped.items())],
+                [(record.item, reason) for sequence, (record, reason) in sorted(triggered.items())])
@@ -0,0 +1,254 @@
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import backtest_engine
+from signals import SIGNAL_FAST_SPAN, SIGNAL_SLOW_SPAN, SIGNAL_WARMUP
+from stops import TRAILING_STOP_STEPS
+from test import TAKE_PROFIT_PERCENTAGE, MIN_TRADE_VOLUME, TICKER_TO_PAIR
+from sweep import TICKERS, ASSET_STARTING_BALANCES, load_price_data, parse_steps
+
+MODELS = ['bootstrap', 'regime']
+HORIZON_DAYS = 4 * 365  # simulated trading days per path, after SIGNAL_WARMUP days that only warm up the signal
+BLOCK_DAYS = 20  # bootstrap block length: volatility clusters and trends shorter than this survive resampling
+REGIME_WINDOW = 30  # days of the rolling volatility that splits the history into calm and stressed regimes
+PATH_CHUNK = 250  # paths generated and evaluated per worker task
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+# Path generator and run settings built in the parent and inherited by forked workers, like the price data
+# of sweep.py
+_generator = None
+_settings = None
+
+
+def historical_returns(data, tickers):
+    # Daily log returns of the days every ticker has a close, and the latest closes
+    frames = {ticker: data.load(ticker) for ticker in tickers}
+    dates, closes, _ = backtest_engine.align_price_data(frames, list(tickers))
+    closes = closes[np.isfinite(closes).all(axis=1)]
+    return np.diff(np.log(closes), axis=0), closes[-1]
+
+
+# Block bootstrap of the historical returns. Each path strings together blocks of
+# block_days consecutive days, starting at random days; all tickers take the same days,
+# so their correlation is kept along with short-term autocorrelation and volatility
+# clustering.
+class BlockBootstrap:
+    def __init__(self, returns, block_days=BLOCK_DAYS):
+        if len(returns) < block_days:
+            raise ValueError(f"{len(returns)} days of returns are fewer than one {block_days}-day block")
+        self.returns = returns
+        self.block_days = block_days
+
+    def sample(self, paths, days, rng):
+        blocks = -(-days // self.block_days)
+        starts = rng.integers(0, len(self.returns) - self.block_days + 1, size=(paths, blocks))
+        rows = (starts[:, :, None] + np.arange(self.block_days)).reshape(paths, -1)[:, :days]
+        return self.returns[rows]
+
+
+# Geometric Brownian motion with two regimes, calm and stressed. Days of the history are
+# labelled stressed when the mean rolling volatility of the tickers is above its median;
+# each regime gets the mean and covariance of its days' log returns, and the regime of
+# every path follows the Markov chain of the historical labels.
+class RegimeSwitchingGBM:
+    def __init__(self, returns, window=REGIME_WINDOW):
+        volatility = pd.DataFrame(returns).rolling(window, min_periods=2).std().mean(axis=1).bfill().to_numpy()
+        regimes = (volatility > np.median(volatility)).astype(np.int8)
+        self.means = np.array([returns[regimes == regime].mean(axis=0) for regime in (0, 1)])
+        # A small ridge keeps the factorisation defined when two tickers move in lockstep
+        ridge = 1e-12 * np.eye(returns.shape[1])
+        self.factors = np.array([np.linalg.cholesky(np.atleast_2d(np.cov(returns[regimes == regime], rowvar=False)) + ridge)
+                                 for regime in (0, 1)])
+        counts = np.zeros((2, 2))
+        np.add.at(counts, (regimes[:-1], regimes[1:]), 1)
+        self.stay = np.diag(counts) / counts.sum(axis=1)
+        self.stressed_share = regimes.mean()
+
+    def sample(self, paths, days, rng):
+        regimes = np.empty((paths, days), dtype=np.int8)
+        switches = rng.random((paths, days))
+        regime = (rng.random(paths) < self.stressed_share).astype(np.int8)
+        for day in range(days):
+            regimes[:, day] = regime
+            regime = np.where(switches[:, day] < self.stay[regime], regime, 1 - regime)
+        shocks = rng.standard_normal((paths, days, self.means.shape[1]))
+        returns = np.empty_like(shocks)
+        for regime in (0, 1):
+            mask = regimes == regime
+            returns[mask] = self.means[regime] + shocks[mask] @ self.factors[regime].T
+        return returns
+
+
+def ema_trends(closes):
+    # Trend matrices of the stored signal (signals.py) for paths x days x tickers closes,
+    # with the EMAs advanced over all paths at once; 0 until a path has SIGNAL_WARMUP bars
+    fast_alpha = 2.0 / (SIGNAL_FAST_SPAN + 1)
+    slow_alpha = 2.0 / (SIGNAL_SLOW_SPAN + 1)
+    trends = np.zeros(closes.shape, dtype=np.int8)
+    fast = closes[:, 0].copy()
+    slow = closes[:, 0].copy()
+    for day in range(closes.shape[1]):
+        if day:
+            fast = (1 - fast_alpha) * fast + fast_alpha * closes[:, day]
+            slow = (1 - slow_alpha) * slow + slow_alpha * closes[:, day]
+        if day >= SIGNAL_WARMUP - 1:
+            trends[:, day] = np.where(fast > slow, backtest_engine.BULLISH, backtest_engine.BEARISH)
+    return trends
+
+
+def equity_curve(closes, trades, volumes, balance, positions):
+    # Daily account value of one simulate() run: cash plus holdings at the close
+    cash = np.full(len(closes), float(balance))
+    holdings = np.zeros(closes.shape)
+    if trades:
+        days, columns, kinds, _, fill_prices, _ = zip(*trades)
+        days, columns = np.asarray(days), np.asarray(columns)
+        signs = np.where(np.asarray(kinds) == backtest_engine.BUY, 1.0, -1.0)
+        traded = signs * np.asarray(volumes)[columns]
+        cash_deltas = np.zeros(len(closes))
+        np.add.at(cash_deltas, days, -traded * np.asarray(fill_prices))
+        np.add.at(holdings, (days, columns), traded)
+        cash += np.cumsum(cash_deltas)
+    holdings = np.cumsum(holdings, axis=0) + np.asarray(positions, dtype=float)
+    return cash + (holdings * closes).sum(axis=1)
+
+def max_drawdown(equity):
+    peaks = np.maximum.accumulate(equity)
+    return float(((peaks - equity) / peaks).max())
+
+
+def _init_worker(generator, settings):
+    global _generator, _settings
+    _generator = generator
+    _settings = settings
+
+def _generate_chunk(task):
+    path_file, start, stop, seed = task
+    paths = np.load(path_file, mmap_mode='r+')
+    returns = _generator.sample(stop - start, paths.shape[1] - 1, np.random.default_rng(seed))
+    paths[start:stop, 0] = _settings['start_prices']
+    paths[start:stop, 1:] = _settings['start_prices'] * np.exp(np.cumsum(returns, axis=1))
+    paths.flush()
+    return stop - start
+
+def _evaluate_chunk(task):
+    path_file, start, stop = task
+    settings = _settings
+    closes = np.asarray(np.load(path_file, mmap_mode='r')[start:stop])
+    trends = ema_trends(closes)
+    warmup = settings['warmup']
+    results = []
+    for path in range(len(closes)):
+        path_closes = closes[path, warmup:]
+        result = backtest_engine.simulate(path_closes, trends[path, warmup:], settings['volumes'], settings['balance'],
+                                          settings['positions'], settings['take_profit_percentage'],
+                                          settings['trailing_stop_steps'])
+        equity = equity_curve(path_closes, result['trades'], settings['volumes'], settings['balance'],
+                              settings['positions'])
+        results.append({
+            'path': start + path,
+            'start_value': settings['balance'] + np.dot(settings['positions'], path_closes[0]),
+            'final_value': equity[-1],
+            'hold_value': settings['balance'] + np.dot(settings['positions'], path_closes[-1]),
+            'max_drawdown_pct': max_drawdown(equity) * 100,
+            'trades': len(result['trades']),
+        })
+    return results
+
+
+def generate_paths(path_file, generator, paths, days, start_prices, seed=None, processes=None):
+    # paths x days x tickers closes in a .npy file, every path starting at start_prices.
+    # Chunks are generated in parallel, each with its own child of the seed, so a seed
+    # gives the same paths whatever the number of processes.
+    storage = np.lib.format.open_memmap(path_file, mode='w+', dtype=np.float64, shape=(paths, days, len(start_prices)))
+    del storage
+    bounds = list(range(0, paths, PATH_CHUNK)) + [paths]
+    seeds = np.random.SeedSequence(seed).spawn(len(bounds) - 1)
+    tasks = [(path_file, start, stop, child) for start, stop, child in zip(bounds[:-1], bounds[1:], seeds)]
+    settings = {'start_prices': np.asarray(start_prices, dtype=float)}
+    with _pool(processes, generator, settings) as pool:
+        pool.map(_generate_chunk, tasks)
+    return path_file
+
+def evaluate_paths(path_file, tickers, initial_balance, asset_starting_balances,
+                   take_profit_percentage=TAKE_PROFIT_PERCENTAGE, trailing_stop_steps=TRAILING_STOP_STEPS,
+                   min_trade_volume=MIN_TRADE_VOLUME, processes=None):
+    # One row per path: the strategy run by simulate() over the days after the signal
+    # warm-up, from the initial balance and holdings, with its final value, the value of
+    # just holding the starting balances and the maximum drawdown of its daily value
+    paths = np.load(path_file, mmap_mode='r')
+    if paths.shape[1] <= SIGNAL_WARMUP:
+        raise ValueError(f"Paths of {paths.shape[1]} days leave no trading days after the {SIGNAL_WARMUP}-day warm-up")
+    settings = {
+        'volumes': [min_trade_volume[TICKER_TO_PAIR[ticker]] for ticker in tickers],
+        'balance': initial_balance,
+        'positions': [asset_starting_balances.get(ticker, 0) for ticker in tickers],
+        'take_profit_percentage': take_profit_percentage,
+        'trailing_stop_steps': trailing_stop_steps,
+        'warmup': SIGNAL_WARMUP,
+    }
+    bounds = list(range(0, paths.shape[0], PATH_CHUNK)) + [paths.shape[0]]
+    tasks = [(path_file, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    with _pool(processes, None, settings) as pool:
+        chunks = pool.map(_evaluate_chunk, tasks)
+    table = pd.DataFrame([row for chunk in chunks for row in chunk]).set_index('path')
+    table['return_pct'] = (table['final_value'] / table['start_value'] - 1) * 100
+    table['hold_return_pct'] = (table['hold_value'] / table['start_value'] - 1) * 100
+    return table
+
+def _pool(processes, generator, settings):
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+    return context.Pool(processes or os.cpu_count(), initializer=_init_worker, initargs=(generator, settings))
+
+def distribution_summary(table):
+    # Percentiles of the final value, return and drawdown over all paths
+    columns = ['final_value', 'return_pct', 'hold_return_pct', 'max_drawdown_pct', 'trades']
+    summary = table[columns].quantile([percentile / 100 for percentile in PERCENTILES]).T
+    summary.columns = [f"p{percentile}" for percentile in PERCENTILES]
+    summary.insert(0, 'mean', table[columns].mean())
+    summary.insert(1, 'std', table[columns].std())
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stress-test the strategy on simulated price paths")
+    parser.add_argument('--db-path', default='crypto_data.db')
+    parser.add_argument('--bar-store', help="read prices from this columnar bar store instead of the database")
+    parser.add_argument('--model', choices=MODELS, default='bootstrap',
+                        help="block bootstrap of historical returns or regime-switching GBM fitted to them")
+    parser.add_argument('--paths', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=HORIZON_DAYS, help="trading days per path")
+    parser.add_argument('--block-days', type=int, default=BLOCK_DAYS)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--paths-file', default='stress_paths.npy', help="where the paths x days x tickers closes are stored")
+    parser.add_argument('--reuse-paths', action='store_true', help="evaluate the paths already in --paths-file")
+    parser.add_argument('--initial-balance', type=float, default=100)
+    parser.add_argument('--take-profit', type=float, default=TAKE_PROFIT_PERCENTAGE)
+    parser.add_argument('--trailing-steps', type=parse_steps, default=TRAILING_STOP_STEPS,
+                        help="comma separated step list, e.g. 0.06,0.10,0.15,0.20,0.25")
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--output', help="write the per-path table to this CSV file")
+    args = parser.parse_args()
+
+    if not args.reuse_paths:
+        data = load_price_data(args.db_path, TICKERS, args.bar_store)
+        returns, start_prices = historical_returns(data, TICKERS)
+        generator = BlockBootstrap(returns, args.block_days) if args.model == 'bootstrap' else RegimeSwitchingGBM(returns)
+        print(f"Generating {args.paths} {args.model} paths of {args.days} days from {len(returns)} days of returns")
+        generate_paths(args.paths_file, generator, args.paths, SIGNAL_WARMUP + args.days, start_prices, args.seed,
+                       args.processes)
+    table = evaluate_paths(args.paths_file, TICKERS, args.initial_balance, ASSET_STARTING_BALANCES,
+                           take_profit_percentage=args.take_profit, trailing_stop_steps=args.trailing_steps,
+                           processes=args.processes)
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:,.2f}'.format):
+        print(f"\nDistribution over {len(table)} paths:")
+        print(distribution_summary(table))
+    print(f"\nPaths losing money: {(table['return_pct'] < 0).mean():.1%}; "
+          f"beating buy-and-hold: {(table['return_pct'] > table['hold_return_pct']).mean():.1%}")
+    if args.output:
+        table.to_csv(args.output)
+        print(f"Wrote {len(table)} rows to {args.output}")
@@ -0,0 +1,155 @@
+import os
+import random
+import logging
+import argparse
+import itertools
+import multiprocessing
+import pandas as pd
+from test import CryptoBacktester, TAKE_PROFIT_PERCENTAGE, TRAILING_STOP_STEPS, MIN_TRADE_VOLUME
+from historical_data import HistoricalData
+from bar_store import BarStore
+
+TICKERS = ['SOL-USD', 'XRP-USD', 'BTC-USD', 'ETH-USD']
+ASSET_STARTING_BALANCES = {'SOL-USD': 0.5, 'XRP-USD': 500, 'BTC-USD': 0.001, 'ETH-USD': 0.1}
+
+# Price data loaded once in the parent. Forked workers inherit it copy-on-write; with the
+# spawn start method it is pickled to each worker once by the pool initializer.
+_shared_data = None
+_backtest_settings = None
+
+
+def parameter_grid(take_profit_percentages, trailing_stop_steps, volume_scales, ma_windows):
+    for take_profit, steps, scale, windows in itertools.product(take_profit_percentages, trailing_stop_steps,
+                                                                volume_scales, ma_windows):
+        yield {
+            'take_profit_percentage': take_profit,
+            'trailing_stop_steps': steps,
+            'volume_scale': scale,
+            'ma_windows': windows,
+        }
+
+def sample_parameters(grid, samples, seed=None):
+    grid = list(grid)
+    if samples >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, samples)
+
+def load_price_data(db_path, tickers, bar_store_path=None):
+    if bar_store_path:
+        # Memory-mapped columns are shared with forked workers through the page cache
+        return HistoricalData(bar_store=BarStore(bar_store_path)).preload(tickers)
+    data = HistoricalData(db_path).preload(tickers)
+    data.close()
+    return data
+
+
+def _init_worker(data, settings):
+    global _shared_data, _backtest_settings
+    _shared_data = data
+    _backtest_settings = settings
+    # The backtester logs every trade at INFO; workers only report the results
+    logging.getLogger(CryptoBacktester.__module__).setLevel(logging.WARNING)
+
+def _run_config(params):
+    settings = _backtest_settings
+    min_trade_volume = {pair: volume * params['volume_scale'] for pair, volume in MIN_TRADE_VOLUME.items()}
+    backtester = CryptoBacktester(
+        None,
+        settings['start_date'],
+        settings['end_date'],
+        settings['initial_balance'],
+        dict(settings['asset_starting_balances']),
+        take_profit_percentage=params['take_profit_percentage'],
+        trailing_stop_steps=params['trailing_stop_steps'],
+        min_trade_volume=min_trade_volume,
+        ma_windows=params['ma_windows'],
+        data=_shared_data,
+    )
+    backtester.run_backtest(settings['tickers'], engine=settings['engine'])
+    performance = backtester.calculate_performance()
+    round_trips, curve, stats = backtester.analyze_trades()
+
+    return {
+        **params,
+        'total_value': performance['total_value'],
+        'profit_loss': performance['profit_loss'],
+        'return_pct': performance['profit_loss'] / performance['initial_total_value'] * 100,
+        'total_trades': performance['total_trades'],
+        'win_rate': stats['win_rate'],
+        'max_drawdown': stats['max_drawdown'],
+        'sharpe': stats['sharpe'],
+        'skipped_buy_orders': backtester.skipped_buy_orders,
+        'skipped_sell_orders': backtester.skipped_sell_orders,
+    }
+
+def run_sweep(data, tickers, configs, start_date, end_date, initial_balance, asset_starting_balances,
+              engine='vectorized', processes=None, rank_by='profit_loss'):
+    settings = {
+        'tickers': tickers,
+        'start_date': start_date,
+        'end_date': end_date,
+        'initial_balance': initial_balance,
+        'asset_starting_balances': asset_starting_balances,
+        'engine': engine,
+    }
+    configs = list(configs)
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(configs) // (processes * 4))
+
+    with context.Pool(processes, initializer=_init_worker, initargs=(data, settings)) as pool:
+        results = pool.map(_run_config, configs, chunksize=chunksize)
+
+    table = pd.DataFrame(results).sort_values(rank_by, ascending=False).reset_index(drop=True)
+    table.index += 1
+    table.index.name = 'rank'
+    return table
+
+
+def parse_windows(value):
+    short_window, long_window = (int(part) for part in value.split('/'))
+    return short_window, long_window
+
+def parse_steps(value):
+    return [float(step) for step in value.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the backtester over a grid of strategy parameters in parallel")
+    parser.add_argument('--db-path', default='crypto_data.db')
+    parser.add_argument('--bar-store', help="read prices from this columnar bar store instead of the database")
+    parser.add_argument('--start-date', default='2020-01-01')
+    parser.add_argument('--end-date', default='2023-12-31')
+    parser.add_argument('--initial-balance', type=float, default=100)
+    parser.add_argument('--take-profit', type=float, nargs='+', default=[TAKE_PROFIT_PERCENTAGE])
+    parser.add_argument('--trailing-steps', type=parse_steps, nargs='+', default=[TRAILING_STOP_STEPS],
+                        help="comma separated step list, e.g. 0.06,0.10,0.15,0.20,0.25")
+    parser.add_argument('--volume-scale', type=float, nargs='+', default=[1.0],
+                        help="multiplier applied to MIN_TRADE_VOLUME for every pair")
+    parser.add_argument('--ma-windows', type=parse_windows, nargs='+', default=[None],
+                        help="short/long SMA windows, e.g. 50/200; default uses the stored trend signal")
+    parser.add_argument('--samples', type=int, help="evaluate a random sample of this many grid points")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--engine', choices=['loop', 'vectorized'], default='vectorized')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--rank-by', default='profit_loss')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--output', help="write the full ranked table to this CSV file")
+    args = parser.parse_args()
+
+    configs = parameter_grid(args.take_profit, args.trailing_steps, args.volume_scale, args.ma_windows)
+    if args.samples:
+        configs = sample_parameters(configs, args.samples, args.seed)
+    configs = list(configs)
+
+    data = load_price_data(args.db_path, TICKERS, args.bar_store)
+    print(f"Loaded {len(TICKERS)} tickers, running {len(configs)} configurations")
+    table = run_sweep(data, TICKERS, configs, args.start_date, args.end_date, args.initial_balance, ASSET_STARTING_BALANCES,
+                      engine=args.engine, processes=args.processes, rank_by=args.rank_by)
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(table.head(args.top))
+    if args.output:
+        table.to_csv(args.output)
+        print(f"Wrote {len(table)} results to {args.output}")
@@ -1,14 +1,25 @@
-import sqlite3
 import pandas as pd
 import numpy as np
+import argparse
+import logging
 from datetime import datetime
+import backtest_engine
+import trade_analytics
+from stops import StopBook, TRAILING_STOP_STEPS
+from historical_data import HistoricalData
+from bar_store import BarStore
+from metrics import metrics, configure_logging, profiled
+
+logger = logging.getLogger(__name__)
 
 MIN_TRADE_VOLUME = {'SOL/USD': 0.02, 'XRP/USD': 10.0, 'BTC/USD': 0.0001, 'ETH/USD': 0.002}
 TICKER_TO_PAIR = {'SOL-USD': 'SOL/USD', 'XRP-USD': 'XRP/USD', 'BTC-USD': 'BTC/USD', 'ETH-USD': 'ETH/USD'}
 TAKE_PROFIT_PERCENTAGE = 0.30
-TRAILING_STOP_STEPS = [0.06, 0.10, 0.15, 0.20, 0.25]
 
 class Order:
+    __slots__ = ('ticker', 'order_type', 'price', 'volume', 'timestamp', 'filled', 'filled_price',
+                 'filled_timestamp', 'stop_loss_price', 'current_stop_step')
+
     def __init__(self, ticker, order_type, price, volume, timestamp):
         self.ticker = ticker
         self.order_type = order_type
@@ -22,47 +33,96 @@ class Order:
         self.current_stop_step = 0
 
 class LimitOrder(Order):
-    def __init__(self, ticker, order_type, price, volume, timestamp):
+    __slots__ = ('entry_price',)
+
+    def __init__(self, ticker, order_type, price, volume, timestamp, entry_price=None):
         super().__init__(ticker, order_type, price, volume, timestamp)
+        self.entry_price = entry_price
         self.stop_loss_price = None
         self.current_stop_step = 0
 
+# Open limit sell orders of the backtester in a StopBook, the trailing stop index the
+# live bot uses, so a close only touches the orders it fills or steps up. An order
+# fills at the close once the close reaches its limit price or falls to its trailing
+# stop. Reserved volume follows the number of open orders: all orders of a ticker have
+# its pair's trade volume, and the running sums reproduce the sum over the open orders
+# exactly.
+class OpenOrderBook:
+    def __init__(self, trailing_stop_steps):
+        self.stops = StopBook(trailing_stop_steps)
+        self.reserved_sums = {}
+
+    def add(self, order):
+        self.stops.add(order, order.ticker, order.entry_price, order.price, order.current_stop_step, order.stop_loss_price)
+        sums = self.reserved_sums.setdefault(order.ticker, [0])
+        if len(sums) <= self.stops.count(order.ticker):
+            sums.append(sums[-1] + order.volume)
+
+    def pop_fillable(self, ticker, price):
+        # Orders a close at price fills, in placement order; stops it moves up are set
+        stepped, triggered = self.stops.update(ticker, price)
+        for order, step, stop_price in stepped:
+            order.current_stop_step = step
+            order.stop_loss_price = stop_price
+        return [order for order, reason in triggered]
+
+    def reserved_volume(self, ticker):
+        return self.reserved_sums[ticker][self.stops.count(ticker)] if ticker in self.reserved_sums else 0
+
+    def __len__(self):
+        return len(self.stops)
+
+    def __iter__(self):
+        return iter(self.stops)
+
+def moving_average_trend(close, short_window, long_window):
+    short_ma = close.rolling(window=short_window).mean()
+    long_ma = close.rolling(window=long_window).mean()
+    return pd.Series(np.where(short_ma > long_ma, 'Bullish', 'Bearish'), index=close.index)
+
 class CryptoBacktester:
-    def __init__(self, db_path, start_date, end_date, initial_balance, asset_starting_balances):
-        self.conn = sqlite3.connect(db_path)
+    def __init__(self, db_path, start_date, end_date, initial_balance, asset_starting_balances,
+                 take_profit_percentage=TAKE_PROFIT_PERCENTAGE, trailing_stop_steps=TRAILING_STOP_STEPS,
+                 min_trade_volume=MIN_TRADE_VOLUME, ma_windows=None, data=None):
+        # data: optional HistoricalData shared with other backtesters; by default one is
+        # created for db_path. ma_windows: optional (short, long) SMA windows replacing the
+        # stored trend signal the live bot trades on.
+        self.data = data if data is not None else HistoricalData(db_path)
+        self.take_profit_percentage = take_profit_percentage
+        self.trailing_stop_steps = trailing_stop_steps
+        self.min_trade_volume = min_trade_volume
+        self.ma_windows = ma_windows
         self.start_date = datetime.strptime(start_date, '%Y-%m-%d')
         self.end_date = datetime.strptime(end_date, '%Y-%m-%d')
         self.balance = initial_balance
         self.initial_balance = initial_balance
         self.positions = asset_starting_balances
         self.initial_positions = asset_starting_balances.copy()
-        self.open_orders = []
+        self.open_orders = OpenOrderBook(trailing_stop_steps)
         self.filled_orders = []
+        self.last_buy = {}
         self.skipped_buy_orders = 0
         self.skipped_sell_orders = 0
+        self.update_log_levels()
+
+    def update_log_levels(self):
+        # Checked once per run so disabled trade logging costs one attribute test per message
+        self.log_trades = logger.isEnabledFor(logging.INFO)
+        self.log_debug = logger.isEnabledFor(logging.DEBUG)
 
     def fetch_all_historical_data(self, tickers):
         all_data = {}
-        start_date_str = self.start_date.strftime('%Y-%m-%d %H:%M:%S')
-        end_date_str = self.end_date.strftime('%Y-%m-%d %H:%M:%S')
-        
         for ticker in tickers:
-            query = f"""
-            SELECT timestamp, close, ground_truth_trend
-            FROM crypto_data
-            WHERE ticker = '{ticker}'
-            AND timestamp BETWEEN '{start_date_str}' AND '{end_date_str}'
-            ORDER BY timestamp ASC
-            """
-            df = pd.read_sql_query(query, self.conn)
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df.set_index('timestamp', inplace=True)
+            df = self.data.window(ticker, self.start_date, self.end_date)
+            if self.ma_windows:
+                df = df.copy()
+                df['signal'] = moving_average_trend(df['close'], *self.ma_windows)
             all_data[ticker] = df
         return all_data
 
     def place_market_order(self, ticker, order_type, price, timestamp):
         pair = TICKER_TO_PAIR[ticker]
-        volume = MIN_TRADE_VOLUME[pair]
+        volume = self.min_trade_volume[pair]
         
         if order_type == 'buy':
             cost = price * volume
@@ -74,17 +134,21 @@ class CryptoBacktester:
                 order.filled_price = price
                 order.filled_timestamp = timestamp
                 self.filled_orders.append(order)
+                self.last_buy[ticker] = order
                 self.place_limit_sell_order(ticker, price, volume, timestamp)
-                print(f"Buy order executed for {ticker}: {volume} @ ${price:.2f}")
+                if self.log_trades:
+                    logger.info(f"Buy order executed for {ticker}: {volume} @ ${price:.2f}")
                 return True
             else:
                 self.skipped_buy_orders += 1
-                print(f"Skipped buy order for {ticker} due to insufficient balance")
+                if self.log_trades:
+                    logger.info(f"Skipped buy order for {ticker} due to insufficient balance")
                 return False
         elif order_type == 'sell':
             available_volume = self.get_available_volume(ticker)
-            required_volume = MIN_TRADE_VOLUME[TICKER_TO_PAIR[ticker]]
-            print(f"Debug - Attempting to sell {ticker}: Available volume: {available_volume}, Required volume: {required_volume}")
+            required_volume = self.min_trade_volume[TICKER_TO_PAIR[ticker]]
+            if self.log_debug:
+                logger.debug(f"Attempting to sell {ticker}: Available volume: {available_volume}, Required volume: {required_volume}")
             if available_volume >= required_volume:
                 self.balance += price * required_volume
                 self.positions[ticker] -= required_volume
@@ -93,52 +157,35 @@ class CryptoBacktester:
                 order.filled_price = price
                 order.filled_timestamp = timestamp
                 self.filled_orders.append(order)
-                print(f"Sell order executed for {ticker}: {required_volume} @ ${price:.2f}")
+                if self.log_trades:
+                    logger.info(f"Sell order executed for {ticker}: {required_volume} @ ${price:.2f}")
                 return True
             else:
                 self.skipped_sell_orders += 1
-                print(f"Skipped sell order for {ticker} due to insufficient volume")
+                if self.log_trades:
+                    logger.info(f"Skipped sell order for {ticker} due to insufficient volume")
                 return False
 
     def place_limit_sell_order(self, ticker, buy_price, volume, timestamp):
-        limit_price = buy_price * (1 + TAKE_PROFIT_PERCENTAGE)
-        order = LimitOrder(ticker, 'limit_sell', limit_price, volume, timestamp)
-        self.open_orders.append(order)
-        print(f"Placed limit sell order for {ticker}: {volume} @ ${limit_price:.2f}")
-
-    def update_trailing_stop(self, order, current_price):
-        if not hasattr(order, 'stop_loss_price'):
-            order.stop_loss_price = None
-            order.current_stop_step = 0
-
-        if order.stop_loss_price is None and current_price >= order.price * (1 + TRAILING_STOP_STEPS[0]):
-            order.stop_loss_price = order.price * 1.05
-            order.current_stop_step = 1
-            print(f"Set initial trailing stop for {order.ticker} at ${order.stop_loss_price:.2f}")
-        elif order.stop_loss_price is not None:
-            for i, step in enumerate(TRAILING_STOP_STEPS[order.current_stop_step:], start=order.current_stop_step):
-                if current_price >= order.price * (1 + step):
-                    order.stop_loss_price = order.price * (1 + TRAILING_STOP_STEPS[i-1])
-                    order.current_stop_step = i
-                    print(f"Updated trailing stop for {order.ticker} to ${order.stop_loss_price:.2f}")
-                else:
-                    break
+        limit_price = buy_price * (1 + self.take_profit_percentage)
+        order = LimitOrder(ticker, 'limit_sell', limit_price, volume, timestamp, entry_price=buy_price)
+        self.open_orders.add(order)
+        if self.log_trades:
+            logger.info(f"Placed limit sell order for {ticker}: {volume} @ ${limit_price:.2f}")
 
     def get_available_volume(self, ticker):
         total_volume = self.positions.get(ticker, 0)
-        reserved_volume = sum(order.volume for order in self.open_orders if order.ticker == ticker and order.order_type == 'limit_sell')
+        reserved_volume = self.open_orders.reserved_volume(ticker)
         available_volume = total_volume - reserved_volume
-        print(f"Debug - {ticker}: Total volume: {total_volume}, Reserved volume: {reserved_volume}, Available volume: {available_volume}")
+        if self.log_debug:
+            logger.debug(f"{ticker}: Total volume: {total_volume}, Reserved volume: {reserved_volume}, Available volume: {available_volume}")
         return available_volume
 
     def process_open_orders(self, ticker, current_price, timestamp):
-        for order in self.open_orders[:]:
-            if order.ticker == ticker:
-                if isinstance(order, LimitOrder):
-                    self.update_trailing_stop(order, current_price)
-                    if current_price >= order.price or (order.stop_loss_price and current_price <= order.stop_loss_price):
-                        self.fill_limit_order(order, current_price, timestamp)
-                        self.open_orders.remove(order)
+        for order in self.open_orders.pop_fillable(ticker, current_price):
+            if self.log_trades and order.stop_loss_price is not None and current_price <= order.stop_loss_price:
+                logger.info(f"Trailing stop of {order.ticker} hit at step {order.current_stop_step} (${order.stop_loss_price:.2f})")
+            self.fill_limit_order(order, current_price, timestamp)
 
     def fill_limit_order(self, order, fill_price, timestamp):
         self.balance += fill_price * order.volume
@@ -147,7 +194,8 @@ class CryptoBacktester:
         order.filled_price = fill_price
         order.filled_timestamp = timestamp
         self.filled_orders.append(order)
-        print(f"Filled limit order for {order.ticker}: {order.volume} @ ${fill_price:.2f}")
+        if self.log_trades:
+            logger.info(f"Filled limit order for {order.ticker}: {order.volume} @ ${fill_price:.2f}")
 
     def process_all_assets_for_day(self, day_data):
         for ticker, row in day_data.items():
@@ -155,34 +203,32 @@ class CryptoBacktester:
             
             current_price = row['close']
             timestamp = row.name
-            current_trend = row['ground_truth_trend']
+            current_trend = row['signal']
             
-            print(f"\nProcessing {ticker} on {timestamp}")
-            print(f"Current price: ${current_price:.2f}, Current trend: {current_trend}")
+            if self.log_trades:
+                logger.info(f"\nProcessing {ticker} on {timestamp}")
+                logger.info(f"Current price: ${current_price:.2f}, Current trend: {current_trend}")
 
             if current_trend == 'Bullish':
-                print(f"Bullish trend detected for {ticker}. Attempting buy order.")
+                if self.log_trades:
+                    logger.info(f"Bullish trend detected for {ticker}. Attempting buy order.")
                 self.place_market_order(ticker, 'buy', current_price, timestamp)
             elif current_trend == 'Bearish':
-                print(f"Bearish trend detected for {ticker}. Attempting sell order.")
+                if self.log_trades:
+                    logger.info(f"Bearish trend detected for {ticker}. Attempting sell order.")
                 self.place_market_order(ticker, 'sell', current_price, timestamp)
 
-            last_buy_order = next((order for order in reversed(self.filled_orders) 
-                                   if order.ticker == ticker and order.order_type == 'buy'), None)
+            last_buy_order = self.last_buy.get(ticker)
             
-            if last_buy_order:
+            if last_buy_order and self.log_trades:
                 buy_price = last_buy_order.price
                 price_increase = (current_price - buy_price) / buy_price
+                logger.info(f"Last buy price: ${buy_price:.2f}, Current price: ${current_price:.2f}, Price increase: {price_increase:.2%}")
 
-                print(f"Last buy price: ${buy_price:.2f}, Current price: ${current_price:.2f}, Price increase: {price_increase:.2%}")
-
-                if price_increase >= TRAILING_STOP_STEPS[0]:
-                    self.update_trailing_stop(last_buy_order, current_price)
-                else:
-                    print(f"Current price has not increased by {TRAILING_STOP_STEPS[0]:.0%} from the buy price for {ticker}. No trailing stop order placed.")
-
-    def run_backtest(self, tickers):
-        all_data = self.fetch_all_historical_data(tickers)
+    def run_backtest(self, tickers, engine='loop'):
+        self.update_log_levels()
+        with metrics.timer('backtest_load'):
+            all_data = self.fetch_all_historical_data(tickers)
         
         non_empty_data = {ticker: df for ticker, df in all_data.items() if not df.empty}
         
@@ -194,26 +240,91 @@ class CryptoBacktester:
         
         if pd.isna(min_date) or pd.isna(max_date):
             raise ValueError("Unable to determine valid date range from the data.")
+
+        if engine == 'vectorized':
+            with metrics.timer('backtest_simulate'):
+                self.run_vectorized_backtest(non_empty_data)
+            return
+        elif engine != 'loop':
+            raise ValueError(f"Unknown backtest engine: {engine}")
         
-        for date in pd.date_range(min_date, max_date):
-            day_data = {}
-            for ticker, df in non_empty_data.items():
-                if date in df.index:
-                    day_data[ticker] = df.loc[date]
-            
-            if day_data:
-                print(f"\nProcessing data for {date.date()}")
-                self.process_all_assets_for_day(day_data)
+        with metrics.timer('backtest_simulate'):
+            for date in pd.date_range(min_date, max_date):
+                day_data = {}
+                for ticker, df in non_empty_data.items():
+                    if date in df.index:
+                        day_data[ticker] = df.loc[date]
+                
+                if day_data:
+                    if self.log_trades:
+                        logger.info(f"\nProcessing data for {date.date()}")
+                    self.process_all_assets_for_day(day_data)
+
+    def run_vectorized_backtest(self, data):
+        tickers = list(data)
+        dates, closes, trends = backtest_engine.align_price_data(data, tickers)
+        # Timestamps as a list: indexing a DatetimeIndex per trade costs more than the run
+        dates = dates.tolist()
+        result = backtest_engine.simulate(
+            closes,
+            trends,
+            volumes=[self.min_trade_volume[TICKER_TO_PAIR[ticker]] for ticker in tickers],
+            balance=self.balance,
+            positions=[self.positions.get(ticker, 0) for ticker in tickers],
+            take_profit_percentage=self.take_profit_percentage,
+            trailing_stop_steps=self.trailing_stop_steps,
+        )
+
+        for day, column, order_type, price, filled_price, placed_day in result['trades']:
+            ticker = tickers[column]
+            volume = self.min_trade_volume[TICKER_TO_PAIR[ticker]]
+            if order_type == backtest_engine.LIMIT_SELL:
+                order = LimitOrder(ticker, order_type, price, volume, dates[placed_day], entry_price=closes[placed_day, column])
+            else:
+                order = Order(ticker, order_type, price, volume, dates[day])
+            order.filled = True
+            order.filled_price = filled_price
+            order.filled_timestamp = dates[day]
+            self.filled_orders.append(order)
+            if order_type == backtest_engine.BUY:
+                self.last_buy[ticker] = order
+
+        for column, limit_price, placed_day, step, stop_price in result['open_orders']:
+            ticker = tickers[column]
+            volume = self.min_trade_volume[TICKER_TO_PAIR[ticker]]
+            order = LimitOrder(ticker, 'limit_sell', limit_price, volume, dates[placed_day], entry_price=closes[placed_day, column])
+            order.current_stop_step = step
+            order.stop_loss_price = stop_price
+            self.open_orders.add(order)
+
+        self.balance = result['balance']
+        traded = {tickers[trade[1]] for trade in result['trades']}
+        for ticker, position in zip(tickers, result['positions']):
+            if ticker in self.positions or ticker in traded:
+                self.positions[ticker] = position
+        self.skipped_buy_orders += result['skipped_buy_orders']
+        self.skipped_sell_orders += result['skipped_sell_orders']
+        logger.info(f"Vectorized backtest processed {len(dates)} days x {len(tickers)} tickers, {len(result['trades'])} trades")
+
+    def analyze_trades(self):
+        # FIFO round trips, the daily equity curve and risk statistics of the filled orders;
+        # the starting holdings are an opening lot at the first price
+        trades = trade_analytics.backtest_trades(self.filled_orders)
+        tickers = list(dict.fromkeys(list(self.initial_positions) + list(trades['ticker'].unique())))
+        prices = pd.DataFrame({ticker: self.data.window(ticker, self.start_date, self.end_date)['close'] for ticker in tickers})
+        opening = {ticker: (volume, self.data.first_price(ticker, self.start_date, self.end_date), self.start_date)
+                   for ticker, volume in self.initial_positions.items() if volume}
+        return trade_analytics.analyze(trades, prices, self.initial_balance, opening)
 
     def calculate_performance(self):
         total_value = self.balance
         for ticker, volume in self.positions.items():
-            last_price = self.fetch_all_historical_data([ticker])[ticker].iloc[-1]['close']
+            last_price = self.data.last_price(ticker, self.start_date, self.end_date)
             total_value += volume * last_price
 
         initial_total_value = self.initial_balance
         for ticker, volume in self.initial_positions.items():
-            first_price = self.fetch_all_historical_data([ticker])[ticker].iloc[0]['close']
+            first_price = self.data.first_price(ticker, self.start_date, self.end_date)
             initial_total_value += volume * first_price
 
         return {
@@ -240,7 +351,7 @@ class CryptoBacktester:
 
         summary += "Final Asset Holdings:\n"
         for ticker, volume in self.positions.items():
-            final_price = self.fetch_all_historical_data([ticker])[ticker].iloc[-1]['close']
+            final_price = self.data.last_price(ticker, self.start_date, self.end_date)
             value = volume * final_price
             summary += f"  {ticker}:\n"
             summary += f"    Amount Held: {volume:.6f}\n"
@@ -248,35 +359,47 @@ class CryptoBacktester:
             summary += f"    Current Price: ${final_price:.2f}\n"
             summary += "\n"
 
-        buy_orders = [order for order in self.filled_orders if order.order_type == 'buy']
-        sell_orders = [order for order in self.filled_orders if order.order_type == 'sell']
-        limit_sell_orders = [order for order in self.filled_orders if order.order_type == 'limit_sell']
-
-        # Calculate average profit per trade
-        total_profit = 0
-        total_trades = 0
-        for buy_order in buy_orders:
-            matching_sells = [order for order in sell_orders + limit_sell_orders 
-                            if order.ticker == buy_order.ticker and order.timestamp > buy_order.timestamp]
-            for sell_order in matching_sells:
-                profit = (sell_order.filled_price - buy_order.filled_price) * min(buy_order.volume, sell_order.volume)
-                total_profit += profit
-                total_trades += 1
-
-        avg_profit_per_trade = total_profit / total_trades if total_trades > 0 else 0
+        order_types = [order.order_type for order in self.filled_orders]
+        round_trips, curve, stats = self.analyze_trades()
 
         summary += "Trading Activity:\n"
         summary += f"  Total Trades: {len(self.filled_orders)}\n"
-        summary += f"  Buy Orders: {len(buy_orders)}\n"
-        summary += f"  Sell Orders: {len(sell_orders)}\n"
-        summary += f"  Limit Sell Orders: {len(limit_sell_orders)}\n"
+        summary += f"  Buy Orders: {order_types.count('buy')}\n"
+        summary += f"  Sell Orders: {order_types.count('sell')}\n"
+        summary += f"  Limit Sell Orders: {order_types.count('limit_sell')}\n"
         summary += f"  Skipped Buy Orders: {self.skipped_buy_orders}\n"
-        summary += f"  Skipped Sell Orders: {self.skipped_sell_orders}\n"
-        summary += f"  Average Profit per Trade: ${avg_profit_per_trade:.2f}\n"
+        summary += f"  Skipped Sell Orders: {self.skipped_sell_orders}\n\n"
+
+        summary += "Round Trips (FIFO):\n"
+        summary += f"  Closed Round Trips: {stats['round_trips']}\n"
+        summary += f"  Win Rate: {stats['win_rate']:.2%}\n"
+        summary += f"  Realized Profit/Loss: ${stats['realized_pnl']:.2f}\n"
+        summary += f"  Average Profit per Round Trip: ${stats['average_pnl']:.2f}\n"
+        summary += f"  Average Return per Round Trip: {stats['average_return']:.2%}\n"
+        summary += f"  Average Holding Period: {stats['average_holding_days']:.1f} days\n\n"
+
+        summary += "Risk:\n"
+        summary += f"  Max Drawdown: {stats['max_drawdown']:.2%} (${stats['max_drawdown_value']:.2f})\n"
+        summary += f"  Sharpe Ratio: {stats['sharpe']:.2f}\n"
+        summary += f"  Sortino Ratio: {stats['sortino']:.2f}\n"
+        summary += f"  Exposure: {stats['exposure']:.2%} of equity invested on average\n"
+        summary += f"  Turnover: {stats['turnover']:.2f}x ({stats['annual_turnover']:.2f}x per year)\n"
 
         return summary
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the momentum strategy on stored data")
+    parser.add_argument('--engine', choices=['loop', 'vectorized'], default='loop',
+                        help="'loop' replays day by day with full trade logging, 'vectorized' runs on aligned NumPy arrays")
+    parser.add_argument('--bar-store', help="read prices from this columnar bar store instead of the database")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="INFO logs every trade, WARNING only the summary")
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'])
+    parser.add_argument('--profile-output', help="write the profile here instead of logging it")
+    parser.add_argument('--metrics-file', help="append stage timings as JSON lines, or write Prometheus text to *.prom")
+    args = parser.parse_args()
+    configure_logging(args.log_level, fmt='%(message)s')
+
     initial_balance = 100
     asset_starting_balances = {
         'SOL-USD': 0.5,
@@ -290,12 +413,16 @@ if __name__ == "__main__":
         start_date='2020-01-01',
         end_date='2023-12-31',
         initial_balance=initial_balance,
-        asset_starting_balances=asset_starting_balances
+        asset_starting_balances=asset_starting_balances,
+        data=HistoricalData(bar_store=BarStore(args.bar_store)) if args.bar_store else None
     )
     
-    print("Starting backtest...")
-    backtester.run_backtest(['SOL-USD', 'XRP-USD', 'BTC-USD', 'ETH-USD'])
+    logger.info("Starting backtest...")
+    with profiled(args.profile, args.profile_output):
+        backtester.run_backtest(['SOL-USD', 'XRP-USD', 'BTC-USD', 'ETH-USD'], engine=args.engine)
     
-    print("\nBacktest completed. Generating KPI summary...")
+    logger.info("\nBacktest completed. Generating KPI summary...")
     kpi_summary = backtester.generate_kpi_summary()
-    print(kpi_summary)
\ No newline at end of file
+    print(kpi_summary)
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+import pytest
+import kraken_daily_momentum as bot
+from exchange_client import ExchangeClient, MockExchange, TokenBucket
+from reconcile import reconcile_orders
+from trade_analytics import ledger_trades
+from trade_ledger import TradeLedger
+
+
+# A connection whose commit waits until the test releases it
+class BlockingConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.writing.set()
+        self.release.wait(10)
+        return self.conn.__exit__(*exc_info)
+
+
+def memory_db():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    bot.create_tables(conn)
+    return conn
+
+
+def test_slow_commit_does_not_block_stop_updates():
+    conn = memory_db()
+    blocking = BlockingConnection(conn)
+    ledger = TradeLedger(blocking).load()
+    ledger.log_trade('BTC-USD', 'BTC/USD', 'buy', 100.0, 1.0)
+    order = ledger.log_trade('BTC-USD', 'BTC/USD', 'sell', 100.0, 1.0, limit_order=1, limit_price=130.0)
+
+    flush = threading.Thread(target=ledger.flush)
+    flush.start()
+    assert blocking.writing.wait(10)
+    results = []
+    tick = threading.Thread(target=lambda: results.append(ledger.update_stops('BTC-USD', 106.0)))
+    tick.start()
+    tick.join(2)
+    blocked = tick.is_alive()
+    blocking.release.set()
+    flush.join(10)
+    tick.join(10)
+
+    assert not blocked
+    assert results == [([order], [])]
+    # The step taken during the write is written by the next flush, under the new row id
+    assert order['id'] is not None
+    assert ledger.flush() == 1
+    assert conn.execute("SELECT current_step FROM trade_history WHERE id = ?", (order['id'],)).fetchone() == (1,)
+
+
+def test_failed_flush_keeps_rows_for_the_next_one():
+    conn = memory_db()
+    ledger = TradeLedger(conn).load()
+    ledger.log_trade('BTC-USD', 'BTC/USD', 'buy', 100.0, 1.0)
+    ledger.set_sync_state('cursor', '1')
+    conn.execute("DROP TABLE sync_state")
+    with pytest.raises(sqlite3.OperationalError):
+        ledger.flush()
+    conn.execute("CREATE TABLE sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    assert ledger.flush() == 1
+    assert conn.execute("SELECT COUNT(*) FROM trade_history").fetchone() == (1,)
+    assert conn.execute("SELECT value FROM sync_state").fetchone() == ('1',)
+
+
+def test_stop_after_partial_fill_records_the_whole_sale():
+    exchange = MockExchange({'BTC/USD': 100.0}, {'USD': 10000.0})
+    unlimited = float('inf')
+    client = ExchangeClient(exchange, TokenBucket(unlimited, 1), TokenBucket(unlimited, 1), fill_batch_window=0)
+    conn = memory_db()
+    ledger = TradeLedger(conn).load()
+    bot.execute_trade(ledger, 'BTC/USD', 'buy', 1.0, client)
+    [order] = ledger.get_open_orders('BTC-USD')
+    exchange.fill_partially(order['exchange_order_id'], 0.4, order['limit_price'])
+    reconcile_orders(ledger, client)
+    assert order['filled_volume'] == 0.4
+
+    # +6% sets the stop at +5%, which the fall to +4% crosses
+    bot.manage_open_orders(ledger, 'BTC-USD', 106.0, client)
+    exchange.set_price('BTC/USD', 104.0)
+    bot.manage_open_orders(ledger, 'BTC-USD', 104.0, client)
+    ledger.flush()
+
+    trades = ledger_trades(conn)
+    sells = trades[trades['side'] == 'sell']
+    bought = trades.loc[trades['side'] == 'buy', 'volume'].sum()
+    assert sorted(zip(sells['price'], sells['volume'])) == [(104.0, 0.6), (order['limit_price'], 0.4)]
+    assert ledger.position('BTC-USD')[0] == bought - sells['volume'].sum() == 0
+    assert TradeLedger(conn).load().position('BTC-USD')[0] == 0
@@ -0,0 +1,213 @@
+import math
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+PERIODS_PER_YEAR = 365  # the equity curve is sampled every calendar day; crypto trades every day
+VOLUME_TOLERANCE = 1e-9  # matched slices smaller than this fraction of the largest trade are rounding noise
+TRADE_COLUMNS = ['ticker', 'side', 'price', 'volume', 'timestamp']
+
+# Executed trades in trade_history: market orders at their order price, limit sells for
+# the volume that filled, at the fill price (the limit price while only partially filled)
+LEDGER_TRADES_QUERY = """
+SELECT ticker,
+       trade_type AS side,
+       CASE WHEN limit_order = 1 THEN COALESCE(filled_at, limit_price) ELSE price END AS price,
+       CASE WHEN limit_order = 1 THEN COALESCE(filled_volume, CASE WHEN filled = 1 THEN volume ELSE 0 END)
+            ELSE volume END AS volume,
+       CASE WHEN limit_order = 1 THEN COALESCE(filled_timestamp, timestamp) ELSE timestamp END AS timestamp
+FROM trade_history
+WHERE limit_order = 0 OR filled = 1 OR filled_volume > 0
+ORDER BY 5, id
+"""
+
+
+def backtest_trades(orders):
+    # CryptoBacktester.filled_orders (in execution order) as a trades frame; market and
+    # limit sells are both sells
+    return pd.DataFrame({
+        'ticker': [order.ticker for order in orders],
+        'side': ['buy' if order.order_type == 'buy' else 'sell' for order in orders],
+        'price': np.array([order.filled_price for order in orders], dtype=float),
+        'volume': np.array([order.volume for order in orders], dtype=float),
+        'timestamp': pd.to_datetime([order.filled_timestamp for order in orders]),
+    }, columns=TRADE_COLUMNS)
+
+def ledger_trades(conn):
+    # Timestamps in trade_history are local time
+    trades = pd.read_sql_query(LEDGER_TRADES_QUERY, conn)
+    trades['timestamp'] = pd.to_datetime(trades['timestamp'], format='ISO8601')
+    return trades[trades['volume'] > 0].reset_index(drop=True)
+
+def stored_prices(conn, tickers, interval='1d'):
+    # Dates x tickers closes from crypto_data
+    placeholders = ', '.join('?' for _ in tickers)
+    closes = pd.read_sql_query(f"""
+    SELECT timestamp, ticker, close FROM crypto_data
+    WHERE interval = ? AND ticker IN ({placeholders})
+    ORDER BY timestamp
+    """, conn, params=[interval] + list(tickers))
+    closes['timestamp'] = pd.to_datetime(closes['timestamp'])
+    return closes.pivot(index='timestamp', columns='ticker', values='close')
+
+
+def _match_ticker(ticker, trades, opening):
+    # FIFO in one vectorized pass. Sells are first clipped to the inventory held at the
+    # time (a running maximum of the shortfall), so a sell never reaches a later buy.
+    # Lots and sales then become intervals on one cumulative volume axis, and every
+    # slice between consecutive interval ends is one round trip.
+    signed = np.where(trades['side'].to_numpy() == 'buy', 1.0, -1.0) * trades['volume'].to_numpy()
+    prices = trades['price'].to_numpy()
+    times = trades['timestamp'].to_numpy()
+    opening_volume, opening_price, opening_time = opening or (0.0, np.nan, np.datetime64('NaT'))
+
+    inventory = opening_volume + np.cumsum(signed)
+    shortfall = np.maximum.accumulate(np.maximum(-inventory, 0))
+    is_sell = signed < 0
+    sold = np.where(is_sell, -signed - np.diff(shortfall, prepend=0.0), 0.0)[is_sell]
+
+    is_buy = ~is_sell
+    lot_volumes = np.concatenate([[opening_volume], signed[is_buy]])
+    lot_prices = np.concatenate([[opening_price], prices[is_buy]])
+    lot_times = np.concatenate([np.array([opening_time], dtype=times.dtype), times[is_buy]])
+    lot_ends = np.cumsum(lot_volumes)
+    sale_ends = np.cumsum(sold)
+    total = sale_ends[-1] if len(sale_ends) else 0.0
+
+    ends = np.unique(np.concatenate([lot_ends[lot_ends < total], sale_ends]))
+    ends = ends[ends > 0]
+    starts = np.concatenate([[0.0], ends])[:-1]
+    volumes = ends - starts
+    keep = volumes > VOLUME_TOLERANCE * max(np.abs(signed).max(initial=0), opening_volume)
+    starts, volumes = starts[keep], volumes[keep]
+    lots = np.searchsorted(lot_ends, starts, side='right')
+    sales = np.searchsorted(sale_ends, starts, side='right')
+
+    entry_prices = lot_prices[lots]
+    exit_prices = prices[is_sell][sales]
+    return pd.DataFrame({
+        'ticker': ticker,
+        'entry_time': lot_times[lots],
+        'exit_time': times[is_sell][sales],
+        'volume': volumes,
+        'entry_price': entry_prices,
+        'exit_price': exit_prices,
+        'pnl': (exit_prices - entry_prices) * volumes,
+        'return': exit_prices / entry_prices - 1,
+    })
+
+def match_fifo(trades, opening=None):
+    # Round trips of FIFO-matched lots, one row per (lot, sale) slice. opening maps tickers
+    # to (volume, price, timestamp) holdings that predate the trades; sells beyond the
+    # holdings on record stay unmatched.
+    opening = opening or {}
+    trades = trades.sort_values('timestamp', kind='stable')
+    frames = [_match_ticker(ticker, group, opening.get(ticker)) for ticker, group in trades.groupby('ticker', sort=False)]
+    round_trips = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['ticker', 'entry_time', 'exit_time', 'volume', 'entry_price', 'exit_price', 'pnl', 'return'])
+    round_trips['holding_period'] = round_trips['exit_time'] - round_trips['entry_time']
+    return round_trips.sort_values(['exit_time', 'entry_time'], kind='stable').reset_index(drop=True)
+
+
+def equity_curve(trades, prices, initial_cash=0.0, opening=None):
+    # Daily cash, holdings value and equity on the dates of prices (dates x tickers closes).
+    # Trades count from the first date at or after them; holdings without a price yet
+    # are valued at zero.
+    opening = opening or {}
+    dates = prices.index
+    tickers = list(prices.columns)
+    columns = {ticker: i for i, ticker in enumerate(tickers)}
+    known = trades['ticker'].isin(columns).to_numpy()
+    if not known.all():
+        raise ValueError(f"No prices for {', '.join(sorted(set(trades['ticker'][~known])))}")
+
+    rows = np.minimum(dates.searchsorted(trades['timestamp'].dt.normalize().to_numpy()), len(dates) - 1)
+    cols = trades['ticker'].map(columns).to_numpy()
+    signed = np.where(trades['side'].to_numpy() == 'buy', 1.0, -1.0) * trades['volume'].to_numpy()
+
+    changes = np.zeros((len(dates), len(tickers)))
+    np.add.at(changes, (rows, cols), signed)
+    for ticker, (volume, price, timestamp) in opening.items():
+        changes[0, columns[ticker]] += volume
+    positions = np.cumsum(changes, axis=0)
+
+    flows = np.zeros(len(dates))
+    np.add.at(flows, rows, -signed * trades['price'].to_numpy())
+    cash = initial_cash + np.cumsum(flows)
+    holdings = np.nansum(positions * prices.ffill().to_numpy(), axis=1)
+    return pd.DataFrame({'cash': cash, 'holdings': holdings, 'equity': cash + holdings}, index=dates)
+
+
+def performance_stats(round_trips, curve, trades):
+    equity = curve['equity']
+    previous = equity.shift(1)
+    returns = (equity / previous - 1)[previous > 0].dropna()
+    downside = math.sqrt((np.minimum(returns, 0) ** 2).mean()) if len(returns) else 0.0
+    deviation = returns.std()
+    peak = equity.cummax()
+    invested = (curve['holdings'] / equity)[equity > 0]
+    notional = (trades['price'] * trades['volume']).sum()
+    average_equity = equity[equity > 0].mean()
+    years = max(len(curve) - 1, 1) / PERIODS_PER_YEAR
+
+    return {
+        'round_trips': len(round_trips),
+        'win_rate': (round_trips['pnl'] > 0).mean() if len(round_trips) else np.nan,
+        'realized_pnl': round_trips['pnl'].sum(),
+        'average_pnl': round_trips['pnl'].mean() if len(round_trips) else np.nan,
+        'average_return': round_trips['return'].mean() if len(round_trips) else np.nan,
+        'average_holding_days': round_trips['holding_period'].dt.total_seconds().mean() / 86400 if len(round_trips) else np.nan,
+        'total_return': equity.iat[-1] / equity.iat[0] - 1 if len(equity) and equity.iat[0] > 0 else np.nan,
+        'max_drawdown': (equity / peak - 1)[peak > 0].min() if (peak > 0).any() else np.nan,
+        'max_drawdown_value': (equity - peak).min() if len(equity) else np.nan,
+        'sharpe': returns.mean() / deviation * math.sqrt(PERIODS_PER_YEAR) if deviation > 0 else np.nan,
+        'sortino': returns.mean() / downside * math.sqrt(PERIODS_PER_YEAR) if downside > 0 else np.nan,
+        'exposure': invested.mean() if len(invested) else np.nan,
+        'turnover': notional / average_equity if average_equity > 0 else np.nan,
+        'annual_turnover': notional / average_equity / years if average_equity > 0 else np.nan,
+    }
+
+def analyze(trades, prices, initial_cash=0.0, opening=None):
+    round_trips = match_fifo(trades, opening)
+    curve = equity_curve(trades, prices, initial_cash, opening)
+    return round_trips, curve, performance_stats(round_trips, curve, trades)
+
+
+def main(db_path, initial_cash, interval, round_trips_path=None, equity_path=None):
+    conn = sqlite3.connect(db_path)
+    trades = ledger_trades(conn)
+    if trades.empty:
+        print("No executed trades in trade_history")
+        return
+    prices = stored_prices(conn, sorted(trades['ticker'].unique()), interval)
+    conn.close()
+    if prices.empty:
+        print(f"No {interval} bars stored for the traded tickers")
+        return
+    # Start at the last bar at or before the first trade so opening positions have a value
+    first = max(prices.index.searchsorted(trades['timestamp'].min().normalize(), side='right') - 1, 0)
+    prices = prices.iloc[first:]
+    round_trips, curve, stats = analyze(trades, prices, initial_cash)
+
+    print(f"{len(trades)} trades in {trades['ticker'].nunique()} tickers, {prices.index[0].date()} to {prices.index[-1].date()}")
+    for name, value in stats.items():
+        print(f"  {name}: {value:.4f}" if isinstance(value, float) else f"  {name}: {value}")
+    if round_trips_path:
+        round_trips.to_csv(round_trips_path, index=False)
+        print(f"Wrote {len(round_trips)} round trips to {round_trips_path}")
+    if equity_path:
+        curve.to_csv(equity_path, index_label='date')
+        print(f"Wrote the equity curve to {equity_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Round-trip P&L and risk statistics of the live trade history")
+    parser.add_argument('db_path')
+    parser.add_argument('--initial-cash', type=float, default=0.0,
+                        help="cash held before the first trade; returns, Sharpe and drawdown are relative to it")
+    parser.add_argument('--interval', default='1d', help="stored bar interval used to value holdings")
+    parser.add_argument('--round-trips', help="write the FIFO round trips to this CSV file")
+    parser.add_argument('--equity', help="write the daily equity curve to this CSV file")
+    args = parser.parse_args()
+    main(args.db_path, args.initial_cash, args.interval, args.round_trips, args.equity)
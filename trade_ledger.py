@@ -0,0 +1,275 @@
+import threading
+from datetime import datetime
+from stops import StopBook, TRAILING_STOP_STEPS
+
+TRADE_COLUMNS = ['ticker', 'pair', 'trade_type', 'price', 'volume', 'timestamp', 'limit_order', 'limit_price',
+                 'filled', 'filled_at', 'filled_timestamp', 'trailing_stop_price', 'current_step',
+                 'exchange_order_id', 'exchange_status', 'filled_volume', 'exchange_order_type']
+
+INSERT_TRADE = f"""
+INSERT INTO trade_history ({', '.join(TRADE_COLUMNS)})
+VALUES ({', '.join('?' for _ in TRADE_COLUMNS)})
+"""
+
+UPDATE_ORDER = """
+UPDATE trade_history
+SET trailing_stop_price = ?, current_step = ?, filled = ?, filled_at = ?, filled_timestamp = ?,
+    exchange_order_id = ?, exchange_status = ?, filled_volume = ?, exchange_order_type = ?
+WHERE id = ?
+"""
+
+UPSERT_SYNC_STATE = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)"
+
+
+# Unit of work over trade_history for one run. load() reads every open limit order and
+# the latest buy of every ticker in two queries; trading code then logs trades, moves
+# stops and fills orders in memory, and flush() writes everything back in a single
+# transaction. Safe to share between the per-ticker worker threads. Small sync_state
+# values, such as the reconciliation cursor, are written in the same transaction.
+# The ledger also keeps the net volume of every ticker it bought and has not sold yet,
+# so portfolios sharing an exchange account can each trade only their own position.
+# Open orders are also kept in a StopBook, so a price update only touches the orders
+# whose trailing stop it moves or crosses. Their take-profit is watched there too when
+# no exchange order rests at the limit price: orders placed before exchange ids were
+# stored, and orders whose exchange order is a stop-loss.
+class TradeLedger:
+    def __init__(self, conn, trailing_stop_steps=TRAILING_STOP_STEPS):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.trailing_stop_steps = trailing_stop_steps
+        self.stops = StopBook(trailing_stop_steps)
+        self.open_orders = {}
+        self.last_buy = {}
+        self.positions = {}
+        self.new_trades = []
+        self.dirty_orders = {}
+        self.sync_state = {}
+        self.dirty_sync_state = {}
+
+    def load(self):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        SELECT id, ticker, price, volume, timestamp, limit_price, trailing_stop_price, current_step,
+               exchange_order_id, exchange_status, filled_volume, exchange_order_type
+        FROM trade_history
+        WHERE limit_order = 1 AND filled = 0 AND (exchange_status IS NULL OR exchange_status = 'open')
+        ORDER BY ticker, id
+        """)
+        with self.lock:
+            self.open_orders = {}
+            self.stops = StopBook(self.trailing_stop_steps)
+            for (order_id, ticker, price, volume, timestamp, limit_price, trailing_stop_price, current_step,
+                 exchange_order_id, exchange_status, filled_volume, exchange_order_type) in cursor.fetchall():
+                order = {
+                    'id': order_id, 'ticker': ticker, 'price': price, 'volume': volume, 'timestamp': timestamp,
+                    'limit_price': limit_price, 'trailing_stop_price': trailing_stop_price,
+                    'current_step': current_step, 'filled': 0, 'filled_at': None, 'filled_timestamp': None,
+                    'exchange_order_id': exchange_order_id, 'exchange_status': exchange_status,
+                    'filled_volume': filled_volume, 'exchange_order_type': exchange_order_type,
+                }
+                self.open_orders.setdefault(ticker, []).append(order)
+                self._watch(order)
+
+            # SQLite returns the bare id/price columns from the row holding MAX(timestamp)
+            cursor.execute("""
+            SELECT ticker, id, price, MAX(timestamp)
+            FROM trade_history
+            WHERE trade_type = 'buy'
+            GROUP BY ticker
+            """)
+            self.last_buy = {ticker: {'id': order_id, 'price': price, 'timestamp': timestamp}
+                             for ticker, order_id, price, timestamp in cursor.fetchall()}
+            # Market sells are logged unfilled; limit sells count what they sold, all of it
+            # once filled
+            cursor.execute("""
+            SELECT ticker, SUM(CASE WHEN trade_type = 'buy' THEN volume
+                                    WHEN limit_order = 0 OR filled = 1 THEN -volume
+                                    ELSE -COALESCE(filled_volume, 0) END)
+            FROM trade_history
+            GROUP BY ticker
+            """)
+            self.positions = dict(cursor.fetchall())
+            cursor.execute("SELECT key, value FROM sync_state")
+            self.sync_state = dict(cursor.fetchall())
+            self.new_trades = []
+            self.dirty_orders = {}
+            self.dirty_sync_state = {}
+        return self
+
+    def log_trade(self, ticker, pair, trade_type, price, volume, limit_order=0, limit_price=None, filled=0, filled_at=None, filled_timestamp=None, trailing_stop_price=None, current_step=0, exchange_order_id=None, exchange_order_type=None):
+        trade = {
+            'id': None, 'ticker': ticker, 'pair': pair, 'trade_type': trade_type, 'price': price, 'volume': volume,
+            'timestamp': datetime.now().isoformat(), 'limit_order': limit_order, 'limit_price': limit_price,
+            'filled': filled, 'filled_at': filled_at, 'filled_timestamp': filled_timestamp,
+            'trailing_stop_price': trailing_stop_price, 'current_step': current_step,
+            'exchange_order_id': exchange_order_id,
+            'exchange_status': 'open' if exchange_order_id is not None and limit_order and not filled else None,
+            'filled_volume': volume if filled else None,
+            'exchange_order_type': exchange_order_type or ('limit' if exchange_order_id is not None and limit_order else None),
+        }
+        with self.lock:
+            self.new_trades.append(trade)
+            if trade_type == 'buy':
+                self._add_position(ticker, volume)
+            elif not limit_order or filled:
+                self._add_position(ticker, -volume)
+            if limit_order and not filled:
+                self.open_orders.setdefault(ticker, []).append(trade)
+                self._watch(trade)
+            if trade_type == 'buy':
+                self.last_buy[ticker] = trade
+        return trade
+
+    def get_open_orders(self, ticker):
+        with self.lock:
+            return list(self.open_orders.get(ticker, []))
+
+    def get_last_buy(self, ticker):
+        with self.lock:
+            return self.last_buy.get(ticker)
+
+    def _add_position(self, ticker, volume):
+        self.positions[ticker] = self.positions.get(ticker, 0.0) + volume
+
+    def position(self, ticker):
+        # (volume bought and not sold through this ledger, the part of it not held by open
+        # take-profit orders)
+        with self.lock:
+            held = self.positions.get(ticker, 0.0)
+            reserved = sum(order['volume'] - (order['filled_volume'] or 0) for order in self.open_orders.get(ticker, []))
+            return held, held - reserved
+
+    def is_open(self, order):
+        with self.lock:
+            return self._is_open(order)
+
+    def _is_open(self, order):
+        return not order['filled'] and any(open_order is order for open_order in self.open_orders.get(order['ticker'], []))
+
+    def _watch(self, order):
+        local_limit = order['exchange_order_id'] is None or order['exchange_order_type'] == 'stop-loss'
+        self.stops.add(order, order['ticker'], order['price'], order['limit_price'] if local_limit else None,
+                       order['current_step'], order['trailing_stop_price'])
+
+    def watch(self, order):
+        # Puts an order that update_stops triggered back in the stop book, e.g. when
+        # closing it on the exchange failed
+        with self.lock:
+            if self._is_open(order) and order not in self.stops:
+                self._watch(order)
+
+    def update_stops(self, ticker, price):
+        # Moves the trailing stops the price reached and returns (stepped orders,
+        # [(order, reason)] for orders whose stop or watched limit price it crossed)
+        with self.lock:
+            stepped, triggered = self.stops.update(ticker, price)
+            for order, step, stop_price in stepped:
+                order['current_step'] = step
+                order['trailing_stop_price'] = stop_price
+                self._mark_dirty(order)
+            return [order for order, step, stop_price in stepped], triggered
+
+    def replace_exchange_order(self, order, exchange_order_id, order_type):
+        # The order now rests on the exchange under a new id, e.g. as a stop-loss order
+        with self.lock:
+            order['exchange_order_id'] = exchange_order_id
+            order['exchange_order_type'] = order_type
+            order['exchange_status'] = 'open'
+            self._mark_dirty(order)
+            self.stops.remove(order)
+            self._watch(order)
+
+    def fill_order(self, order, fill_price):
+        # Returns False when another thread filled or canceled the order first. A filled
+        # row counts its whole volume, here and in trade_analytics.
+        with self.lock:
+            if not self._is_open(order):
+                return False
+            self._add_position(order['ticker'], (order['filled_volume'] or 0) - order['volume'])
+            order['filled'] = 1
+            order['filled_at'] = fill_price
+            order['filled_timestamp'] = datetime.now().isoformat()
+            order['filled_volume'] = order['volume']
+            self.open_orders[order['ticker']].remove(order)
+            self.stops.remove(order)
+            self._mark_dirty(order)
+            return True
+
+    def exchange_orders(self):
+        # Open orders that were placed on the exchange, by exchange order id
+        with self.lock:
+            return {order['exchange_order_id']: order for orders in self.open_orders.values()
+                    for order in orders if order['exchange_order_id'] is not None}
+
+    def apply_exchange_order(self, order, status, filled_volume, average_price, closed_timestamp=None):
+        # Record the exchange's view of an order: partial fills while it is open, the fill
+        # price once it is closed; canceled or expired orders leave the open set
+        with self.lock:
+            if order['filled'] or (order['exchange_status'] == status and order['filled_volume'] == filled_volume):
+                return False
+            sold = order['volume'] if status == 'closed' else (filled_volume or 0)
+            self._add_position(order['ticker'], (order['filled_volume'] or 0) - sold)
+            order['exchange_status'] = status
+            order['filled_volume'] = filled_volume
+            if status == 'closed':
+                order['filled'] = 1
+                order['filled_at'] = average_price
+                order['filled_timestamp'] = closed_timestamp or datetime.now().isoformat()
+            if status != 'open':
+                self.open_orders[order['ticker']].remove(order)
+                self.stops.remove(order)
+            self._mark_dirty(order)
+            return True
+
+    def get_sync_state(self, key):
+        with self.lock:
+            return self.sync_state.get(key)
+
+    def set_sync_state(self, key, value):
+        with self.lock:
+            self.sync_state[key] = value
+            self.dirty_sync_state[key] = value
+
+    def _mark_dirty(self, order):
+        # Orders created this run are written with their final values by the insert
+        if order['id'] is not None:
+            self.dirty_orders[order['id']] = order
+
+    def flush(self):
+        # The dirty rows are snapshot and cleared under the lock, which is released for the
+        # write itself so stop updates on the tick path never wait for a commit. flush_lock
+        # keeps flushes in order; a failed write puts its rows back for the next flush.
+        with self.flush_lock:
+            with self.lock:
+                if not self.new_trades and not self.dirty_orders and not self.dirty_sync_state:
+                    return 0
+                trades, orders, sync_state = self.new_trades, self.dirty_orders, self.dirty_sync_state
+                self.new_trades, self.dirty_orders, self.dirty_sync_state = [], {}, {}
+                inserts = [tuple(trade[column] for column in TRADE_COLUMNS) for trade in trades]
+                updates = [(order['trailing_stop_price'], order['current_step'], order['filled'], order['filled_at'],
+                            order['filled_timestamp'], order['exchange_order_id'], order['exchange_status'],
+                            order['filled_volume'], order['exchange_order_type'], order['id'])
+                           for order in orders.values()]
+            try:
+                # The connection context manager commits once, or rolls back everything on error
+                with self.conn:
+                    cursor = self.conn.cursor()
+                    cursor.executemany(INSERT_TRADE, inserts)
+                    # Rows inserted in one write transaction get consecutive AUTOINCREMENT ids
+                    last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+                    cursor.executemany(UPDATE_ORDER, updates)
+                    cursor.executemany(UPSERT_SYNC_STATE, list(sync_state.items()))
+            except Exception:
+                with self.lock:
+                    self.new_trades[:0] = trades
+                    self.dirty_orders = {**orders, **self.dirty_orders}
+                    self.dirty_sync_state = {**sync_state, **self.dirty_sync_state}
+                raise
+            with self.lock:
+                for offset, (trade, inserted) in enumerate(zip(trades, inserts)):
+                    trade['id'] = last_id - len(trades) + 1 + offset
+                    # Changed while the write ran, when it had no id to be marked dirty under
+                    if tuple(trade[column] for column in TRADE_COLUMNS) != inserted:
+                        self.dirty_orders[trade['id']] = trade
+            return len(inserts) + len(updates)
@@ -0,0 +1,163 @@
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import backtest_engine
+from test import TAKE_PROFIT_PERCENTAGE, MIN_TRADE_VOLUME, TICKER_TO_PAIR
+from sweep import TICKERS, ASSET_STARTING_BALANCES, load_price_data, parse_windows
+
+DEFAULT_MA_WINDOWS = [(20, 50), (20, 100), (50, 100), (50, 200), (100, 200)]
+
+# Signal matrices built once in the parent and inherited by forked workers, like the
+# price data of sweep.py
+_shared_signals = None
+_evaluation_settings = None
+
+
+# Aligned closes and the trend matrix of every candidate SMA pair over the whole history.
+# The averages come from one cumulative sum per ticker, and every train and test window
+# is a row slice of these arrays, so adding windows adds no indicator work.
+class SignalMatrices:
+    def __init__(self, data, tickers, ma_windows):
+        frames = {ticker: data.load(ticker) for ticker in tickers}
+        self.tickers = list(tickers)
+        self.dates, self.closes, _ = backtest_engine.align_price_data(frames, self.tickers)
+        # Holdings are valued at the last known close on days a ticker has no bar
+        self.marks = pd.DataFrame(self.closes).ffill().to_numpy()
+        windows = sorted({window for pair in ma_windows for window in pair})
+        averages = backtest_engine.moving_average_matrices(frames, self.tickers, self.dates, windows)
+        self.trends = {(short_window, long_window): backtest_engine.crossover_trends(averages[short_window], averages[long_window])
+                       for short_window, long_window in ma_windows}
+
+    def evaluate(self, ma_windows, start, end, volumes, balance, positions, take_profit_percentage):
+        # Fresh simulate() run over rows start:end with the starting balance and holdings
+        result = backtest_engine.simulate(self.closes[start:end], self.trends[ma_windows][start:end], volumes,
+                                          balance, positions, take_profit_percentage)
+        start_value = balance + np.nansum(np.asarray(positions, dtype=float) * self.marks[start])
+        end_value = result['balance'] + np.nansum(np.asarray(result['positions'], dtype=float) * self.marks[end - 1])
+        return {
+            'profit_loss': end_value - start_value,
+            'return_pct': (end_value - start_value) / start_value * 100 if start_value else np.nan,
+            'trades': len(result['trades']),
+        }
+
+
+def rolling_windows(dates, train_days, test_days, step_days):
+    # (train_start, test_start, test_end) row bounds on dates. Windows advance by step_days
+    # and stop once a test period would run past the history.
+    start = dates[0]
+    last = dates[-1] + pd.Timedelta(days=1)
+    while start + pd.Timedelta(days=train_days + test_days) <= last:
+        test_start = start + pd.Timedelta(days=train_days)
+        bounds = dates.searchsorted([start, test_start, test_start + pd.Timedelta(days=test_days)])
+        if bounds[2] > bounds[1]:
+            yield tuple(int(bound) for bound in bounds)
+        start += pd.Timedelta(days=step_days)
+
+
+def _init_worker(signals, settings):
+    global _shared_signals, _evaluation_settings
+    _shared_signals = signals
+    _evaluation_settings = settings
+
+def _run_window(task):
+    window, ma_windows, train_start, test_start, test_end = task
+    settings = _evaluation_settings
+    signals = _shared_signals
+    args = (settings['volumes'], settings['balance'], settings['positions'], settings['take_profit_percentage'])
+    train = signals.evaluate(ma_windows, train_start, test_start, *args) if test_start > train_start else {}
+    test = signals.evaluate(ma_windows, test_start, test_end, *args)
+    return {
+        'window': window,
+        'train_start': signals.dates[train_start].date(),
+        'test_start': signals.dates[test_start].date(),
+        'test_end': signals.dates[test_end - 1].date(),
+        'ma_windows': f"{ma_windows[0]}/{ma_windows[1]}",
+        'train_return_pct': train.get('return_pct', np.nan),
+        'train_trades': train.get('trades', 0),
+        'test_profit_loss': test['profit_loss'],
+        'test_return_pct': test['return_pct'],
+        'test_trades': test['trades'],
+    }
+
+def run_walk_forward(signals, ma_windows, train_days, test_days, step_days, initial_balance, asset_starting_balances,
+                     take_profit_percentage=TAKE_PROFIT_PERCENTAGE, min_trade_volume=MIN_TRADE_VOLUME, processes=None):
+    # One row per (window, SMA pair) with its in-sample and out-of-sample results. With
+    # train_days > 0 the pair with the best train return of each window is marked
+    # selected; with train_days == 0 every pair is simply scored on rolling windows.
+    settings = {
+        'volumes': [min_trade_volume[TICKER_TO_PAIR[ticker]] for ticker in signals.tickers],
+        'balance': initial_balance,
+        'positions': [asset_starting_balances.get(ticker, 0) for ticker in signals.tickers],
+        'take_profit_percentage': take_profit_percentage,
+    }
+    tasks = [(window, pair, *bounds)
+             for window, bounds in enumerate(rolling_windows(signals.dates, train_days, test_days, step_days))
+             for pair in ma_windows]
+    if not tasks:
+        raise ValueError(f"History from {signals.dates[0].date()} to {signals.dates[-1].date()} is shorter than one window")
+
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(tasks) // (processes * 4))
+    with context.Pool(processes, initializer=_init_worker, initargs=(signals, settings)) as pool:
+        table = pd.DataFrame(pool.map(_run_window, tasks, chunksize=chunksize))
+
+    if train_days:
+        best = table.groupby('window')['train_return_pct'].idxmax()
+        table['selected'] = table.index.isin(best)
+    return table
+
+def robustness_summary(table):
+    # Out-of-sample returns of each SMA pair across all windows
+    grouped = table.groupby('ma_windows')['test_return_pct']
+    summary = pd.DataFrame({
+        'windows': grouped.count(),
+        'mean_return_pct': grouped.mean(),
+        'std_return_pct': grouped.std(),
+        'worst_return_pct': grouped.min(),
+        'best_return_pct': grouped.max(),
+        'profitable_windows': grouped.apply(lambda returns: (returns > 0).mean()),
+    })
+    return summary.sort_values('mean_return_pct', ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Walk-forward and rolling-window backtests over candidate SMA windows")
+    parser.add_argument('--db-path', default='crypto_data.db')
+    parser.add_argument('--bar-store', help="read prices from this columnar bar store instead of the database")
+    parser.add_argument('--ma-windows', type=parse_windows, nargs='+', default=DEFAULT_MA_WINDOWS,
+                        help="candidate short/long SMA windows, e.g. 20/50 50/200")
+    parser.add_argument('--train-days', type=int, default=365,
+                        help="in-sample period used to pick the SMA pair; 0 scores every pair on rolling windows")
+    parser.add_argument('--test-days', type=int, default=90)
+    parser.add_argument('--step-days', type=int, help="distance between window starts (default: --test-days)")
+    parser.add_argument('--initial-balance', type=float, default=100)
+    parser.add_argument('--take-profit', type=float, default=TAKE_PROFIT_PERCENTAGE)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--output', help="write the per-window table to this CSV file")
+    args = parser.parse_args()
+
+    data = load_price_data(args.db_path, TICKERS, args.bar_store)
+    signals = SignalMatrices(data, TICKERS, args.ma_windows)
+    table = run_walk_forward(signals, args.ma_windows, args.train_days, args.test_days, args.step_days or args.test_days,
+                             args.initial_balance, ASSET_STARTING_BALANCES, take_profit_percentage=args.take_profit,
+                             processes=args.processes)
+    print(f"{table['window'].nunique()} windows x {len(args.ma_windows)} SMA pairs, "
+          f"{signals.dates[0].date()} to {signals.dates[-1].date()}")
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print("\nOut-of-sample returns per SMA pair:")
+        print(robustness_summary(table))
+        if args.train_days:
+            selected = table[table['selected']]
+            print("\nWalk-forward (pair chosen on the preceding train period):")
+            print(selected[['window', 'test_start', 'test_end', 'ma_windows', 'train_return_pct', 'test_return_pct',
+                            'test_trades']].to_string(index=False))
+            compounded = (1 + selected['test_return_pct'] / 100).prod() - 1
+            print(f"\nCompounded out-of-sample return: {compounded:.2%} over {len(selected)} test periods")
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"Wrote {len(table)} rows to {args.output}")